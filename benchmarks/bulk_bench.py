@@ -0,0 +1,61 @@
+"""Importing a json array of rows: one ORM object per row against bulk_insert's chunked executemany.
+
+Run with: python benchmarks/bulk_bench.py [rows]
+"""
+from sqlalchemy import create_engine, func, select, Column, Date, Integer, String
+from sqlalchemy.orm import declarative_base, sessionmaker
+import datetime
+import json
+import os
+import sys
+import tempfile
+import time
+
+Base = declarative_base()
+
+class Reading(Base):
+	__tablename__ = "readings"
+	id = Column(Integer, primary_key=True)
+	sensor = Column(String(32))
+	day = Column(Date)
+	value = Column(Integer)
+
+def _payload(rows: int) -> str:
+	return json.dumps([{"sensor": f"sensor {i % 100}", "day": "2024-01-01", "value": i} for i in range(rows)])
+
+def _engine(directory: str, name: str):
+	# A file, not memory, so commits pay for the journal like a real database
+	engine = create_engine(f"sqlite:///{os.path.join(directory, name)}.sqlite")
+	Base.metadata.create_all(engine)
+	return engine
+
+def _run(label: str, work, engine, rows: int) -> None:
+	start = time.perf_counter()
+	work()
+	elapsed = time.perf_counter() - start
+	with engine.connect() as connection:
+		assert connection.execute(select(func.count()).select_from(Reading.__table__)).scalar() == rows
+	print(f"{label:<38} {elapsed * 1000:9.1f} ms  {rows / elapsed:10.0f} rows/s")
+
+def main(rows: int) -> None:
+	from libmercury.bulk import insert_rows
+	payload = _payload(rows)
+	with tempfile.TemporaryDirectory() as directory:
+		orm = _engine(directory, "orm")
+
+		def per_object():
+			# What imports did before: json_to_object-style instances added one at a time
+			session = sessionmaker(bind=orm)()
+			for row in json.loads(payload):
+				row["day"] = datetime.date.fromisoformat(row["day"])
+				session.add(Reading(**row))
+				session.flush()
+			session.commit()
+
+		bulk = _engine(directory, "bulk")
+		print(f"{rows} rows")
+		_run("ORM object per row (before)", per_object, orm, rows)
+		_run("insert_rows, chunks of 5000", lambda: insert_rows(bulk, Reading, payload, chunk_size=5000), bulk, rows)
+
+if __name__ == "__main__":
+	main(int(sys.argv[1]) if len(sys.argv) > 1 else 50000)
@@ -0,0 +1,64 @@
+"""A migration creating tables and then adding columns to each: the per-operation engine, reflection and autocommit of
+the old MigrationWrapper against one Migration per file.
+
+Run with: python benchmarks/migration_bench.py [tables]
+"""
+from sqlalchemy import create_engine, inspect, Column, Integer, MetaData, String, Table
+import os
+import sys
+import tempfile
+import time
+
+def _columns():
+	return [Column("id", Integer, primary_key=True), Column("name", String(32))]
+
+def old_wrapper(url: str, tables: int) -> None:
+	# What every operation did before: a reflection of the schema(all of it to create a table) and an autocommitted statement
+	engine = create_engine(url)
+	metadata = MetaData()
+	for index in range(tables):
+		metadata.reflect(bind=engine)
+		Table(f"table_{index}", metadata, *_columns()).create(engine)
+	for index in range(tables):
+		for column in ("a", "b", "c"):
+			Table(f"table_{index}", metadata, autoload_with=engine)
+			with engine.begin() as connection:
+				connection.exec_driver_sql(f"ALTER TABLE table_{index} ADD COLUMN {column} INTEGER NULL")
+	engine.dispose()
+
+def _run(label: str, work, directory: str, tables: int) -> None:
+	url = f"sqlite:///{os.path.join(directory, label.split()[0])}.sqlite"
+	# The wrappers print every operation
+	stdout = sys.stdout
+	sys.stdout = open(os.devnull, "w")
+	start = time.perf_counter()
+	try:
+		work(url, tables)
+	finally:
+		sys.stdout.close()
+		sys.stdout = stdout
+	elapsed = time.perf_counter() - start
+	engine = create_engine(url)
+	assert len(inspect(engine).get_columns(f"table_{tables - 1}")) == 5
+	print(f"{label:<34} {elapsed * 1000:9.1f} ms")
+
+def main(tables: int) -> None:
+	from libmercury.db.MigrationGenerator import Migration, MigrationWrapper
+
+	def migration(url: str, tables: int) -> None:
+		# What mercury migrate does for a file: one connection and transaction, the schema reflected once
+		with Migration(url):
+			wrapper = MigrationWrapper(url)
+			for index in range(tables):
+				wrapper.create_table(f"table_{index}", _columns())
+			for index in range(tables):
+				for column in ("a", "b", "c"):
+					wrapper.add_column(f"table_{index}", Column(column, Integer, nullable=True))
+
+	with tempfile.TemporaryDirectory() as directory:
+		print(f"{tables} tables, 3 columns added to each")
+		_run("old MigrationWrapper (before)", old_wrapper, directory, tables)
+		_run("Migration, one transaction", migration, directory, tables)
+
+if __name__ == "__main__":
+	main(int(sys.argv[1]) if len(sys.argv) > 1 else 50)
@@ -0,0 +1,73 @@
+"""Serializing a list of model instances: model_to_json per object against a compiled Serializer.
+
+Run with: python benchmarks/serialize_bench.py [rows]
+"""
+from sqlalchemy import create_engine, select, Column, DateTime, Integer, Numeric, String
+from sqlalchemy.orm import declarative_base, sessionmaker
+from decimal import Decimal
+import datetime
+import json
+import sys
+import time
+
+Base = declarative_base()
+
+class Order(Base):
+	__tablename__ = "orders"
+	id = Column(Integer, primary_key=True)
+	customer = Column(String(64))
+	status = Column(String(16))
+	quantity = Column(Integer)
+	# Kept as strings, sqlite has no decimal or datetime type and model_to_json can't encode them
+	total = Column(String(16))
+	created = Column(String(32))
+	note = Column(String(256))
+
+def _setup(rows: int):
+	engine = create_engine("sqlite://")
+	Base.metadata.create_all(engine)
+	with engine.begin() as connection:
+		connection.execute(Order.__table__.insert(), [
+			{
+				"customer": f"customer {i}",
+				"status": "paid",
+				"quantity": i % 7,
+				"total": str(Decimal(i) / 100),
+				"created": datetime.datetime(2024, 1, 1).isoformat(),
+				"note": "n" * 40,
+			}
+			for i in range(rows)
+		])
+	return engine, sessionmaker(bind=engine)()
+
+def _time(label: str, func, repeat: int = 5) -> None:
+	best = min(_run(func) for _ in range(repeat))
+	print(f"{label:<34} {best * 1000:8.2f} ms")
+
+def _run(func) -> float:
+	start = time.perf_counter()
+	func()
+	return time.perf_counter() - start
+
+def main(rows: int) -> None:
+	from libmercury.utils import model_to_dict
+	from libmercury.serialization import serializer_for
+	engine, session = _setup(rows)
+	orders = session.query(Order).all()
+	serializer = serializer_for(Order, exclude=["note"])
+
+	def per_object():
+		# What list endpoints did before: the column walk and exclude check on every object
+		return "[" + ",".join(json.dumps({c.name: getattr(o, c.name) for c in o.__table__.columns if c.name not in ["note"]}) for o in orders) + "]"
+
+	print(f"{rows} orders, best of 5")
+	_time("model_to_json per object (before)", per_object)
+	_time("model_to_dict per object (now)", lambda: json.dumps([model_to_dict(o, ["note"]) for o in orders]))
+	_time("Serializer.dumps", lambda: serializer.dumps(orders))
+	with engine.connect() as connection:
+		_time("query + hydrate + dumps", lambda: serializer.dumps(session.query(Order).all()))
+		_time("Core rows + dump_rows", lambda: serializer.dump_rows(connection.execute(select(Order.__table__)).all()))
+	assert json.loads(per_object()) == json.loads(serializer.dumps(orders))
+
+if __name__ == "__main__":
+	main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
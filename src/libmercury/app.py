@@ -0,0 +1,207 @@
+from colorama import Fore, Style
+from .route_management import Route
+from .dispatch import LazyRoute, compile_route, get_nested_value
+from .manifest import RouteManifest
+from .static import StaticFiles
+from .compression import Compression
+from .metrics import Metrics
+from .profiling import Profiler
+from .limits import Bulkhead
+from .db.instrumentation import SQLInstrumentation
+from marsrouter import Router
+from werkzeug import Response
+from typing import List, Optional, Tuple
+import importlib.util
+import json
+import os
+import threading
+import time
+
+class BaseApp:
+	"""Loads the controllers listed in map.json and compiles their routes, shared by WSGIApp and ASGIApp."""
+	# Whether the app can await async def controllers
+	serves_async = True
+
+	def __init__(self, static: Optional[StaticFiles] = None, compression: Optional[Compression] = None, metrics: Optional[Metrics] = None, profiler: Optional[Profiler] = None,
+			lazy: bool = False, manifest: str = ".mercury_manifest.json", startup_report: bool = False, concurrency: Optional[Bulkhead] = None,
+			sql: Optional[SQLInstrumentation] = None):
+		# Pass static=StaticFiles(...) or compression=Compression(...) to tune them, or disable either with False
+		self.static = StaticFiles() if static is None else static
+		self.compression = Compression() if compression is None else compression
+		# Metrics are opt-in, pass metrics=Metrics(...) to record them and serve the exposition
+		self.metrics = metrics
+		# So is timing the statements, pass sql=SQLInstrumentation(...) to count them per request and report N+1 queries
+		self.sql = sql
+		if self.sql:
+			self.sql.activate()
+		# Profiling is opt-in, pass profiler=Profiler(...) to be able to switch it on at runtime
+		self.profiler = profiler
+		# A global limit on the requests running at once, routes can add their own with useConcurrencyLimit
+		self.concurrency = concurrency
+		# With lazy=True the routes come from a cached scan of the route decorators(see manifest.py)
+		# and each controller module is imported by the first request reaching one of its routes
+		self.lazy = lazy
+		self.manifest = manifest
+		# (controller path, what was done, seconds) for every module, including lazy imports done later
+		self.startup_timings: List[Tuple[str, str, float]] = []
+		self._modules = {}
+		self._loaders = {}
+		self._modules_lock = threading.Lock()
+		started = time.perf_counter()
+		self.routes = []
+		self.load_project()
+		self.router = Router()
+		self.load_mapper()
+		self.startup_time = time.perf_counter() - started
+		if startup_report or os.environ.get("MERCURY_STARTUP_REPORT"):
+			self.print_startup_report()
+
+	def load_mapper(self) -> None:
+		for route in self.routes:
+			if route.url[-1] == "/" and route.url != "/":
+				route.url = route.url[:-1]
+			loader = self._loaders.get(route)
+			compiled = LazyRoute(route, loader) if loader else compile_route(route)
+			# Lazy routes are only checked when their first request imports the controller
+			if not loader and (compiled.is_async or compiled.is_async_generator) and not self.serves_async:
+				raise self.async_error(compiled)
+			if self.metrics:
+				compiled.metrics = self.metrics.route(route.method, route.url)
+			self.router.add_route(route.url, compiled, methods=[route.method])
+
+	def load_project(self) -> None:
+		# Load the map.json file
+		with open('map.json') as f:
+			config = json.load(f)
+		
+		# Load and register routes from controllers
+		controller_paths = sorted(set(config.get('controllers', [])))
+		if not self.lazy:
+			for controller_path in controller_paths:
+				self._load_controller(controller_path)
+			return
+
+		manifest = RouteManifest(self.manifest)
+		for controller_path in controller_paths:
+			started = time.perf_counter()
+			entry, scanned = manifest.entry(controller_path, self._class_name(controller_path))
+			if entry["eager"]:
+				# The scan couldn't see every route of this controller, import it now
+				self._load_controller(controller_path)
+				continue
+			self._record_timing(controller_path, "scan" if scanned else "manifest", started)
+			for method, url, attribute in entry["routes"]:
+				route = Route(method, url, None)
+				self._loaders[route] = self._lazy_loader(controller_path, attribute)
+				self.routes.append(route)
+		manifest.prune(controller_paths)
+		manifest.save()
+
+	def _class_name(self, controller_path: str) -> str:
+		# The controller class is named like its module
+		return os.path.splitext(os.path.basename(controller_path))[0]
+
+	def _record_timing(self, controller_path: str, action: str, started: float) -> None:
+		self.startup_timings.append((controller_path, action, time.perf_counter() - started))
+
+	def _import_controller(self, controller_path: str, action: str = "import"):
+		# Modules are imported once, even when several lazy routes of one controller are hit at the same time
+		with self._modules_lock:
+			if controller_path in self._modules:
+				return self._modules[controller_path]
+			started = time.perf_counter()
+			module_name = self._class_name(controller_path)
+			spec = importlib.util.spec_from_file_location(module_name, controller_path)
+			module = importlib.util.module_from_spec(spec)
+			spec.loader.exec_module(module)
+			
+			# Get the controller class from the module
+			controller_class = getattr(module, module_name, None)
+			self._modules[controller_path] = controller_class
+			self._record_timing(controller_path, action, started)
+		if not controller_class:
+			print(f"{Fore.YELLOW}[WARNING] Controller class {module_name} not found in module {module_name}{Style.RESET_ALL}")
+		return controller_class
+
+	def _lazy_loader(self, controller_path: str, attribute: str):
+		def load():
+			controller_class = self._import_controller(controller_path, "lazy import")
+			if controller_class is None:
+				raise ImportError(f"Controller class {self._class_name(controller_path)} not found in {controller_path}")
+			return getattr(controller_class, attribute)
+		return load
+
+	def _load_controller(self, controller_path: str) -> None:
+		controller_class = self._import_controller(controller_path)
+		if not controller_class:
+			return
+	
+		# Iterate over all attributes in the class
+		for method_name in dir(controller_class):
+			method = getattr(controller_class, method_name)
+			
+			# Check if the attribute is callable and has route attributes
+			if callable(method) and hasattr(method, '_route_method') and hasattr(method, '_route_url'):
+				route = Route(method._route_method, method._route_url, method)
+				self.routes.append(route)
+
+	def admit(self, compiled, environ: dict) -> Tuple[Optional[Response], float]:
+		"""
+		Takes a slot of the route's concurrency limit, then of the global one. The route's limit goes first,
+		so requests to a saturated slow route are turned away before they can hold a global slot.
+		Returns the 503 to answer with(or None when admitted) and the seconds the request spent queued,
+		None when nothing could have queued it.
+		"""
+		# Time spent in the server's accept queue, set by the prefork server's thread pool
+		queued_at = environ.get("mercury.queued_at")
+		route_limit = compiled.concurrency
+		if queued_at is None and route_limit is None and self.concurrency is None:
+			return None, None
+		now = time.perf_counter()
+		waited = 0.0 if queued_at is None else max(now - queued_at, 0.0)
+		if route_limit is not None and route_limit.acquire() is None:
+			return route_limit.reject(), waited + time.perf_counter() - now
+		if self.concurrency is not None and self.concurrency.acquire() is None:
+			if route_limit is not None:
+				route_limit.release()
+			return self.concurrency.reject(), waited + time.perf_counter() - now
+		if route_limit is not None or self.concurrency is not None:
+			waited += time.perf_counter() - now
+		return None, waited
+
+	def release(self, compiled) -> None:
+		if compiled.concurrency is not None:
+			compiled.concurrency.release()
+		if self.concurrency is not None:
+			self.concurrency.release()
+
+	def record_sql(self, compiled, scope) -> None:
+		"""Hands the statements of an ended request to the instrumentation and the metrics."""
+		if scope.sql is None:
+			return
+		self.sql.finish(compiled, scope)
+		if compiled.metrics:
+			self.metrics.record_sql(compiled.metrics, scope.sql.queries, scope.sql.time)
+
+	def end_request(self, compiled, scope, error: bool) -> None:
+		"""Ends the request's database scope and frees its concurrency slots, call it once the body was sent."""
+		try:
+			scope.end(error)
+		finally:
+			self.release(compiled)
+			# Statements of the commit count as well
+			self.record_sql(compiled, scope)
+
+	def async_error(self, compiled) -> TypeError:
+		name = getattr(compiled.controller, "__qualname__", None) or repr(compiled.controller)
+		kind, action = ("an async generator", "iterate") if compiled.is_async_generator else ("an async def controller", "await")
+		return TypeError(f"{name} ({compiled.route.method} {compiled.route.url}) is {kind}, "
+			f"{type(self).__name__} can't {action} it, serve the app with ASGIApp or make the controller a plain def")
+
+	def print_startup_report(self) -> None:
+		print(f"{Fore.BLUE}[Startup]{Style.RESET_ALL} Ready in {self.startup_time * 1000:.1f}ms, {len(self.routes)} routes{' (lazy)' if self.lazy else ''}")
+		for controller_path, action, seconds in sorted(self.startup_timings, key=lambda timing: -timing[2]):
+			print(f"{Fore.BLUE}[Startup]{Style.RESET_ALL} {seconds * 1000:8.2f}ms  {action:<11} {controller_path}")
+
+	def get_nested_value(self, data: dict, key_path: str, default=None):
+		return get_nested_value(data, key_path, default)
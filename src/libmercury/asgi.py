@@ -0,0 +1,267 @@
+from concurrent.futures import ThreadPoolExecutor
+from .app import BaseApp
+from .static import StaticFiles
+from .compression import Compression
+from .metrics import Metrics
+from .profiling import Profiler
+from .limits import Bulkhead
+from .db.instrumentation import SQLInstrumentation
+from .db.connection import RequestScope
+from werkzeug import Request, Response
+from typing import Callable, Iterable, Optional, Tuple
+from functools import partial
+import asyncio
+import contextvars
+import io
+import sys
+import time
+
+def build_environ(scope: dict, body: bytes) -> dict:
+	"""Translates an ASGI http scope and its body into a WSGI environ, so werkzeug's Request works unchanged."""
+	server = scope.get("server") or ("localhost", 80)
+	client = scope.get("client") or ("", 0)
+	environ = {
+		"REQUEST_METHOD": scope["method"],
+		"SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+		"PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+		"QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+		"SERVER_NAME": server[0],
+		"SERVER_PORT": str(server[1]),
+		"SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+		"REMOTE_ADDR": client[0],
+		"REMOTE_PORT": str(client[1]),
+		"CONTENT_LENGTH": str(len(body)),
+		"wsgi.version": (1, 0),
+		"wsgi.url_scheme": scope.get("scheme", "http"),
+		"wsgi.input": io.BytesIO(body),
+		"wsgi.errors": sys.stderr,
+		"wsgi.multithread": True,
+		"wsgi.multiprocess": True,
+		"wsgi.run_once": False,
+		"asgi.scope": scope,
+	}
+	for name, value in scope.get("headers", []):
+		name = name.decode("latin-1")
+		value = value.decode("latin-1")
+		if name == "content-length":
+			continue
+		if name == "content-type":
+			environ["CONTENT_TYPE"] = value
+			continue
+		key = "HTTP_" + name.upper().replace("-", "_")
+		if key in environ:
+			separator = "; " if key == "HTTP_COOKIE" else ","
+			value = environ[key] + separator + value
+		environ[key] = value
+	return environ
+
+class ASGIApp(BaseApp):
+	"""
+	:param max_workers: Size of the thread pool sync controllers run in(defaults to the executor's default)
+	Serves the same map.json project as WSGIApp over ASGI. Controllers declared with
+	`async def` are awaited on the event loop, sync controllers run in the thread pool.
+	"""
+	def __init__(self, max_workers: Optional[int] = None, static: Optional[StaticFiles] = None, compression: Optional[Compression] = None, metrics: Optional[Metrics] = None, profiler: Optional[Profiler] = None,
+			lazy: bool = False, manifest: str = ".mercury_manifest.json", startup_report: bool = False, concurrency: Optional[Bulkhead] = None,
+			sql: Optional[SQLInstrumentation] = None):
+		super().__init__(static, compression, metrics, profiler, lazy, manifest, startup_report, concurrency, sql)
+		self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="mercury")
+
+	async def _read_body(self, receive: Callable) -> Optional[bytes]:
+		chunks = []
+		while True:
+			message = await receive()
+			if message["type"] == "http.disconnect":
+				return None
+			chunks.append(message.get("body", b""))
+			if not message.get("more_body"):
+				return b"".join(chunks)
+
+	def _call_wsgi(self, app: Callable, environ: dict) -> tuple:
+		captured = []
+		body = app(environ, lambda status, headers, exc_info=None: captured.extend((status, headers)))
+		return int(captured[0].split(" ", 1)[0]), captured[1], body
+
+	async def _run_sync(self, func: Callable, *args):
+		# run_in_executor doesn't carry context variables over, the request's database scope is one of them
+		context = contextvars.copy_context()
+		return await asyncio.get_running_loop().run_in_executor(self.executor, partial(context.run, func, *args))
+
+	async def _wait_for_disconnect(self, receive: Callable) -> None:
+		# The body has been read already, the next message can only be the disconnect
+		while (await receive())["type"] != "http.disconnect":
+			pass
+
+	async def _send_response(self, response: Response, environ: dict, send: Callable, receive: Callable) -> None:
+		if hasattr(response.response, "__aiter__"):
+			# werkzeug can't iterate async bodies, take the headers and stream it ourselves
+			headers = response.get_wsgi_headers(environ).to_wsgi_list()
+			app_iter = [] if environ["REQUEST_METHOD"] == "HEAD" else response.response
+			return await self._send(response.status_code, headers, app_iter, send, receive)
+		app_iter, status, headers = response.get_wsgi_response(environ)
+		await self._send(int(status.split(" ", 1)[0]), headers, app_iter, send, receive)
+
+	async def _stream(self, app_iter, send: Callable, receive: Callable) -> None:
+		# Stop pulling from the body as soon as the client goes away
+		disconnected = asyncio.ensure_future(self._wait_for_disconnect(receive))
+		try:
+			if hasattr(app_iter, "__aiter__"):
+				async for chunk in app_iter:
+					if disconnected.done():
+						return
+					await send({"type": "http.response.body", "body": chunk, "more_body": True})
+			else:
+				# Arbitrary iterables may block while producing a chunk, pull them from the pool
+				iterator = iter(app_iter)
+				sentinel = object()
+				while not disconnected.done():
+					chunk = await self._run_sync(next, iterator, sentinel)
+					if chunk is sentinel:
+						break
+					await send({"type": "http.response.body", "body": chunk, "more_body": True})
+		finally:
+			disconnected.cancel()
+			if hasattr(app_iter, "aclose"):
+				await app_iter.aclose()
+
+	async def _send(self, status: int, headers: list, app_iter: Iterable[bytes], send: Callable, receive: Callable) -> None:
+		await send({
+			"type": "http.response.start",
+			"status": status,
+			"headers": [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers],
+		})
+		try:
+			if isinstance(app_iter, (list, tuple)):
+				for chunk in app_iter:
+					await send({"type": "http.response.body", "body": chunk, "more_body": True})
+			else:
+				await self._stream(app_iter, send, receive)
+		finally:
+			if hasattr(app_iter, "close"):
+				app_iter.close()
+		await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+	async def asgi_handler(self, scope: dict, receive: Callable, send: Callable) -> None:
+		body = await self._read_body(receive)
+		if body is None:
+			return
+		environ = build_environ(scope, body)
+		if self.static and scope["path"].startswith(self.static.url_prefix):
+			status, headers, app_iter = await self._run_sync(self.static.resolve, environ)
+			return await self._send(status, headers, app_iter, send, receive)
+		if self.metrics and scope["path"] == self.metrics.path:
+			exposition = (await self._run_sync(self.metrics.exposition)).encode()
+			headers = [("Content-Type", "text/plain; version=0.0.4; charset=utf-8"), ("Content-Length", str(len(exposition)))]
+			return await self._send(200, headers, [exposition], send, receive)
+		if self.profiler and scope["path"] == self.profiler.admin_path:
+			status, headers, app_iter = await self._run_sync(self._call_wsgi, self.profiler.admin, environ)
+			return await self._send(status, headers, app_iter, send, receive)
+
+		start = time.perf_counter()
+		request = Request(environ)
+		method = request.method
+		path = request.path
+		result = self.router.match(path, method)
+		compiled = result.get("controller")
+		if not compiled:
+			response = Response(result.get("error"), status=result.get("status_code"), content_type='text/html')
+			if self.metrics:
+				route_metrics = self.metrics.unmatched
+				self.metrics.begin(route_metrics)
+				self.metrics.record(route_metrics, response.status_code, start, len(body), response.calculate_content_length() or 0)
+			return await self._send_response(response, environ, send, receive)
+
+		route_metrics = compiled.metrics
+		if route_metrics:
+			self.metrics.begin(route_metrics)
+		params = result.get("params")
+		# Queued requests wait on the event loop, waiting in the pool could starve the requests holding the slots
+		response, waited = await self.admit_async(compiled)
+		if waited is not None and route_metrics:
+			self.metrics.record_wait(route_metrics, waited, response is not None)
+		if response is not None:
+			if route_metrics:
+				self.metrics.record(route_metrics, response.status_code, start, len(body), response.calculate_content_length() or 0)
+			return await self._send_response(response, environ, send, receive)
+		db_scope = RequestScope(f"{method} {compiled.route.url}", compiled.use_primary or RequestScope.wrote_recently(request))
+		if self.sql:
+			self.sql.begin(db_scope)
+		try:
+			if compiled.is_async:
+				# Auth and validation run exactly as in WSGIApp, only the controller is awaited
+				response = compiled.run_stages(request, params)
+				if response is None:
+					response = compiled.finish(request, await compiled.controller(request, *params.values()))
+			elif self.profiler and self.profiler.enabled and self.profiler.should_profile(compiled.route.url, environ):
+				# Only sync controllers are profiled, cProfile can't follow a coroutine across awaits
+				response = await self._run_sync(self.profiler.run, compiled, request, params)
+			else:
+				response = await self._run_sync(compiled, request, params)
+			if self.compression and compiled.compress:
+				response = self.compression.apply(response, environ, compiled.compression_min_size)
+		except Exception:
+			if route_metrics:
+				self.metrics.record(route_metrics, 500, start, len(body), 0)
+			await self._end_scope(compiled, db_scope, True)
+			raise
+		except BaseException:
+			# Cancelled, e.g. the client went away, the scope can't be awaited anymore but the slots are freed
+			self.release(compiled)
+			raise
+		if route_metrics:
+			self.metrics.record(route_metrics, response.status_code, start, len(body), response.calculate_content_length() or 0)
+		if response.status_code < 400:
+			db_scope.remember_writes(response)
+		if self.sql:
+			self.sql.annotate(db_scope, response)
+		try:
+			await self._send_response(response, environ, send, receive)
+		finally:
+			# After the body was sent, a streamed body may read from the session until its last chunk
+			await self._end_scope(compiled, db_scope, response.status_code >= 400)
+
+	async def _end_scope(self, compiled, scope: RequestScope, error: bool) -> None:
+		try:
+			try:
+				await scope.close_async_sessions(error)
+			finally:
+				# Committing blocks, only go through the pool when the request opened a session
+				if scope.opened():
+					await self._run_sync(scope.close_sessions, error)
+		finally:
+			scope.reset()
+			# A streamed body holds the concurrency slots until its last chunk was sent
+			self.release(compiled)
+			self.record_sql(compiled, scope)
+
+	async def admit_async(self, compiled) -> Tuple[Optional[Response], Optional[float]]:
+		"""BaseApp.admit without blocking the event loop while a request is queued."""
+		route_limit = compiled.concurrency
+		if route_limit is None and self.concurrency is None:
+			return None, None
+		start = time.perf_counter()
+		if route_limit is not None and await route_limit.acquire_async() is None:
+			return route_limit.reject(), time.perf_counter() - start
+		if self.concurrency is not None and await self.concurrency.acquire_async() is None:
+			if route_limit is not None:
+				route_limit.release()
+			return self.concurrency.reject(), time.perf_counter() - start
+		return None, time.perf_counter() - start
+
+	async def lifespan(self, receive: Callable, send: Callable) -> None:
+		while True:
+			message = await receive()
+			if message["type"] == "lifespan.startup":
+				await send({"type": "lifespan.startup.complete"})
+			elif message["type"] == "lifespan.shutdown":
+				self.executor.shutdown(wait=True)
+				await send({"type": "lifespan.shutdown.complete"})
+				return
+
+	async def __call__(self, scope: dict, receive: Callable, send: Callable) -> None:
+		if scope["type"] == "http":
+			await self.asgi_handler(scope, receive, send)
+		elif scope["type"] == "lifespan":
+			await self.lifespan(receive, send)
+		else:
+			raise ValueError(f"Unsupported ASGI scope type '{scope['type']}'")
@@ -0,0 +1,185 @@
+from .db.query_cache import query_cache
+from sqlalchemy import insert
+from sqlalchemy.engine import Engine
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Union
+from datetime import date, datetime, time
+import json
+
+class ChunkResult:
+	"""The outcome of one chunk of a bulk insert or upsert, every chunk commits on its own."""
+	__slots__ = ("index", "start", "rows", "rowcount", "error")
+
+	def __init__(self, index: int, start: int, rows: int, rowcount: int = -1, error: Optional[str] = None) -> None:
+		self.index = index
+		self.start = start
+		self.rows = rows
+		# Rows the database reports as written, -1 when the driver doesn't tell(e.g. for executemany)
+		self.rowcount = rowcount
+		self.error = error
+
+	@property
+	def ok(self) -> bool:
+		return self.error is None
+
+	def to_dict(self) -> dict:
+		return {"index": self.index, "start": self.start, "rows": self.rows, "rowcount": self.rowcount, "error": self.error}
+
+	def __repr__(self):
+		return f"ChunkResult(index={self.index}, rows={self.rows}, rowcount={self.rowcount}, error={self.error!r})"
+
+# Json has no date types, iso strings are turned into the values these columns expect
+_PARSERS = {datetime: datetime.fromisoformat, date: date.fromisoformat, time: time.fromisoformat}
+
+def _converters(table) -> Dict[str, Callable[[Any], Any]]:
+	converters = {}
+	for column in table.columns:
+		try:
+			python_type = column.type.python_type
+		except NotImplementedError:
+			continue
+		if python_type in _PARSERS:
+			parse = _PARSERS[python_type]
+			converters[column.key] = lambda value, parse=parse: parse(value) if isinstance(value, str) else value
+	return converters
+
+class _RowValidator:
+	"""Checks the keys of every row shape once against the model's columns, and converts the values json can't carry."""
+	def __init__(self, model) -> None:
+		self.model = model
+		self.columns = frozenset(column.key for column in model.__table__.columns)
+		self.converters = _converters(model.__table__)
+		self._shapes = set()
+
+	def __call__(self, row: dict) -> dict:
+		if not isinstance(row, dict):
+			raise ValueError(f"Expected an object per row, got {type(row).__name__}")
+		shape = frozenset(row)
+		if shape not in self._shapes:
+			unknown = shape - self.columns
+			if unknown:
+				raise ValueError(f"{self.model.__name__} has no columns {sorted(unknown)}")
+			self._shapes.add(shape)
+		if self.converters:
+			row = dict(row)
+			for key, convert in self.converters.items():
+				if key in row:
+					row[key] = convert(row[key])
+		return row
+
+def _rows(data: Union[str, bytes, Iterable[dict]]) -> Iterable[dict]:
+	if isinstance(data, (str, bytes, bytearray)):
+		data = json.loads(data)
+		if not isinstance(data, list):
+			raise ValueError("Expected a json array of objects")
+	return data
+
+def _chunks(rows: Iterable[dict], chunk_size: int) -> Iterator[List[dict]]:
+	chunk = []
+	for row in rows:
+		chunk.append(row)
+		if len(chunk) >= chunk_size:
+			yield chunk
+			chunk = []
+	if chunk:
+		yield chunk
+
+def _by_shape(chunk: List[dict]) -> List[List[dict]]:
+	# executemany binds every row with the keys of the first one, rows leaving out columns go in their own batch
+	groups: Dict[frozenset, List[dict]] = {}
+	for row in chunk:
+		groups.setdefault(frozenset(row), []).append(row)
+	return list(groups.values())
+
+def _upsert_statement(engine: Engine, table, conflict: List[str], update: Optional[List[str]], shape: frozenset):
+	dialect = engine.dialect.name
+	if dialect == "sqlite":
+		from sqlalchemy.dialects.sqlite import insert as dialect_insert
+	elif dialect == "postgresql":
+		from sqlalchemy.dialects.postgresql import insert as dialect_insert
+	elif dialect == "mysql":
+		from sqlalchemy.dialects.mysql import insert as dialect_insert
+	else:
+		raise ValueError(f"Upserts aren't supported on {dialect}, only on sqlite, postgresql and mysql")
+	statement = dialect_insert(table)
+	columns = [key for key in (update if update is not None else sorted(shape)) if key in shape and key not in conflict]
+	if dialect == "mysql":
+		# MySQL resolves the conflict on whichever unique key collided
+		if not columns:
+			columns = conflict[:1]
+		return statement.on_duplicate_key_update({key: statement.inserted[key] for key in columns})
+	if not columns:
+		return statement.on_conflict_do_nothing(index_elements=conflict)
+	return statement.on_conflict_do_update(index_elements=conflict, set_={key: statement.excluded[key] for key in columns})
+
+def _write(engine: Engine, model, data, chunk_size: int, method: str, on_error: str, statement_for: Callable[[frozenset], Any]) -> List[ChunkResult]:
+	if method not in ("executemany", "values"):
+		raise ValueError("method must be 'executemany' or 'values'")
+	if on_error not in ("raise", "continue"):
+		raise ValueError("on_error must be 'raise' or 'continue'")
+	validate = _RowValidator(model)
+	statements = {}
+	results = []
+	start = 0
+	try:
+		for index, chunk in enumerate(_chunks(_rows(data), chunk_size)):
+			result = ChunkResult(index, start, len(chunk))
+			start += len(chunk)
+			results.append(result)
+			try:
+				chunk = [validate(row) for row in chunk]
+				rowcount = 0
+				# One transaction per chunk, a failing chunk doesn't undo the ones before it
+				with engine.begin() as connection:
+					for rows in _by_shape(chunk):
+						shape = frozenset(rows[0])
+						statement = statements.get(shape)
+						if statement is None:
+							statement = statements[shape] = statement_for(shape)
+						if method == "values":
+							cursor = connection.execute(statement.values(rows))
+						else:
+							cursor = connection.execute(statement, rows)
+						rowcount = -1 if cursor.rowcount < 0 or rowcount < 0 else rowcount + cursor.rowcount
+				result.rowcount = rowcount
+				# The rows were written beside the ORM session, cached lookups of the model are outdated as soon as
+				# the chunk committed, not only once the whole import is done
+				if query_cache.is_cached(model):
+					query_cache.invalidate(model)
+			except Exception as e:
+				result.error = str(e)
+				if on_error == "raise":
+					raise
+	except BaseException:
+		# Committed chunks invalidated already, a chunk interrupted part way(e.g. by KeyboardInterrupt) may have written too
+		if results and query_cache.is_cached(model):
+			query_cache.invalidate(model)
+		raise
+	return results
+
+def insert_rows(engine: Engine, model, data: Union[str, bytes, Iterable[dict]], chunk_size: int = 1000, method: str = "executemany",
+		on_error: str = "raise") -> List[ChunkResult]:
+	"""
+	:param engine: The engine written to, e.g. get_connection().Engine
+	:param model: The model whose table the rows go into
+	:param data: A list(or any iterable, e.g. a generator reading a file) of dicts keyed by column, or a json array of objects
+	:param chunk_size: Rows per statement and transaction
+	:param method: "executemany" binds the chunk's rows to one insert, "values" renders them into a single multi-row INSERT ... VALUES
+	  (mind the database's limit on bound parameters, e.g. 32766 on sqlite)
+	:param on_error: "raise" stops at the first failing chunk, "continue" records the error and goes on with the next chunk
+	Inserts rows through Core instead of building an ORM object per row. The keys of every row shape are checked against
+	the model's columns once, iso strings are parsed for date and time columns. Returns a ChunkResult per chunk.
+	"""
+	table = model.__table__
+	return _write(engine, model, data, chunk_size, method, on_error, lambda shape: insert(table))
+
+def upsert_rows(engine: Engine, model, data: Union[str, bytes, Iterable[dict]], conflict: Optional[List[str]] = None,
+		update: Optional[List[str]] = None, chunk_size: int = 1000, method: str = "executemany", on_error: str = "raise") -> List[ChunkResult]:
+	"""
+	:param conflict: Columns of the unique constraint rows collide on(defaults to the primary key)
+	:param update: Columns overwritten when a row exists(defaults to every column given but the conflict ones, [] skips existing rows)
+	insert_rows that updates the rows which already exist, with INSERT ... ON CONFLICT on sqlite and postgresql
+	and ON DUPLICATE KEY UPDATE on mysql. The other parameters are the ones of insert_rows.
+	"""
+	table = model.__table__
+	conflict = conflict or [column.key for column in table.primary_key.columns]
+	return _write(engine, model, data, chunk_size, method, on_error, lambda shape: _upsert_statement(engine, table, conflict, update, shape))
@@ -0,0 +1,185 @@
+from libmercury.security.jwt import JWT
+from werkzeug import Request, Response
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, List, Optional
+import threading
+import time
+
+class CacheBackend(ABC):
+	"""Storage used by the response cache, subclass it to share cached responses between processes(e.g. redis)."""
+	@abstractmethod
+	def get(self, key: str) -> Optional[Any]:
+		...
+
+	@abstractmethod
+	def set(self, key: str, value: Any, ttl: float) -> None:
+		...
+
+	@abstractmethod
+	def delete(self, key: str) -> None:
+		...
+
+	@abstractmethod
+	def delete_prefix(self, prefix: str) -> None:
+		...
+
+	@abstractmethod
+	def clear(self) -> None:
+		...
+
+class LRUCache(CacheBackend):
+	"""A bounded in-process backend, least recently used entries are evicted first."""
+	def __init__(self, max_entries: int = 1024) -> None:
+		self.max_entries = max_entries
+		self._entries = OrderedDict()
+		self._lock = threading.Lock()
+
+	def get(self, key: str) -> Optional[Any]:
+		with self._lock:
+			entry = self._entries.get(key)
+			if entry is None:
+				return None
+			expires, value = entry
+			if expires < time.monotonic():
+				del self._entries[key]
+				return None
+			self._entries.move_to_end(key)
+			return value
+
+	def set(self, key: str, value: Any, ttl: float) -> None:
+		with self._lock:
+			self._entries[key] = (time.monotonic() + ttl, value)
+			self._entries.move_to_end(key)
+			while len(self._entries) > self.max_entries:
+				self._entries.popitem(last=False)
+
+	def delete(self, key: str) -> None:
+		with self._lock:
+			self._entries.pop(key, None)
+
+	def delete_prefix(self, prefix: str) -> None:
+		with self._lock:
+			for key in [key for key in self._entries if key.startswith(prefix)]:
+				del self._entries[key]
+
+	def clear(self) -> None:
+		with self._lock:
+			self._entries.clear()
+
+# Separates the parts of a cache key, it can't appear in a url or a header value
+_SEP = "\x1f"
+
+def _route_prefix(method: str, url: str) -> str:
+	return f"{method} {url}{_SEP}"
+
+def _params_key(params: dict) -> str:
+	return "&".join(f"{name}={params[name]}" for name in sorted(params))
+
+def _subject(request: Request) -> Optional[str]:
+	# Set by the route's auth stage once the token's signature was checked, an unverified token names no subject
+	token = request.environ.get("mercury.verified_token")
+	if not token:
+		return None
+	try:
+		return JWT(token).payload.get("sub")
+	except ValueError:
+		return None
+
+class RouteCache:
+	"""The cache of a single route, created for routes decorated with useCache."""
+	def __init__(self, cache: "ResponseCache", method: str, url: str, ttl: float, vary: List[str], subject: bool, backend: Optional[CacheBackend]) -> None:
+		self.cache = cache
+		self.prefix = _route_prefix(method, url)
+		self.ttl = ttl
+		self.vary = tuple(vary)
+		self.subject = subject
+		self.backend = backend or cache.backend
+		self.hits = 0
+		self.misses = 0
+
+	def key(self, request: Request, params: dict) -> Optional[str]:
+		"""The cache key of the request, None when a per-subject route has no verified subject to key it by."""
+		key = self.prefix + _params_key(params) + _SEP
+		if self.vary:
+			args = request.args
+			key += "&".join(f"{name}={args.get(name, '')}" for name in self.vary)
+		if self.subject:
+			subject = _subject(request)
+			if subject is None:
+				return None
+			key += f"{_SEP}{subject}"
+		return key
+
+	def lookup(self, request: Request, params: dict) -> Optional[Response]:
+		key = self.key(request, params)
+		if key is None:
+			return None
+		entry = self.backend.get(key)
+		if entry is None:
+			self.misses += 1
+			# Remember the key so store() doesn't have to build it again
+			request.environ["mercury.cache_key"] = key
+			return None
+		self.hits += 1
+		status, headers, body = entry
+		return Response(body, status=status, headers=headers)
+
+	def store(self, request: Request, response: Response) -> None:
+		key = request.environ.get("mercury.cache_key")
+		if key is None or response.status_code != 200 or response.is_streamed or "Set-Cookie" in response.headers:
+			return
+		self.backend.set(key, (response.status_code, list(response.headers.items()), response.get_data()), self.ttl)
+
+class ResponseCache:
+	"""Keeps track of the cached routes, their hit/miss counters and the invalidation hooks."""
+	def __init__(self, backend: Optional[CacheBackend] = None) -> None:
+		self.backend = backend or LRUCache()
+		self.routes = {}
+
+	def route(self, method: str, url: str, handler) -> RouteCache:
+		if handler._cache_subject and (not hasattr(handler, "_auth") or handler._negative_auth):
+			# Without a verified token anyone could claim another client's subject and get its cached responses
+			raise ValueError(f"useCache(subject=True) on {method} {url} needs useAuthorization, the subject comes from the verified token")
+		route_cache = RouteCache(
+			self, method, url,
+			handler._cache_ttl,
+			handler._cache_vary or [],
+			handler._cache_subject,
+			handler._cache_backend,
+		)
+		self.routes[(method, url)] = route_cache
+		return route_cache
+
+	def invalidate(self, url: str, method: str = "GET", **params) -> None:
+		"""
+		:param url: The route template, e.g. '/users/{id:int}'
+		:param params: Path params narrowing the invalidation to a single resource, all of them must be given
+		Drops cached responses of a route, for every query string and subject.
+		"""
+		prefix = _route_prefix(method, url)
+		if params:
+			prefix += _params_key(params) + _SEP
+		route_cache = self.routes.get((method, url))
+		backend = route_cache.backend if route_cache else self.backend
+		backend.delete_prefix(prefix)
+
+	def clear(self) -> None:
+		self.backend.clear()
+		for route_cache in self.routes.values():
+			if route_cache.backend is not self.backend:
+				route_cache.backend.clear()
+
+	def stats(self) -> dict:
+		routes = {
+			f"{method} {url}": {"hits": route_cache.hits, "misses": route_cache.misses}
+			for (method, url), route_cache in self.routes.items()
+		}
+		hits = sum(route["hits"] for route in routes.values())
+		misses = sum(route["misses"] for route in routes.values())
+		return {"hits": hits, "misses": misses, "routes": routes}
+
+response_cache = ResponseCache()
+
+def invalidate(url: str, method: str = "GET", **params) -> None:
+	response_cache.invalidate(url, method, **params)
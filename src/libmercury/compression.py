@@ -0,0 +1,106 @@
+from werkzeug.http import parse_accept_header
+from werkzeug import Response
+from typing import AsyncIterable, AsyncIterator, Iterable, Optional
+import zlib
+
+# zlib window bits selecting the container each content coding uses
+_WBITS = {"gzip": 31, "deflate": 15}
+
+def _compress_stream(body: Iterable, compressor) -> Iterable[bytes]:
+	try:
+		for chunk in body:
+			if isinstance(chunk, str):
+				chunk = chunk.encode()
+			# Flush on every chunk so streamed bodies reach the client as they are produced
+			data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+			if data:
+				yield data
+		yield compressor.flush()
+	finally:
+		if hasattr(body, "close"):
+			body.close()
+
+async def _compress_async_stream(body: AsyncIterable, compressor) -> AsyncIterator[bytes]:
+	try:
+		async for chunk in body:
+			if isinstance(chunk, str):
+				chunk = chunk.encode()
+			data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+			if data:
+				yield data
+		yield compressor.flush()
+	finally:
+		if hasattr(body, "aclose"):
+			await body.aclose()
+
+class Compression:
+	"""
+	:param min_size: Buffered bodies smaller than this are sent uncompressed
+	:param level: zlib compression level
+	:param mimetypes: Compressible content types besides text/*
+	:param encodings: Supported content codings, in order of preference
+	Negotiates gzip/deflate from Accept-Encoding and compresses controller responses,
+	streamed bodies are compressed chunk by chunk instead of being buffered.
+	"""
+	def __init__(self, min_size: int = 1024, level: int = 6, mimetypes: Optional[Iterable[str]] = None, encodings: Iterable[str] = ("gzip", "deflate")) -> None:
+		self.min_size = min_size
+		self.level = level
+		self.mimetypes = frozenset(mimetypes if mimetypes is not None else (
+			"application/json",
+			"application/javascript",
+			"application/xml",
+			"application/x-ndjson",
+			"image/svg+xml",
+		))
+		self.encodings = tuple(encodings)
+
+	def negotiate(self, environ: dict) -> Optional[str]:
+		header = environ.get("HTTP_ACCEPT_ENCODING")
+		if not header:
+			return None
+		accept = parse_accept_header(header)
+		best, best_quality = None, 0
+		for encoding in self.encodings:
+			quality = accept.quality(encoding)
+			if quality > best_quality:
+				best, best_quality = encoding, quality
+		return best
+
+	def _compressible(self, response: Response) -> bool:
+		if response.status_code < 200 or response.status_code in (204, 206, 304):
+			return False
+		if response.direct_passthrough or "Content-Encoding" in response.headers:
+			return False
+		mimetype = response.mimetype or ""
+		if mimetype == "text/event-stream":
+			return False
+		return mimetype.startswith("text/") or mimetype in self.mimetypes
+
+	def apply(self, response: Response, environ: dict, min_size: Optional[int] = None) -> Response:
+		if not self._compressible(response):
+			return response
+		streamed = response.is_streamed
+		if not streamed and response.calculate_content_length() < (self.min_size if min_size is None else min_size):
+			return response
+
+		response.vary.add("Accept-Encoding")
+		encoding = self.negotiate(environ)
+		if encoding is None:
+			return response
+
+		compressor = zlib.compressobj(self.level, zlib.DEFLATED, _WBITS[encoding])
+		if hasattr(response.response, "__aiter__"):
+			response.response = _compress_async_stream(response.response, compressor)
+			response.headers.pop("Content-Length", None)
+		elif streamed:
+			response.response = _compress_stream(response.response, compressor)
+			response.headers.pop("Content-Length", None)
+		else:
+			response.set_data(compressor.compress(response.get_data()) + compressor.flush())
+		response.headers["Content-Encoding"] = encoding
+
+		# The compressed body is no longer byte-identical to the one the strong ETag named
+		etag, weak = response.get_etag()
+		if etag and not weak:
+			response.set_etag(etag, weak=True)
+		return response
@@ -1,6 +1,9 @@
 from colorama import Fore, Style
-from sqlalchemy import Column, create_engine, MetaData, Table
-from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy import Column, create_engine, event, ForeignKeyConstraint, Index, MetaData, Table, text, UniqueConstraint
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import NoSuchColumnError, NoSuchTableError
+from contextlib import contextmanager
+from typing import Dict, List, Optional
 import importlib.util
 import os
 import inspect
@@ -272,10 +275,241 @@ class MigrationSystem:
 	
 		return discrepancies, autogenerate_table
 
+# Dialects whose DDL runs inside a transaction, a failed migration leaves their schema as it was
+TRANSACTIONAL_DDL = ("sqlite", "postgresql")
+
+def _engine(connection_string):
+	engine = create_engine(connection_string)
+	if engine.dialect.name == "sqlite":
+		# pysqlite only opens a transaction before DML and commits before DDL, let SQLAlchemy's BEGIN span both
+		@event.listens_for(engine, "connect")
+		def _connect(dbapi_connection, connection_record):
+			dbapi_connection.isolation_level = None
+
+		@event.listens_for(engine, "begin")
+		def _begin(connection):
+			connection.exec_driver_sql("BEGIN")
+	return engine
+
+def _url(connection_string) -> str:
+	return make_url(connection_string).render_as_string(hide_password=False)
+
+class _Batch:
+	"""The ALTERs of one sqlite table waiting to be applied together."""
+	def __init__(self) -> None:
+		self.added = []
+		self.dropped = []
+		# (old column name, new Column)
+		self.modified = []
+
+	def rebuilds(self) -> bool:
+		# sqlite adds a column in place, anything else means copying the table
+		return bool(self.dropped or self.modified)
+
+class Migration:
+	"""
+	:param connection_string: The database the migration runs on
+	One migration file: the MigrationWrappers created while it's active share its connection, its transaction and
+	its schema, reflected once and kept up to date by the operations. On sqlite the ALTERs of a table are batched,
+	a table dropping or changing columns is copied into its new shape once, whatever the number of changes.
+	The file commits when the block ends without an error and rolls back otherwise, on dialects without
+	transactional DDL(e.g. mysql) the statements that ran before the error stay applied.
+	What the operations did is only printed once it committed(or ran, without transactional DDL).
+	"""
+	active: Optional["Migration"] = None
+
+	def __init__(self, connection_string) -> None:
+		self.url = _url(connection_string)
+		self.engine = _engine(connection_string)
+		self.dialect = self.engine.dialect.name
+		self.transactional = self.dialect in TRANSACTIONAL_DDL
+		self.connection = None
+		self._transaction = None
+		self._metadata = None
+		self._batches: Dict[str, _Batch] = {}
+		self._reports: List[str] = []
+		self._outer = None
+
+	def __enter__(self) -> "Migration":
+		self.connection = self.engine.connect()
+		self._transaction = self.connection.begin()
+		self._outer = Migration.active
+		Migration.active = self
+		return self
+
+	def __exit__(self, exc_type, exc, traceback) -> None:
+		Migration.active = self._outer
+		self._outer = None
+		try:
+			if exc_type is None:
+				try:
+					self.flush()
+				except BaseException:
+					self._rollback()
+					raise
+				self._transaction.commit()
+				for message in self._reports:
+					print(f"{Fore.GREEN}[Migrator]{Style.RESET_ALL} {message}")
+			else:
+				self._rollback()
+		finally:
+			self.connection.close()
+			self.connection = None
+			self._transaction = None
+			self._reports.clear()
+			self.engine.dispose()
+
+	def _rollback(self) -> None:
+		self._transaction.rollback()
+		# The reflected schema has the changes that were rolled back
+		self._metadata = None
+		self._batches.clear()
+
+	def report(self, message: str) -> None:
+		"""Prints what an operation did once the migration committed, right away when its statements can't be rolled back."""
+		if self.transactional:
+			self._reports.append(message)
+		else:
+			print(f"{Fore.GREEN}[Migrator]{Style.RESET_ALL} {message}")
+
+	@property
+	def metadata(self) -> MetaData:
+		if self._metadata is None:
+			self._metadata = MetaData()
+			self._metadata.reflect(bind=self.connection)
+		return self._metadata
+
+	def table(self, table_name: str) -> Table:
+		table = self.metadata.tables.get(table_name)
+		if table is None:
+			raise NoSuchTableError(table_name)
+		return table
+
+	def execute(self, statement: str, parameters: Optional[dict] = None) -> None:
+		self.connection.execute(text(statement), parameters or {})
+
+	def quote(self, name: str) -> str:
+		return self.engine.dialect.identifier_preparer.quote(name)
+
+	def batch(self, table_name: str) -> _Batch:
+		self.table(table_name)
+		batch = self._batches.get(table_name)
+		if batch is None:
+			batch = self._batches[table_name] = _Batch()
+		return batch
+
+	def flush(self, table_name: Optional[str] = None) -> None:
+		"""Applies the batched ALTERs of a table, or of every table."""
+		names = [table_name] if table_name is not None else list(self._batches)
+		for name in names:
+			batch = self._batches.pop(name, None)
+			if batch is None:
+				continue
+			if not batch.rebuilds():
+				table = self.table(name)
+				for column in batch.added:
+					self._add_column(name, column)
+					table.append_column(column)
+				continue
+			self._rebuild(name, batch)
+			# Reflecting the one table is all it takes to know its new shape
+			self.metadata.remove(self.metadata.tables[name])
+			Table(name, self.metadata, autoload_with=self.connection)
+
+	def _add_column(self, table_name: str, column: Column) -> None:
+		self.execute(f"ALTER TABLE {self.quote(table_name)} ADD COLUMN {_column_sql(column, self.engine.dialect)}")
+
+	def _rebuild(self, table_name: str, batch: _Batch) -> None:
+		# sqlite's copy and swap: create the table in its new shape, copy the rows, drop the old one and take its name
+		table = self.table(table_name)
+		dropped = set(batch.dropped)
+		modified = dict(batch.modified)
+		columns = []
+		# (new column name, column name in the old table)
+		copied = []
+		for column in table.columns:
+			if column.name in dropped:
+				continue
+			new_column = modified.pop(column.name, None)
+			if new_column is None:
+				new_column = column._copy()
+			columns.append(new_column)
+			copied.append((new_column.name, column.name))
+		missing = dropped.union(modified) - set(table.columns.keys())
+		if missing:
+			raise NoSuchColumnError(f"Table '{table_name}' has no columns {sorted(missing)}")
+		columns.extend(batch.added)
+		renamed = {old: new for new, old in copied}
+		constraints = []
+		for constraint in table.constraints:
+			if not all(column.name in renamed for column in constraint.columns):
+				continue
+			names = [renamed[column.name] for column in constraint.columns]
+			if isinstance(constraint, UniqueConstraint):
+				constraints.append(UniqueConstraint(*names, name=constraint.name))
+			elif isinstance(constraint, ForeignKeyConstraint):
+				constraints.append(ForeignKeyConstraint(names, [element.target_fullname for element in constraint.elements],
+					name=constraint.name, ondelete=constraint.ondelete, onupdate=constraint.onupdate))
+		temporary = Table(f"_mercury_batch_{table_name}", self.metadata, *columns, *constraints)
+		try:
+			temporary.create(self.connection)
+			new_names = ", ".join(self.quote(new) for new, _ in copied)
+			old_names = ", ".join(self.quote(old) for _, old in copied)
+			self.execute(f"INSERT INTO {self.quote(temporary.name)} ({new_names}) SELECT {old_names} FROM {self.quote(table_name)}")
+			indexes = list(table.indexes)
+			self.execute(f"DROP TABLE {self.quote(table_name)}")
+			for index in indexes:
+				# Indexes go with the table they're on when it's renamed
+				if all(column.name in renamed for column in index.columns):
+					Index(index.name, *[temporary.c[renamed[column.name]] for column in index.columns], unique=index.unique).create(self.connection)
+				else:
+					print(f"{Fore.YELLOW}[WARNING] Index '{index.name}' of '{table_name}' was dropped with its columns{Style.RESET_ALL}")
+			self.execute(f"ALTER TABLE {self.quote(temporary.name)} RENAME TO {self.quote(table_name)}")
+		finally:
+			self.metadata.remove(temporary)
+		self.report(f"Table '{table_name}' rebuilt with {len(batch.added) + len(batch.dropped) + len(batch.modified)} column changes.")
+
+	def record_version(self, version: int) -> None:
+		"""Stores the migration version in the transaction of the migration, it's only recorded if the migration commits."""
+		self.execute("UPDATE mercury_version SET version = :version", {"version": version})
+
+def _column_sql(column: Column, dialect) -> str:
+	column_sql = f"{dialect.identifier_preparer.quote(column.name)} {column.type.compile(dialect)}"
+	if not column.nullable:
+		column_sql += " NOT NULL"
+	else:
+		column_sql += " NULL"
+	if column.default is not None:
+		# Extract the default value, accounting for SQL expressions or callable defaults
+		if callable(column.default.arg):
+			default_value = column.default.arg()
+		else:
+			default_value = column.default.arg
+		column_sql += f" DEFAULT {default_value}"
+	return column_sql
+
 class MigrationWrapper:
+	"""
+	The operations of a migration's upgrade() and downgrade(). Created while `mercury migrate` runs the file,
+	it joins the file's Migration, otherwise every operation commits on its own.
+	"""
 	def __init__(self, connection_string: str) -> None:
-		self.engine = create_engine(connection_string)
-		self.metadata = MetaData(bind=self.engine)
+		active = Migration.active
+		self.migration = active if active is not None and active.url == _url(connection_string) else Migration(connection_string)
+		self.engine = self.migration.engine
+
+	@contextmanager
+	def _operation(self):
+		if self.migration.connection is not None:
+			yield self.migration
+			return
+		with self.migration:
+			yield self.migration
+
+	@property
+	def metadata(self) -> MetaData:
+		with self._operation() as migration:
+			return migration.metadata
 
 	def create_table(self, table_name: str, columns: list) -> None:
 		"""
@@ -284,13 +518,15 @@ class MigrationWrapper:
 		:param table_name: Name of the table to create
 		:param columns: List of Column definitions
 		"""
-		self.metadata.reflect(bind=self.engine)
-		try:
-			table = Table(table_name, self.metadata, *columns)
-			table.create(self.engine)
-			print(f"{Fore.GREEN}[Migrator]{Style.RESET_ALL} Table '{table_name}' created successfully.")
-		except SQLAlchemyError as e:
-			print(f"{Fore.GREEN}[Migrator]{Style.RESET_ALL} Error creating table: {e}")
+		with self._operation() as migration:
+			# The tables its foreign keys point to are in the reflected schema already
+			table = Table(table_name, migration.metadata, *columns)
+			try:
+				table.create(migration.connection)
+			except BaseException:
+				migration.metadata.remove(table)
+				raise
+			migration.report(f"Table '{table_name}' created successfully.")
 
 	def delete_table(self, table_name: str) -> None:
 		"""
@@ -298,12 +534,12 @@ class MigrationWrapper:
 		
 		:param table_name: Name of the table to delete
 		"""
-		try:
-			table = Table(table_name, self.metadata, autoload_with=self.engine)
-			table.drop(self.engine)
-			print(f"{Fore.GREEN}[Migrator]{Style.RESET_ALL} Table '{table_name}' deleted successfully.")
-		except SQLAlchemyError as e:
-			print(f"{Fore.GREEN}[Migrator]{Style.RESET_ALL} Error deleting table: {e}")
+		with self._operation() as migration:
+			migration.flush(table_name)
+			table = migration.table(table_name)
+			table.drop(migration.connection)
+			migration.metadata.remove(table)
+			migration.report(f"Table '{table_name}' deleted successfully.")
 
 	def add_column(self, table_name: str, column: Column) -> None:
 		"""
@@ -312,29 +548,13 @@ class MigrationWrapper:
 		:param table_name: Name of the table
 		:param column: Column definition
 		"""
-		try:
-			table = Table(table_name, self.metadata, autoload_with=self.engine)
-			with self.engine.connect() as conn:
-				# Manually construct the column definition with type, nullable, and default value
-				column_sql = f"{column.name} {column.type.compile(self.engine.dialect)}"
-			
-				if not column.nullable:
-					column_sql += " NOT NULL"
-				else:
-					column_sql += " NULL"
-			
-				if column.default is not None:
-					# Extract the default value, accounting for SQL expressions or callable defaults
-					if callable(column.default.arg):
-						default_value = column.default.arg()
-					else:
-						default_value = column.default.arg
-					column_sql += f" DEFAULT {default_value}"
-			
-				conn.execute(f'ALTER TABLE {table_name} ADD COLUMN {column_sql}')
-			print(f"{Fore.GREEN}[Migrator]{Style.RESET_ALL} Column '{column.name}' added to table '{table_name}'.")
-		except SQLAlchemyError as e:
-			print(f"{Fore.GREEN}[Migrator]{Style.RESET_ALL} Error adding column: {e}")
+		with self._operation() as migration:
+			if migration.dialect == "sqlite":
+				migration.batch(table_name).added.append(column)
+			else:
+				migration._add_column(table_name, column)
+				migration.table(table_name).append_column(column)
+			migration.report(f"Column '{column.name}' added to table '{table_name}'.")
 
 	def drop_column(self, table_name: str, column_name: str) -> None:
 		"""
@@ -343,13 +563,14 @@ class MigrationWrapper:
 		:param table_name: Name of the table
 		:param column_name: Name of the column to drop
 		"""
-		try:
-			table = Table(table_name, self.metadata, autoload_with=self.engine)
-			with self.engine.connect() as conn:
-				conn.execute(f'ALTER TABLE {table_name} DROP COLUMN {column_name}')
-			print(f"{Fore.GREEN}[Migrator]{Style.RESET_ALL} Column '{column_name}' dropped from table '{table_name}'.")
-		except SQLAlchemyError as e:
-			print(f"{Fore.GREEN}[Migrator]{Style.RESET_ALL} Error dropping column: {e}")
+		with self._operation() as migration:
+			if migration.dialect == "sqlite":
+				migration.batch(table_name).dropped.append(column_name)
+			else:
+				migration.execute(f"ALTER TABLE {migration.quote(table_name)} DROP COLUMN {migration.quote(column_name)}")
+				migration.metadata.remove(migration.table(table_name))
+				Table(table_name, migration.metadata, autoload_with=migration.connection)
+			migration.report(f"Column '{column_name}' dropped from table '{table_name}'.")
 
 	def modify_column(self, table_name: str, old_column_name: str, new_column: Column) -> None:
 		"""
@@ -359,14 +580,54 @@ class MigrationWrapper:
 		:param old_column_name: Name of the column to modify
 		:param new_column: New Column definition
 		"""
-		try:
-			table = Table(table_name, self.metadata, autoload_with=self.engine)
-			with self.engine.connect() as conn:
-				conn.execute(f'ALTER TABLE {table_name} RENAME COLUMN {old_column_name} TO temp_{old_column_name}')
-				conn.execute(f'ALTER TABLE {table_name} ADD COLUMN {new_column.compile(conn.dialect)}')
-				conn.execute(f'UPDATE {table_name} SET {new_column.name} = temp_{old_column_name}')
-				conn.execute(f'ALTER TABLE {table_name} DROP COLUMN temp_{old_column_name}')
-			print(f"{Fore.GREEN}[Migrator]{Style.RESET_ALL} Column '{old_column_name}' modified to '{new_column.name}' in table '{table_name}'.")
-		except SQLAlchemyError as e:
-			print(f"{Fore.GREEN}[Migrator]{Style.RESET_ALL} Error modifying column: {e}")
+		with self._operation() as migration:
+			if migration.dialect == "sqlite":
+				migration.batch(table_name).modified.append((old_column_name, new_column))
+			else:
+				table = migration.quote(table_name)
+				old = migration.quote(old_column_name)
+				temporary = migration.quote(f"temp_{old_column_name}")
+				migration.execute(f"ALTER TABLE {table} RENAME COLUMN {old} TO {temporary}")
+				migration.execute(f"ALTER TABLE {table} ADD COLUMN {_column_sql(new_column, migration.engine.dialect)}")
+				migration.execute(f"UPDATE {table} SET {migration.quote(new_column.name)} = {temporary}")
+				migration.execute(f"ALTER TABLE {table} DROP COLUMN {temporary}")
+				migration.metadata.remove(migration.table(table_name))
+				Table(table_name, migration.metadata, autoload_with=migration.connection)
+			migration.report(f"Column '{old_column_name}' modified to '{new_column.name}' in table '{table_name}'.")
 
+	def create_index(self, index_name: str, table_name: str, columns: list, unique: bool = False) -> None:
+		"""
+		Create an index on columns of an existing table.
+
+		:param index_name: Name of the index
+		:param table_name: Name of the table
+		:param columns: Names of the indexed columns, in order
+		:param unique: Whether the index enforces unique values
+		"""
+		with self._operation() as migration:
+			migration.flush(table_name)
+			table = migration.table(table_name)
+			index = Index(index_name, *[table.c[column] for column in columns], unique=unique)
+			try:
+				index.create(migration.connection)
+			except BaseException:
+				table.indexes.discard(index)
+				raise
+			migration.report(f"Index '{index_name}' created on table '{table_name}'.")
+
+	def drop_index(self, index_name: str, table_name: str) -> None:
+		"""
+		Drop an index of a table.
+
+		:param index_name: Name of the index
+		:param table_name: Name of the table
+		"""
+		with self._operation() as migration:
+			migration.flush(table_name)
+			table = migration.table(table_name)
+			index = next((index for index in table.indexes if index.name == index_name), None)
+			if index is None:
+				index = Index(index_name, _table=table)
+			index.drop(migration.connection)
+			table.indexes.discard(index)
+			migration.report(f"Index '{index_name}' dropped from table '{table_name}'.")
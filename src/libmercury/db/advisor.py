@@ -0,0 +1,304 @@
+from sqlalchemy import inspect
+from .instrumentation import statement_shape
+from typing import Any, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+import json
+import re
+
+# Statements EXPLAIN can plan without running them
+_EXPLAINABLE = ("select", "with", "update", "delete")
+_IDENTIFIER = r'[`"\[]?(\w+)[`"\]]?'
+_FROM = re.compile(rf"\b(?:from|join|update)\s+(?:\w+\.)?{_IDENTIFIER}(?:\s+(?:as\s+)?{_IDENTIFIER})?", re.IGNORECASE)
+_REFERENCE = re.compile(rf"(?:{_IDENTIFIER}\.)?{_IDENTIFIER}")
+_OPERATOR = re.compile(r"\s*(=|==|!=|<>|<=|>=|<|>|\bin\b|\bis\b|\blike\b|\bbetween\b)", re.IGNORECASE)
+_ORDERING = re.compile(r"\b(?:order|group)\s+by\s+(.+?)(?=\blimit\b|\boffset\b|\bfor\s+update\b|\bhaving\b|\border\s+by\b|\)|$)", re.IGNORECASE | re.DOTALL)
+_PREDICATES = re.compile(r"\b(?:where|on|having)\b(.+?)(?=\bgroup\s+by\b|\border\s+by\b|\blimit\b|\bjoin\b|\bunion\b|$)", re.IGNORECASE | re.DOTALL)
+_KEYWORDS = frozenset(("where", "on", "join", "left", "right", "inner", "outer", "cross", "full", "natural", "group", "order", "limit", "offset", "set", "using", "union", "having", "for", "as"))
+
+class Finding(NamedTuple):
+	"""A step of a plan an index could avoid, table is the name or alias the plan gives."""
+	kind: str
+	table: str
+
+class IndexSuggestion:
+	"""An index on a model's table, with the plan steps and statements it would help."""
+	def __init__(self, table: str, columns: Tuple[str, ...]) -> None:
+		self.table = table
+		self.columns = columns
+		self.reasons = set()
+		self.statements: List[str] = []
+
+	@property
+	def name(self) -> str:
+		return f"ix_{self.table}_{'_'.join(self.columns)}"[:63]
+
+	def migration(self) -> str:
+		"""The line creating the index in a migration's upgrade()."""
+		return f"wrapper.create_index('{self.name}', '{self.table}', {list(self.columns)!r})"
+
+	def downgrade(self) -> str:
+		return f"wrapper.drop_index('{self.name}', '{self.table}')"
+
+	def __repr__(self):
+		return f"IndexSuggestion(table='{self.table}', columns={self.columns}, statements={len(self.statements)})"
+
+def read_statements(path: str) -> Iterator[Tuple[str, Any]]:
+	"""
+	Yields (statement, parameters) from a file: the json lines written by SQLInstrumentation(capture=...),
+	or plain sql separated by semicolons(a dump of a query log), whose statements run without parameters.
+	"""
+	with open(path) as f:
+		text = f.read()
+	if text.lstrip().startswith("{"):
+		for line in text.splitlines():
+			line = line.strip()
+			if line:
+				entry = json.loads(line)
+				yield entry["statement"], entry.get("parameters")
+		return
+	text = "\n".join(line for line in text.splitlines() if not line.lstrip().startswith("--"))
+	for statement in text.split(";"):
+		statement = statement.strip()
+		if statement:
+			yield statement, None
+
+def _placeholders(statement: str, dialect: str):
+	# Statements of a log carry no values, the plan of a filter doesn't depend on them on sqlite
+	if dialect == "sqlite":
+		names = re.findall(r"(?<!:):(\w+)", statement)
+		return {name: None for name in names} if names else (None,) * statement.count("?")
+	return None
+
+class IndexAdvisor:
+	"""
+	:param engine: The engine the statements are explained on, it should hold production-like data,
+	  planners choose full scans of tables small enough to read at once
+	:param models: The models whose tables indexes are suggested for, e.g. the ones listed in map.json
+	Runs EXPLAIN QUERY PLAN(sqlite) or EXPLAIN(postgresql, mysql) on a workload of statements and collects
+	full table scans and sorts done in a temporary b-tree, then suggests an index per table and column list:
+	the columns the statement compares for equality, then its ORDER BY/GROUP BY columns, then a range column.
+	Statements are only planned, never run, and the transaction they're planned in is rolled back.
+	"""
+	def __init__(self, engine, models: Iterable) -> None:
+		self.engine = engine
+		self.tables = {model.__table__.name.lower(): model.__table__ for model in models}
+		self.explained = 0
+		self.skipped = 0
+		self.failed: List[Tuple[str, str]] = []
+		# Statements that scan a table without filtering it, no index helps them
+		self.unfiltered: Dict[str, int] = {}
+		self._existing: Optional[Dict[str, List[Tuple[str, ...]]]] = None
+
+	def explain(self, connection, statement: str, parameters: Any = None) -> List[Finding]:
+		dialect = self.engine.dialect.name
+		if parameters is None:
+			parameters = _placeholders(statement, dialect)
+		elif isinstance(parameters, list):
+			parameters = tuple(parameters)
+		if dialect == "sqlite":
+			rows = connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters or ()).fetchall()
+			return self._sqlite_findings(row[-1] for row in rows)
+		if dialect == "postgresql":
+			plan = connection.exec_driver_sql(f"EXPLAIN (FORMAT JSON) {statement}", parameters or ()).scalar()
+			if isinstance(plan, str):
+				plan = json.loads(plan)
+			return self._postgresql_findings(plan[0]["Plan"])
+		if dialect == "mysql":
+			rows = connection.exec_driver_sql(f"EXPLAIN {statement}", parameters or ()).mappings().fetchall()
+			return self._mysql_findings(rows)
+		raise ValueError(f"Index suggestions aren't supported on {dialect}, only on sqlite, postgresql and mysql")
+
+	def _sqlite_findings(self, details: Iterable[str]) -> List[Finding]:
+		findings = []
+		for detail in details:
+			# "SCAN items", "SCAN TABLE items AS i"(before 3.36) or "SCAN items USING INDEX ix"(a full pass over an index)
+			match = re.match(r"SCAN (?:TABLE )?(\w+)(?: AS (\w+))?", detail)
+			if match:
+				findings.append(Finding("scan", match.group(2) or match.group(1)))
+			elif detail.startswith(("USE TEMP B-TREE FOR ORDER BY", "USE TEMP B-TREE FOR GROUP BY")):
+				findings.append(Finding("sort", ""))
+		return findings
+
+	def _postgresql_findings(self, node: dict) -> List[Finding]:
+		findings = []
+		if node.get("Node Type") == "Seq Scan":
+			findings.append(Finding("scan", node.get("Alias") or node.get("Relation Name", "")))
+		elif node.get("Node Type") in ("Sort", "Incremental Sort"):
+			findings.append(Finding("sort", ""))
+		for child in node.get("Plans", ()):
+			findings.extend(self._postgresql_findings(child))
+		return findings
+
+	def _mysql_findings(self, rows) -> List[Finding]:
+		findings = []
+		for row in rows:
+			if row.get("type") == "ALL" and row.get("table"):
+				findings.append(Finding("scan", row["table"]))
+			if "Using filesort" in (row.get("Extra") or ""):
+				findings.append(Finding("sort", ""))
+		return findings
+
+	def _aliases(self, statement: str) -> Dict[str, str]:
+		aliases = {}
+		for match in _FROM.finditer(statement):
+			table = match.group(1).lower()
+			if table not in self.tables:
+				continue
+			alias = match.group(2)
+			# An aliased table is only known by its alias within the statement
+			if alias and alias.lower() not in _KEYWORDS:
+				aliases[alias.lower()] = table
+			else:
+				aliases[table] = table
+		return aliases
+
+	def _resolve(self, qualifier: Optional[str], column: str, aliases: Dict[str, str]) -> Optional[Tuple[str, str]]:
+		column = column.lower()
+		if qualifier:
+			qualifier = qualifier.lower()
+			table = aliases.get(qualifier)
+			return (qualifier, column) if table and column in self._columns(table) else None
+		# Unqualified columns belong to the only table of the statement having one by that name
+		owners = {alias for alias, table in aliases.items() if column in self._columns(table)}
+		if len(owners) != 1:
+			return None
+		return (owners.pop(), column)
+
+	def _columns(self, table: str) -> Dict[str, str]:
+		return {column.name.lower(): column.name for column in self.tables[table].columns}
+
+	def _predicates(self, statement: str, aliases: Dict[str, str]) -> List[Tuple[str, str, str]]:
+		"""(alias, column, "eq" or "range") for the columns the statement compares, in order of appearance."""
+		predicates = []
+		for clause in _PREDICATES.finditer(statement):
+			text = clause.group(1)
+			for match in _REFERENCE.finditer(text):
+				resolved = self._resolve(match.group(1), match.group(2), aliases)
+				if resolved is None:
+					continue
+				operator = _OPERATOR.match(text, match.end())
+				if operator is None:
+					# The right side of a join condition, e.g. books.author_id = authors.id
+					before = text[:match.start()].rstrip()
+					if before.endswith("=") and not before.endswith(("<=", ">=", "!=")):
+						predicates.append((*resolved, "eq"))
+					continue
+				kind = operator.group(1).lower()
+				predicates.append((*resolved, "eq" if kind in ("=", "==", "in", "is") else "range"))
+		return predicates
+
+	def _ordering(self, statement: str, aliases: Dict[str, str]) -> List[Tuple[str, str]]:
+		columns = []
+		for clause in _ORDERING.finditer(statement):
+			for part in clause.group(1).split(","):
+				match = _REFERENCE.match(part.strip())
+				resolved = match and self._resolve(match.group(1), match.group(2), aliases)
+				if not resolved:
+					# Ordering by an expression, an index on the columns wouldn't give that order
+					return []
+				columns.append(resolved)
+		return columns
+
+	def _suggest(self, alias: str, table: str, predicates, ordering, sort: bool) -> Optional[Tuple[str, ...]]:
+		names = self._columns(table)
+		columns = []
+		for predicate_alias, column, kind in predicates:
+			if predicate_alias == alias and kind == "eq" and column not in columns:
+				columns.append(column)
+		if sort and ordering and all(order_alias == alias for order_alias, _ in ordering):
+			columns.extend(column for _, column in ordering if column not in columns)
+		# Equality, then sort, then range: the index can only seek on one range and it has to come last
+		ranged = [column for predicate_alias, column, kind in predicates if predicate_alias == alias and kind == "range" and column not in columns]
+		columns.extend(ranged[:1])
+		return tuple(names[column] for column in columns) or None
+
+	def existing_indexes(self) -> Dict[str, List[Tuple[str, ...]]]:
+		"""The column lists of the indexes(and primary keys) the database and the models already have, per table."""
+		if self._existing is None:
+			inspector = inspect(self.engine)
+			tables = set(inspector.get_table_names())
+			self._existing = {}
+			for name, table in self.tables.items():
+				indexes = [tuple(column.name for column in table.primary_key.columns)]
+				indexes.extend(tuple(column.name for column in index.columns) for index in table.indexes)
+				if table.name in tables:
+					indexes.extend(tuple(index["column_names"]) for index in inspector.get_indexes(table.name))
+					indexes.extend(tuple(constraint["column_names"]) for constraint in inspector.get_unique_constraints(table.name))
+				self._existing[name] = [tuple(column.lower() for column in index if column) for index in indexes]
+		return self._existing
+
+	def _covered(self, table: str, columns: Tuple[str, ...]) -> bool:
+		wanted = tuple(column.lower() for column in columns)
+		return any(index[:len(wanted)] == wanted for index in self.existing_indexes()[table])
+
+	def analyze(self, statements: Iterable[Tuple[str, Any]]) -> List[IndexSuggestion]:
+		"""Plans every distinct statement shape of the workload, returns the suggestions helping the most statements first."""
+		suggestions: Dict[Tuple[str, Tuple[str, ...]], IndexSuggestion] = {}
+		seen = set()
+		with self.engine.connect() as connection:
+			for statement, parameters in statements:
+				shape = statement_shape(statement)
+				if shape in seen:
+					continue
+				seen.add(shape)
+				if not shape.lower().startswith(_EXPLAINABLE):
+					self.skipped += 1
+					continue
+				transaction = connection.begin()
+				try:
+					findings = self.explain(connection, statement, parameters)
+				except Exception as e:
+					self.failed.append((shape, str(e).splitlines()[0]))
+					continue
+				finally:
+					transaction.rollback()
+				self.explained += 1
+				self._collect(shape, findings, suggestions)
+		return sorted(self._merge(suggestions.values()), key=lambda suggestion: (-len(suggestion.statements), suggestion.name))
+
+	def _merge(self, suggestions: Iterable[IndexSuggestion]) -> List[IndexSuggestion]:
+		# An index also serves the statements of any leading part of its columns, one index is enough for both
+		merged = []
+		for suggestion in sorted(suggestions, key=lambda suggestion: -len(suggestion.columns)):
+			wider = next((kept for kept in merged if kept.table == suggestion.table and kept.columns[:len(suggestion.columns)] == suggestion.columns), None)
+			if wider is None:
+				merged.append(suggestion)
+				continue
+			wider.reasons |= suggestion.reasons
+			wider.statements.extend(statement for statement in suggestion.statements if statement not in wider.statements)
+		return merged
+
+	def _collect(self, shape: str, findings: List[Finding], suggestions: Dict) -> None:
+		aliases = self._aliases(shape)
+		if not aliases:
+			return
+		predicates = self._predicates(shape, aliases)
+		ordering = self._ordering(shape, aliases)
+		sort = any(finding.kind == "sort" for finding in findings)
+		candidates = []
+		for finding in findings:
+			if finding.kind != "scan":
+				continue
+			alias = finding.table.lower()
+			table = aliases.get(alias)
+			if table is None:
+				continue
+			columns = self._suggest(alias, table, predicates, ordering, sort)
+			if columns is None:
+				self.unfiltered[table] = self.unfiltered.get(table, 0) + 1
+				continue
+			candidates.append((table, columns, "full scan"))
+		if sort and ordering and len({alias for alias, _ in ordering}) == 1:
+			alias = ordering[0][0]
+			table = aliases[alias]
+			columns = self._suggest(alias, table, predicates, ordering, True)
+			candidates.append((table, columns, "temp b-tree sort"))
+		for table, columns, reason in candidates:
+			if self._covered(table, columns):
+				continue
+			name = self.tables[table].name
+			suggestion = suggestions.get((name, columns))
+			if suggestion is None:
+				suggestion = suggestions[(name, columns)] = IndexSuggestion(name, columns)
+			suggestion.reasons.add(reason)
+			if shape not in suggestion.statements:
+				suggestion.statements.append(shape)
@@ -0,0 +1,62 @@
+from sqlalchemy import func, select
+from typing import Any, Generator, List, Optional
+
+class AsyncQuery:
+	"""
+	:param session: The AsyncSession(or the scoped registry of one) the statement runs on
+	:param statement: The select statement, e.g. select(User).filter_by(active=True)
+	The async counterpart of a Query: it's refined the same way(filter, filter_by, order_by, limit, offset, options)
+	and only runs when one of all(), first(), one(), one_or_none(), count() or exists() is awaited.
+	Awaiting the query itself returns all() of it. Statements of a session run one at a time,
+	relationships have to be loaded eagerly(e.g. options(selectinload(...))), async code can't load them on access.
+	"""
+	def __init__(self, session, statement) -> None:
+		self.session = session
+		self.statement = statement
+
+	def _derive(self, statement) -> "AsyncQuery":
+		return AsyncQuery(self.session, statement)
+
+	def filter(self, *criterion) -> "AsyncQuery":
+		return self._derive(self.statement.filter(*criterion))
+
+	def filter_by(self, **kwargs) -> "AsyncQuery":
+		return self._derive(self.statement.filter_by(**kwargs))
+
+	def order_by(self, *clauses) -> "AsyncQuery":
+		return self._derive(self.statement.order_by(*clauses))
+
+	def limit(self, limit: Optional[int]) -> "AsyncQuery":
+		return self._derive(self.statement.limit(limit))
+
+	def offset(self, offset: Optional[int]) -> "AsyncQuery":
+		return self._derive(self.statement.offset(offset))
+
+	def options(self, *options) -> "AsyncQuery":
+		return self._derive(self.statement.options(*options))
+
+	async def all(self) -> List[Any]:
+		return (await self.session.execute(self.statement)).scalars().all()
+
+	async def first(self) -> Optional[Any]:
+		return (await self.session.execute(self.statement.limit(1))).scalars().first()
+
+	async def one(self) -> Any:
+		return (await self.session.execute(self.statement)).scalars().one()
+
+	async def one_or_none(self) -> Optional[Any]:
+		return (await self.session.execute(self.statement)).scalars().one_or_none()
+
+	async def count(self) -> int:
+		counted = select(func.count()).select_from(self.statement.order_by(None).subquery())
+		return (await self.session.execute(counted)).scalar()
+
+	async def exists(self) -> bool:
+		# SELECT EXISTS(...) lets the database stop at the first matching row
+		return bool((await self.session.execute(select(self.statement.order_by(None).exists()))).scalar())
+
+	def __await__(self) -> Generator[Any, None, List[Any]]:
+		return self.all().__await__()
+
+	def __repr__(self):
+		return f"AsyncQuery({self.statement})"
@@ -1,8 +1,326 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import Session, scoped_session, sessionmaker
+from contextvars import ContextVar
+from .telemetry import PoolTelemetry
+from .replicas import ReplicaSet, is_read
+from typing import Callable, List, Optional
+import math
+import os
+import threading
+import time
+import weakref
+
+# Drivers the async engine uses when only the sync url is configured
+ASYNC_DRIVERS = {"sqlite": "aiosqlite", "postgresql": "asyncpg", "mysql": "aiomysql"}
+
+# Set by the apps for the duration of a request, sessions are scoped to it instead of to the thread,
+# so coroutines sharing the event loop thread each get their own session
+_request_scope: ContextVar[Optional["RequestScope"]] = ContextVar("mercury_request_scope", default=None)
+
+# Holds the time until which a client that just wrote reads from the primary
+READ_YOUR_WRITES_COOKIE = "mercury_primary_until"
+
+def _scope():
+	scope = _request_scope.get()
+	return threading.get_ident() if scope is None else scope
+
+def _create_engine(url, kwargs: dict):
+	if make_url(url).get_backend_name() == "sqlite":
+		# A request's session may be ended on another thread than it was used on(e.g. by the ASGI executor)
+		kwargs = dict(kwargs, connect_args=dict(kwargs.get("connect_args", {})))
+		kwargs["connect_args"].setdefault("check_same_thread", False)
+	return create_engine(url, **kwargs)
+
+def _wrote(session: Session) -> None:
+	session.info["mercury_wrote"] = True
+	scope = _request_scope.get()
+	if scope is not None:
+		scope.wrote = True
+
+class RoutingSession(Session):
+	"""
+	A session reading from a replica and writing to the primary(its bind). Once it wrote, or when the
+	request is pinned to the primary, it reads from the primary as well so it sees its own writes.
+	A session sticks to the replica it picked first, its reads see one replica's state.
+	"""
+	def __init__(self, replicas: Optional[ReplicaSet] = None, **kwargs) -> None:
+		super().__init__(**kwargs)
+		self.replicas = replicas
+		self._replica = None
+
+	def get_bind(self, mapper=None, clause=None, **kwargs):
+		if self.replicas is None or self._flushing or self.info.get("mercury_wrote") or not is_read(clause):
+			if getattr(clause, "is_dml", False):
+				_wrote(self)
+			return super().get_bind(mapper, clause, **kwargs)
+		scope = _request_scope.get()
+		if (scope is not None and scope.primary) or self.info.get("mercury_primary"):
+			return super().get_bind(mapper, clause, **kwargs)
+		if self._replica is None:
+			self._replica = self.replicas.choose()
+		return self._replica
+
+event.listen(RoutingSession, "after_flush", lambda session, context: _wrote(session))
 
 class connection:
-	def __init__(self, *args, **kwargs) -> None:
-		self.Engine = create_engine(*args, **kwargs)
-		self._sessionmaker = sessionmaker(bind=self.Engine)
-		self.Session = self._sessionmaker()
+	"""
+	:param pool_size: Connections kept open in the pool
+	:param max_overflow: Connections opened beyond pool_size under load, closed again when returned
+	:param pool_pre_ping: Test connections before handing them out, replacing the ones the server dropped
+	:param pool_recycle: Seconds after which a connection is replaced, for servers closing idle connections
+	:param commit_on_success: Commit the request's session when the request succeeded, by default whatever the controller didn't commit itself is rolled back
+	:param slow_checkout: Seconds a request may wait for a pooled connection before a warning naming its route is printed, None disables it
+	:param async_url: Url of the asyncio engine(defaults to the engine's url with the async driver of its database, e.g. sqlite+aiosqlite)
+	:param replicas: Urls of read replicas of the database, sessions then read from them and write to the primary(the first url)
+	:param replica_strategy: How a session's replica is picked, "round_robin" or "least_connections"
+	:param read_your_writes: Seconds a client that wrote keeps reading from the primary(tracked with a cookie), so replication lag can't hide its writes
+	Engine plus a scoped Session: `Connection.Session` is a registry handing every request(or thread,
+	outside of requests) its own session. The apps open it lazily on first use and roll it back(or commit it,
+	with commit_on_success=True), then remove it, when the request ends, so threads can safely share the engine's pool.
+	`Connection.AsyncEngine` and `Connection.AsyncSession` are their asyncio counterparts for async controllers,
+	created on first use so the async driver is only needed by apps using them.
+	Routes decorated with usePrimary() read from the primary, the async session always uses it.
+	"""
+	instances = weakref.WeakSet()
+	# Called with every engine the connections create(replicas and the async engine's sync engine included), e.g. to instrument it
+	engine_hooks: List[Callable] = []
+	# The longest read_your_writes of all connections, 0 skips the cookie handling entirely
+	read_your_writes_window = 0.0
+
+	def __init__(self, *args, pool_size: Optional[int] = None, max_overflow: Optional[int] = None, pool_pre_ping: bool = False,
+			pool_recycle: int = -1, commit_on_success: bool = False, slow_checkout: Optional[float] = 0.1, async_url: Optional[str] = None,
+			replicas: Optional[List[str]] = None, replica_strategy: str = "round_robin", read_your_writes: float = 0.0, **kwargs) -> None:
+		# Only pass the pool options that were set, sqlite's default pools reject pool_size and max_overflow
+		if pool_size is not None:
+			kwargs["pool_size"] = pool_size
+		if max_overflow is not None:
+			kwargs["max_overflow"] = max_overflow
+		if pool_pre_ping:
+			kwargs["pool_pre_ping"] = True
+		if pool_recycle != -1:
+			kwargs["pool_recycle"] = pool_recycle
+		# The async engine shares the pool settings, not the sync driver's options
+		self._async_kwargs = {key: value for key, value in kwargs.items() if key in ("pool_size", "max_overflow", "pool_pre_ping", "pool_recycle", "echo")}
+		self._async_url = async_url
+		self._async = None
+		self._async_lock = threading.Lock()
+		url = args[0] if args else kwargs.pop("url")
+		self.Engine = _create_engine(url, kwargs)
+		self.commit_on_success = commit_on_success
+		# Pool usage shows up next to the request metrics of the apps
+		self.telemetry = PoolTelemetry(self.Engine, slow_checkout)
+		self.telemetries = [self.telemetry]
+		self.replicas = None
+		if replicas:
+			engines = [_create_engine(replica, kwargs) for replica in replicas]
+			telemetry = [PoolTelemetry(engine, slow_checkout) for engine in engines]
+			self.telemetries.extend(telemetry)
+			self.replicas = ReplicaSet(engines, telemetry, replica_strategy)
+			connection.read_your_writes_window = max(connection.read_your_writes_window, read_your_writes)
+		self.read_your_writes = read_your_writes
+		self._sessionmaker = sessionmaker(bind=self.Engine, class_=RoutingSession, replicas=self.replicas)
+		self.Session = scoped_session(self._sessionmaker, scopefunc=_scope)
+		connection.instances.add(self)
+		for engine in self.engines():
+			self._engine_created(engine)
+
+	def _after_fork(self) -> None:
+		for telemetry in self.telemetries:
+			telemetry.reset()
+		self.Engine.dispose(close=False)
+		if self.replicas is not None:
+			self.replicas.dispose(close=False)
+		if self._async is not None:
+			self._async[0].sync_engine.dispose(close=False)
+
+	def engines(self) -> list:
+		"""The sync engines of this connection: the primary, the replicas and the async engine's once it was created."""
+		engines = [self.Engine]
+		if self.replicas is not None:
+			engines.extend(self.replicas.engines)
+		if self._async is not None:
+			engines.append(self._async[0].sync_engine)
+		return engines
+
+	def _engine_created(self, engine) -> None:
+		for hook in list(connection.engine_hooks):
+			hook(engine)
+
+	def _create_async(self) -> tuple:
+		from sqlalchemy.ext.asyncio import AsyncSession, async_scoped_session, create_async_engine
+		url = self._async_url
+		if url is None:
+			backend = self.Engine.url.get_backend_name()
+			if backend not in ASYNC_DRIVERS:
+				raise ValueError(f"No async driver known for {backend}, pass async_url to connection()")
+			url = self.Engine.url.set(drivername=f"{backend}+{ASYNC_DRIVERS[backend]}")
+		engine = create_async_engine(url, **self._async_kwargs)
+		self._engine_created(engine.sync_engine)
+		# Expiring on commit would make the next attribute access load from the database, which can't happen implicitly in async code
+		session = async_scoped_session(sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False), scopefunc=_scope)
+		return engine, session
+
+	def _get_async(self) -> tuple:
+		if self._async is None:
+			with self._async_lock:
+				if self._async is None:
+					self._async = self._create_async()
+		return self._async
+
+	@property
+	def AsyncEngine(self):
+		return self._get_async()[0]
+
+	@property
+	def AsyncSession(self):
+		return self._get_async()[1]
+
+	def has_session(self) -> bool:
+		return self.Session.registry.has()
+
+	def has_pending_writes(self) -> bool:
+		"""Whether the session of the current scope has changes its commit will write."""
+		if not self.Session.registry.has():
+			return False
+		session = self.Session()
+		return bool(session.new or session.dirty or session.deleted)
+
+	def end_session(self, error: bool = False) -> None:
+		"""Commits(or on error rolls back) and removes the session of the current scope, if one was opened."""
+		if not self.Session.registry.has():
+			return
+		session = self.Session()
+		try:
+			if error or not self.commit_on_success:
+				session.rollback()
+			else:
+				session.commit()
+		except Exception:
+			session.rollback()
+			raise
+		finally:
+			self.Session.remove()
+
+	async def end_async_session(self, error: bool = False) -> None:
+		"""end_session for the AsyncSession of the current scope."""
+		if self._async is None or not self._async[1].registry.has():
+			return
+		registry = self._async[1]
+		session = registry()
+		try:
+			if error or not self.commit_on_success:
+				await session.rollback()
+			else:
+				await session.commit()
+		except Exception:
+			await session.rollback()
+			raise
+		finally:
+			await registry.remove()
+
+def _after_fork() -> None:
+	for instance in list(connection.instances):
+		instance._after_fork()
+
+if hasattr(os, "register_at_fork"):
+	# Pooled connections must not be shared with forked workers, they open their own
+	os.register_at_fork(after_in_child=_after_fork)
+
+class RequestScope:
+	"""
+	:param route: The route being handled, e.g. "GET /users/{id:int}", it names the request in warnings
+	:param primary: Read from the primary instead of the replicas
+	The database scope of one request, created by the apps when a request starts.
+	Sessions used while handling the request(including while a streamed body is produced)
+	belong to it, end() commits or rolls them back and removes them.
+	"""
+	__slots__ = ("route", "primary", "wrote", "sql", "_token")
+
+	def __init__(self, route: Optional[str] = None, primary: bool = False) -> None:
+		self.route = route
+		self.primary = primary
+		self.wrote = False
+		# The RequestSQL counting the request's statements, set when the app instruments them
+		self.sql = None
+		self._token = _request_scope.set(self)
+
+	@staticmethod
+	def wrote_recently(request) -> bool:
+		"""Whether the client wrote within the read-your-writes window, its requests then read from the primary."""
+		if not connection.read_your_writes_window:
+			return False
+		until = request.cookies.get(READ_YOUR_WRITES_COOKIE)
+		try:
+			return until is not None and float(until) > time.time()
+		except ValueError:
+			return False
+
+	def remember_writes(self, response) -> None:
+		"""Keeps a client that wrote on the primary for the read-your-writes window, call it before the response is sent."""
+		window = connection.read_your_writes_window
+		if not window:
+			return
+		token = _request_scope.set(self)
+		try:
+			wrote = self.wrote or any(instance.has_pending_writes() for instance in list(connection.instances))
+		finally:
+			_request_scope.reset(token)
+		if wrote:
+			response.set_cookie(READ_YOUR_WRITES_COOKIE, f"{time.time() + window:.3f}", max_age=math.ceil(window), httponly=True, samesite="Lax")
+
+	def opened(self) -> bool:
+		token = _request_scope.set(self)
+		try:
+			return any(instance.has_session() for instance in list(connection.instances))
+		finally:
+			_request_scope.reset(token)
+
+	def close_sessions(self, error: bool = False) -> None:
+		"""Ends the request's session of every connection, it may run in any thread or context."""
+		token = _request_scope.set(self)
+		try:
+			failure = None
+			for instance in list(connection.instances):
+				try:
+					instance.end_session(error)
+				except Exception as e:
+					failure = failure or e
+			if failure is not None:
+				raise failure
+		finally:
+			_request_scope.reset(token)
+
+	async def close_async_sessions(self, error: bool = False) -> None:
+		"""close_sessions for the AsyncSessions, awaited on the event loop."""
+		token = _request_scope.set(self)
+		try:
+			failure = None
+			for instance in list(connection.instances):
+				try:
+					await instance.end_async_session(error)
+				except Exception as e:
+					failure = failure or e
+			if failure is not None:
+				raise failure
+		finally:
+			_request_scope.reset(token)
+
+	def reset(self) -> None:
+		"""Leaves the scope, must run in the context the scope was created in."""
+		try:
+			_request_scope.reset(self._token)
+		except (ValueError, RuntimeError):
+			# Already left, or the body was closed from another context
+			pass
+
+	def end(self, error: bool = False) -> None:
+		try:
+			self.close_sessions(error)
+		finally:
+			self.reset()
+
+def current_route() -> Optional[str]:
+	"""The route of the request running in this context, None outside of requests."""
+	scope = _request_scope.get()
+	return scope.route if scope is not None else None
@@ -0,0 +1,231 @@
+from colorama import Fore, Style
+from sqlalchemy import event
+from .connection import _request_scope, connection, current_route
+from .telemetry import WARNING_INTERVAL
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+from time import monotonic, perf_counter
+import heapq
+import json
+import os
+import random
+import re
+import threading
+
+SQL_HEADER = "X-Mercury-SQL"
+# IN lists of placeholders(e.g. of a selectinload) vary in length between statements of one shape
+_IN_LIST = re.compile(r"\((?:\s*(?:\?|%s|%\(\w+\)s|:\w+|\$\d+)\s*,)+\s*(?:\?|%s|%\(\w+\)s|:\w+|\$\d+)\s*\)")
+_MAX_SHAPES = 4096
+_shapes: Dict[str, str] = {}
+
+def statement_shape(statement: str) -> str:
+	"""The statement with its whitespace and IN lists normalized, statements of one shape only differ by their parameters."""
+	shape = _shapes.get(statement)
+	if shape is None:
+		shape = _IN_LIST.sub("(?)", " ".join(statement.split()))
+		if len(_shapes) >= _MAX_SHAPES:
+			_shapes.clear()
+		_shapes[statement] = shape
+	return shape
+
+def _shorten(statement: str, length: int) -> str:
+	statement = " ".join(statement.split())
+	return statement if len(statement) <= length else statement[:length] + "..."
+
+def _controller_name(compiled) -> str:
+	controller = compiled.controller
+	return getattr(controller, "__qualname__", None) or repr(controller)
+
+class RequestSQL:
+	"""The statements one request ran: how many, the time they took, how often each shape ran and the slowest ones."""
+	__slots__ = ("queries", "time", "shapes", "slowest", "_keep")
+
+	def __init__(self, keep: int = 5) -> None:
+		self.queries = 0
+		self.time = 0.0
+		self.shapes = Counter()
+		# A min-heap of (seconds, statement), the fastest of the kept statements is the one replaced
+		self.slowest: List[Tuple[float, str]] = []
+		self._keep = keep
+
+	def add(self, statement: str, duration: float) -> None:
+		self.queries += 1
+		self.time += duration
+		self.shapes[statement_shape(statement)] += 1
+		if len(self.slowest) < self._keep:
+			heapq.heappush(self.slowest, (duration, statement))
+		elif self.slowest and duration > self.slowest[0][0]:
+			heapq.heapreplace(self.slowest, (duration, statement))
+
+	def repeated(self, threshold: int) -> List[Tuple[str, int]]:
+		"""The shapes that ran more than threshold times, most repeated first."""
+		return [(shape, count) for shape, count in self.shapes.most_common() if count > threshold]
+
+class RouteSQL:
+	"""The totals of the requests of one route."""
+	__slots__ = ("requests", "queries", "time", "max_queries", "n_plus_one", "slowest")
+
+	def __init__(self) -> None:
+		self.requests = 0
+		self.queries = 0
+		self.time = 0.0
+		self.max_queries = 0
+		# Requests that repeated a statement shape more than the threshold
+		self.n_plus_one = 0
+		# The longest time of the slowest shapes, a route repeats its statements so each shape is kept once
+		self.slowest: Dict[str, Tuple[float, str]] = {}
+
+class SQLInstrumentation:
+	"""
+	:param n_plus_one: Times one statement shape may run within a request before it's reported as an N+1 query, None disables the check
+	:param slow_query: Seconds a statement may take before it's logged as slow, None disables the slow query log
+	:param sample_rate: Fraction of the slow statements that are logged(0.1 logs one in ten)
+	:param header: Adds an X-Mercury-SQL header with the request's query count, database time and repeated shapes to every response
+	  (defaults to on when the MERCURY_ENV environment variable is "development", `mercury run` sets it)
+	:param slowest: Slowest statements kept per request and per route
+	:param statement_length: Characters of a statement shown in the logs and in stats()
+	:param capture: File the first statement of every shape is appended to with its parameters, as json lines `mercury analyze`
+	  reads to suggest indexes(defaults to the MERCURY_SQL_CAPTURE environment variable, None captures nothing)
+	Times every statement through SQLAlchemy's engine events on the engines of the app's connections(replicas,
+	async engines and bulk writes included), engines created elsewhere aren't timed. Statements run while handling a request are counted per request
+	and aggregated per route in stats() and in the metrics, statements of a request repeating one shape(e.g.
+	a lazy load per row of a list) are reported with the controller running them.
+	"""
+	active: Optional["SQLInstrumentation"] = None
+	_listening = False
+
+	def __init__(self, n_plus_one: Optional[int] = 10, slow_query: Optional[float] = 0.5, sample_rate: float = 1.0,
+			header: Optional[bool] = None, slowest: int = 5, statement_length: int = 500, capture: Optional[str] = None) -> None:
+		self.n_plus_one = n_plus_one
+		self.slow_query = slow_query
+		self.sample_rate = sample_rate
+		self.header = os.environ.get("MERCURY_ENV") == "development" if header is None else header
+		self.slowest = slowest
+		self.statement_length = statement_length
+		self.capture = capture or os.environ.get("MERCURY_SQL_CAPTURE")
+		self._captured = set()
+		self.routes: Dict[Optional[str], RouteSQL] = {}
+		self._lock = threading.Lock()
+		self._warned: Dict[Tuple[Optional[str], str], float] = {}
+
+	def activate(self) -> None:
+		"""Starts timing the statements of the connections' engines, including the ones created later, the apps call it for the instrumentation they were given."""
+		SQLInstrumentation.active = self
+		if not SQLInstrumentation._listening:
+			SQLInstrumentation._listening = True
+			connection.engine_hooks.append(_instrument)
+			for instance in list(connection.instances):
+				for engine in instance.engines():
+					_instrument(engine)
+
+	def begin(self, scope) -> None:
+		"""Starts counting the statements of the request the scope belongs to."""
+		scope.sql = RequestSQL(self.slowest)
+
+	def observe(self, statement: str, duration: float, parameters=None) -> None:
+		scope = _request_scope.get()
+		if scope is not None and scope.sql is not None:
+			scope.sql.add(statement, duration)
+		if self.capture and parameters is not None:
+			self._capture(statement, parameters, scope.route if scope is not None else None)
+		if self.slow_query is not None and duration >= self.slow_query and (self.sample_rate >= 1.0 or random.random() < self.sample_rate):
+			route = current_route() or "outside of a request"
+			print(f"{Fore.YELLOW}[WARNING] Slow query in {route} took {duration * 1000:.0f}ms: {_shorten(statement, self.statement_length)}{Style.RESET_ALL}")
+
+	def _capture(self, statement: str, parameters, route: Optional[str]) -> None:
+		shape = statement_shape(statement)
+		if shape in self._captured or len(self._captured) >= _MAX_SHAPES:
+			return
+		with self._lock:
+			if shape in self._captured:
+				return
+			self._captured.add(shape)
+		# Values json can't carry(dates, decimals) are written as strings, the database parses them back for EXPLAIN
+		line = json.dumps({"statement": statement, "parameters": parameters, "route": route}, default=str)
+		try:
+			with open(self.capture, "a") as f:
+				f.write(line + "\n")
+		except OSError as e:
+			print(f"{Fore.YELLOW}[WARNING] Could not capture a statement to {self.capture}: {e}{Style.RESET_ALL}")
+
+	def annotate(self, scope, response) -> None:
+		"""Adds the header with the statements run so far, call it before the response is sent."""
+		sql = scope.sql
+		if not self.header or sql is None:
+			return
+		repeated = len(sql.repeated(self.n_plus_one)) if self.n_plus_one is not None else 0
+		response.headers[SQL_HEADER] = f"queries={sql.queries}; time={sql.time * 1000:.2f}ms; repeated={repeated}"
+
+	def finish(self, compiled, scope) -> None:
+		"""Adds the request's statements to its route's totals and reports the shapes it repeated, once the scope ended."""
+		sql = scope.sql
+		if sql is None:
+			return
+		repeated = sql.repeated(self.n_plus_one) if self.n_plus_one is not None else []
+		with self._lock:
+			route_sql = self.routes.get(scope.route)
+			if route_sql is None:
+				route_sql = self.routes[scope.route] = RouteSQL()
+			route_sql.requests += 1
+			route_sql.queries += sql.queries
+			route_sql.time += sql.time
+			route_sql.max_queries = max(route_sql.max_queries, sql.queries)
+			if repeated:
+				route_sql.n_plus_one += 1
+			slowest = route_sql.slowest
+			for slow in sql.slowest:
+				shape = statement_shape(slow[1])
+				if shape not in slowest or slow[0] > slowest[shape][0]:
+					slowest[shape] = slow
+			if len(slowest) > self.slowest:
+				route_sql.slowest = dict(heapq.nlargest(self.slowest, slowest.items(), key=lambda item: item[1][0]))
+			now = monotonic()
+			warn = []
+			for shape, count in repeated:
+				# Every request of an N+1 route repeats it, one warning per interval is enough
+				key = (scope.route, shape)
+				if now - self._warned.get(key, -WARNING_INTERVAL) >= WARNING_INTERVAL:
+					self._warned[key] = now
+					warn.append((shape, count))
+		for shape, count in warn:
+			print(f"{Fore.YELLOW}[WARNING] Possible N+1 query in {_controller_name(compiled)} ({scope.route}): {count} statements of one shape "
+				f"in one request, eager load the relationship or query the rows at once: {_shorten(shape, self.statement_length)}{Style.RESET_ALL}")
+
+	def stats(self) -> dict:
+		"""The totals of this process per route, with the slowest statements first."""
+		with self._lock:
+			return {
+				route: {
+					"requests": route_sql.requests,
+					"queries": route_sql.queries,
+					"time": route_sql.time,
+					"queries_per_request": route_sql.queries / route_sql.requests,
+					"max_queries": route_sql.max_queries,
+					"n_plus_one": route_sql.n_plus_one,
+					"slowest": [{"time": duration, "statement": _shorten(statement, self.statement_length)} for duration, statement in sorted(route_sql.slowest.values(), reverse=True)],
+				}
+				for route, route_sql in self.routes.items()
+			}
+
+	def reset(self) -> None:
+		with self._lock:
+			self.routes.clear()
+			self._warned.clear()
+			self._captured.clear()
+
+def _instrument(engine) -> None:
+	if not event.contains(engine, "before_cursor_execute", _before_cursor_execute):
+		event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+		event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+	if context is not None and SQLInstrumentation.active is not None:
+		# The context belongs to this one execution, a statement that fails just leaves it behind
+		context._mercury_started = perf_counter()
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany) -> None:
+	started = getattr(context, "_mercury_started", None)
+	instrumentation = SQLInstrumentation.active
+	if started is not None and instrumentation is not None:
+		# executemany batches are writes, there is nothing to suggest an index for
+		instrumentation.observe(statement, perf_counter() - started, None if executemany else parameters)
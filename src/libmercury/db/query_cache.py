@@ -0,0 +1,175 @@
+from ..cache import LRUCache
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+from .statements import find_first, row_exists
+from typing import Any, Callable, Dict, Optional, Set
+import copy
+import threading
+
+# Stands for a cached "no such row", the backend returns None for missing entries
+_NOT_FOUND = object()
+
+class ModelCache:
+	"""The cached lookups of one model, with its counters."""
+	def __init__(self, model, ttl: float, max_entries: int) -> None:
+		self.model = model
+		self.ttl = ttl
+		self.backend = LRUCache(max_entries)
+		self.keys = tuple(attribute.key for attribute in inspect(model).column_attrs)
+		# Bumped by every invalidation, a lookup only stores its result if no write committed while it ran
+		self.generation = 0
+		self.hits = 0
+		self.misses = 0
+		self.bypassed = 0
+		self.invalidations = 0
+
+class QueryCache:
+	"""
+	An opt-in, in-process cache of find_or_404() and exists() lookups, keyed by model and filter kwargs.
+	Models are cached once enabled with cache_queries(), the entries expire after their ttl and the least
+	recently used ones are evicted beyond max_entries. Commits(including update_object's), deletes and bulk
+	updates of a model drop its entries through session events, and a lookup that ran while a write committed
+	isn't stored, so a process never reads a value older than its last commit. Sessions with uncommitted
+	changes of a model skip its cache. Writes of other processes only show up after the ttl.
+	"""
+	def __init__(self) -> None:
+		self.models: Dict[type, ModelCache] = {}
+		self._lock = threading.Lock()
+
+	def enable(self, model, ttl: float = 60, max_entries: int = 1024) -> None:
+		with self._lock:
+			self.models[model] = ModelCache(model, ttl, max_entries)
+
+	def disable(self, model) -> None:
+		with self._lock:
+			self.models.pop(model, None)
+
+	def is_cached(self, model) -> bool:
+		return model in self.models
+
+	def _changed(self, session, model) -> bool:
+		changed = session.info.get("mercury_changed_models", ())
+		if model in changed or None in changed:
+			return True
+		for obj in (*session.new, *session.dirty, *session.deleted):
+			if isinstance(obj, model):
+				return True
+		return False
+
+	def _lookup(self, session, model, kind: str, kwargs: dict, load: Callable[[], Any]) -> Any:
+		model_cache = self.models[model]
+		try:
+			key = (kind, tuple(sorted(kwargs.items())))
+			hash(key)
+		except TypeError:
+			key = None
+		if key is None or self._changed(session, model):
+			# The database has to answer, it knows about the session's own writes
+			model_cache.bypassed += 1
+			return load()
+		value = model_cache.backend.get(key)
+		if value is not None:
+			model_cache.hits += 1
+			return value
+		model_cache.misses += 1
+		generation = model_cache.generation
+		session.info["mercury_primary"] = True
+		try:
+			# Replicas may lag behind the commit that just invalidated the entry, fill the cache from the primary
+			value = load()
+		finally:
+			session.info.pop("mercury_primary", None)
+		with self._lock:
+			if model_cache.generation == generation:
+				model_cache.backend.set(key, value, model_cache.ttl)
+		return value
+
+	def find(self, session, model, kwargs: dict) -> Optional[Any]:
+		"""The first instance matching kwargs, attached to the session, or None."""
+		model_cache = self.models[model]
+
+		def load():
+			instance = find_first(session, model, kwargs)
+			if instance is None:
+				return _NOT_FOUND
+			return {key: getattr(instance, key) for key in model_cache.keys}
+		values = self._lookup(session, model, "find", kwargs, load)
+		if values is _NOT_FOUND:
+			return None
+		return self._attach(session, model, values)
+
+	def exists(self, session, model, kwargs: dict) -> bool:
+		return self._lookup(session, model, "exists", kwargs, lambda: row_exists(session, model, kwargs))
+
+	def _attach(self, session, model, values: dict):
+		# Built without running __init__ or recording history, then added as a persistent instance without any sql
+		mapper = inspect(model)
+		instance = mapper.class_manager.new_instance()
+		for key, value in values.items():
+			# The cached values are shared between requests, mutable ones are copied
+			set_committed_value(instance, key, copy.deepcopy(value) if isinstance(value, (dict, list)) else value)
+		make_transient_to_detached(instance)
+		existing = session.identity_map.get(inspect(instance).key)
+		if existing is not None:
+			return existing
+		session.add(instance)
+		return instance
+
+	def invalidate(self, model) -> None:
+		"""Drops the entries of a model and of the models inheriting from it."""
+		with self._lock:
+			for cached_model, model_cache in self.models.items():
+				if model is None or issubclass(cached_model, model) or issubclass(model, cached_model):
+					model_cache.generation += 1
+					model_cache.invalidations += 1
+					model_cache.backend.clear()
+
+	def clear(self) -> None:
+		self.invalidate(None)
+
+	def stats(self) -> dict:
+		models = {}
+		for model, model_cache in list(self.models.items()):
+			lookups = model_cache.hits + model_cache.misses
+			models[model.__name__] = {
+				"hits": model_cache.hits,
+				"misses": model_cache.misses,
+				"bypassed": model_cache.bypassed,
+				"invalidations": model_cache.invalidations,
+				"hit_rate": model_cache.hits / lookups if lookups else 0.0,
+			}
+		hits = sum(model["hits"] for model in models.values())
+		misses = sum(model["misses"] for model in models.values())
+		return {"hits": hits, "misses": misses, "hit_rate": hits / (hits + misses) if hits + misses else 0.0, "models": models}
+
+query_cache = QueryCache()
+
+def _changed_models(session) -> Set:
+	return session.info.setdefault("mercury_changed_models", set())
+
+# Listening on Session catches every session of the process, including the ones of async sessions
+@event.listens_for(Session, "after_flush")
+def _after_flush(session, flush_context) -> None:
+	if not query_cache.models:
+		return
+	changed = _changed_models(session)
+	for obj in (*session.new, *session.dirty, *session.deleted):
+		changed.add(type(obj))
+
+@event.listens_for(Session, "do_orm_execute")
+def _bulk_write(orm_execute_state) -> None:
+	if query_cache.models and (orm_execute_state.is_update or orm_execute_state.is_delete or orm_execute_state.is_insert):
+		mapper = orm_execute_state.bind_mapper
+		# Statements on a table instead of a model can't be traced to one, they drop everything
+		_changed_models(orm_execute_state.session).add(mapper.class_ if mapper is not None else None)
+
+@event.listens_for(Session, "after_commit")
+def _after_commit(session) -> None:
+	changed = session.info.pop("mercury_changed_models", None)
+	for model in changed or ():
+		query_cache.invalidate(model)
+
+@event.listens_for(Session, "after_rollback")
+def _after_rollback(session) -> None:
+	session.info.pop("mercury_changed_models", None)
@@ -0,0 +1,44 @@
+from sqlalchemy.sql.selectable import Select
+from typing import List
+import itertools
+
+STRATEGIES = ("round_robin", "least_connections")
+
+def is_read(clause) -> bool:
+	"""Whether a statement can run on a replica, locking reads(SELECT ... FOR UPDATE) belong on the primary."""
+	return isinstance(clause, Select) and clause._for_update_arg is None
+
+class ReplicaSet:
+	"""
+	:param engines: The engines of the replicas
+	:param telemetry: The PoolTelemetry of every engine, in the same order
+	:param strategy: "round_robin", or "least_connections" for the replica with the fewest connections checked out
+	Picks the replica a session reads from.
+	"""
+	def __init__(self, engines: list, telemetry: list, strategy: str = "round_robin") -> None:
+		if strategy not in STRATEGIES:
+			raise ValueError(f"Unknown replica strategy '{strategy}', use one of {', '.join(STRATEGIES)}")
+		if not engines:
+			raise ValueError("A replica set needs at least one replica")
+		self.engines: List = engines
+		self.telemetry = telemetry
+		self.strategy = strategy
+		# next() on a count is atomic, threads don't need a lock to take turns
+		self._turn = itertools.count()
+
+	def choose(self):
+		count = len(self.engines)
+		index = next(self._turn) % count
+		if self.strategy == "least_connections":
+			# Scanning from the round robin position spreads the requests over replicas that are tied
+			best = index
+			for offset in range(1, count):
+				candidate = (index + offset) % count
+				if self.telemetry[candidate].checked_out < self.telemetry[best].checked_out:
+					best = candidate
+			index = best
+		return self.engines[index]
+
+	def dispose(self, close: bool = True) -> None:
+		for engine in self.engines:
+			engine.dispose(close=close)
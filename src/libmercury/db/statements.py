@@ -0,0 +1,70 @@
+from sqlalchemy import and_, bindparam, inspect, select
+from typing import Any, Dict, NamedTuple, Optional, Tuple
+
+class CachedFilter(NamedTuple):
+	"""The statements of one (model, filter keys) combination, built once with bound parameters in place of the values."""
+	criterion: Any
+	first: Any
+	exists: Any
+
+_cache: Dict[tuple, CachedFilter] = {}
+
+def _build(model, shape: Tuple[Tuple[str, bool], ...]) -> CachedFilter:
+	clauses = []
+	for key, is_none in shape:
+		column = getattr(model, key)
+		# filter_by(x=None) means IS NULL, which a bound parameter can't express
+		clauses.append(column.is_(None) if is_none else column == bindparam(f"mercury_{key}"))
+	criterion = and_(*clauses)
+	primary_key = [getattr(model, inspect(model).get_property_by_column(column).key) for column in model.__table__.primary_key.columns]
+	return CachedFilter(
+		criterion,
+		select(model).where(criterion).limit(1),
+		# The primary key alone is enough to know a row exists, nothing gets hydrated
+		select(*primary_key).where(criterion).limit(1),
+	)
+
+def cached_filter(model, kwargs: dict) -> Optional[Tuple[CachedFilter, dict]]:
+	"""
+	Returns the cached statements for filtering a model by kwargs and the parameters to execute them with,
+	or None when a key isn't a column(e.g. a relationship), those go through filter_by as before.
+	"""
+	try:
+		shape = tuple(sorted((key, value is None) for key, value in kwargs.items()))
+	except TypeError:
+		return None
+	cache_key = (model, shape)
+	cached = _cache.get(cache_key)
+	if cached is None:
+		column_attrs = inspect(model).column_attrs
+		if any(key not in column_attrs for key, _ in shape):
+			return None
+		cached = _build(model, shape)
+		_cache[cache_key] = cached
+	return cached, {f"mercury_{key}": value for key, value in kwargs.items() if value is not None}
+
+def filtered_query(session, model, kwargs: dict):
+	"""session.query(model).filter_by(**kwargs), with the filter built once per set of keys."""
+	cached = cached_filter(model, kwargs)
+	if cached is None:
+		return session.query(model).filter_by(**kwargs)
+	statements, params = cached
+	query = session.query(model).filter(statements.criterion)
+	return query.params(**params) if params else query
+
+def find_first(session, model, kwargs: dict) -> Optional[Any]:
+	"""The first instance matching kwargs, or None."""
+	cached = cached_filter(model, kwargs)
+	if cached is None:
+		return session.query(model).filter_by(**kwargs).first()
+	statements, params = cached
+	# unique() is required when the model eagerly joins a collection
+	return session.execute(statements.first, params).scalars().unique().first()
+
+def row_exists(session, model, kwargs: dict) -> bool:
+	"""Whether a row matches kwargs, selecting only the primary key of at most one row."""
+	cached = cached_filter(model, kwargs)
+	if cached is None:
+		return session.query(model).filter_by(**kwargs).with_entities(*model.__table__.primary_key.columns).limit(1).first() is not None
+	statements, params = cached
+	return session.execute(statements.exists, params).first() is not None
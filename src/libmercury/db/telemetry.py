@@ -0,0 +1,126 @@
+from colorama import Fore, Style
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError as PoolTimeout
+from bisect import bisect_left
+from typing import Dict, Iterable, List, Optional, Tuple
+from time import monotonic, perf_counter
+import threading
+
+POOL_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+# Seconds between two slow checkout warnings of the same route
+WARNING_INTERVAL = 10.0
+
+class PoolTelemetry:
+	"""
+	:param engine: The engine whose pool is instrumented
+	:param slow_checkout: Seconds of waiting for a connection above which a warning naming the waiting route is printed, None disables it
+	:param buckets: Upper bounds in seconds of the checkout wait histogram
+	Watches a connection pool through its events: connections checked out, overflow in use, time spent waiting
+	for a checkout, connection lifetimes and invalidations. Counters are laid out in one flat list:
+	[wait buckets..., +Inf bucket, wait sum, checkouts, timeouts, connects, invalidations, lifetime sum, closed connections]
+	"""
+	def __init__(self, engine, slow_checkout: Optional[float] = 0.1, buckets: Iterable[float] = POOL_BUCKETS) -> None:
+		self.engine = engine
+		# The url's repr hides the password
+		self.name = repr(engine.url)
+		self.slow_checkout = slow_checkout
+		self.bounds = tuple(sorted(buckets))
+		self._sum = len(self.bounds) + 1
+		self.values = [0] * (self._sum + 7)
+		self.checked_out = 0
+		self._lock = threading.Lock()
+		self._warned: Dict[Optional[str], float] = {}
+		event.listen(engine, "connect", self._on_connect)
+		event.listen(engine, "checkout", self._on_checkout)
+		event.listen(engine, "checkin", self._on_checkin)
+		event.listen(engine, "invalidate", self._on_invalidate)
+		event.listen(engine, "soft_invalidate", self._on_invalidate)
+		event.listen(engine, "close", self._on_close)
+		# dispose() replaces the pool, the pool events carry over to the new one but the timing wrapper doesn't
+		event.listen(engine, "engine_disposed", lambda engine: self._instrument(engine.pool))
+		self._instrument(engine.pool)
+
+	def _instrument(self, pool) -> None:
+		# No pool event fires before a checkout starts waiting, so the wait is timed around the pool's own checkout
+		do_get = pool._do_get
+
+		def timed_get():
+			start = perf_counter()
+			try:
+				connection = do_get()
+			except PoolTimeout:
+				self._observe_wait(perf_counter() - start, timed_out=True)
+				raise
+			self._observe_wait(perf_counter() - start)
+			return connection
+		pool._do_get = timed_get
+
+	def _observe_wait(self, wait: float, timed_out: bool = False) -> None:
+		values = self.values
+		with self._lock:
+			values[bisect_left(self.bounds, wait)] += 1
+			values[self._sum] += wait
+			values[self._sum + 1] += 1
+			if timed_out:
+				values[self._sum + 2] += 1
+		if self.slow_checkout is not None and wait >= self.slow_checkout:
+			self._warn(wait, timed_out)
+
+	def _warn(self, wait: float, timed_out: bool) -> None:
+		from .connection import current_route
+		route = current_route()
+		now = monotonic()
+		# Under saturation every request waits, one warning per route and interval is enough
+		if now - self._warned.get(route, -WARNING_INTERVAL) < WARNING_INTERVAL:
+			return
+		self._warned[route] = now
+		outcome = "timed out after waiting" if timed_out else "waited"
+		size, overflow = self.pool_size()
+		print(f"{Fore.YELLOW}[WARNING] {route or 'Code outside of a request'} {outcome} {wait * 1000:.0f}ms for a database connection "
+			f"from {self.name} ({self.checked_out} checked out, pool size {size}, overflow {overflow}){Style.RESET_ALL}")
+
+	def _on_connect(self, dbapi_connection, connection_record) -> None:
+		connection_record.info["mercury_connected_at"] = monotonic()
+		with self._lock:
+			self.values[self._sum + 3] += 1
+
+	def _on_checkout(self, dbapi_connection, connection_record, connection_proxy) -> None:
+		with self._lock:
+			self.checked_out += 1
+
+	def _on_checkin(self, dbapi_connection, connection_record) -> None:
+		with self._lock:
+			self.checked_out -= 1
+
+	def _on_invalidate(self, dbapi_connection, connection_record, exception) -> None:
+		with self._lock:
+			self.values[self._sum + 4] += 1
+
+	def _on_close(self, dbapi_connection, connection_record) -> None:
+		connected_at = connection_record.info.pop("mercury_connected_at", None)
+		if connected_at is None:
+			return
+		with self._lock:
+			self.values[self._sum + 5] += monotonic() - connected_at
+			self.values[self._sum + 6] += 1
+
+	def pool_size(self) -> Tuple[Optional[int], int]:
+		"""The configured size of the pool and the overflow connections open beyond it(None and 0 for pools without a size)."""
+		pool = self.engine.pool
+		if not hasattr(pool, "overflow"):
+			return None, 0
+		# QueuePool counts its overflow from -pool_size, it's negative while the pool isn't full yet
+		return pool.size(), max(pool.overflow(), 0)
+
+	def snapshot(self) -> Tuple[List[float], List[int]]:
+		"""Returns the counters and the gauges [checked out, overflow in use, pool size]."""
+		size, overflow = self.pool_size()
+		with self._lock:
+			return list(self.values), [self.checked_out, overflow, size or 0]
+
+	def reset(self) -> None:
+		"""Starts from zero, e.g. in a forked worker that doesn't own the parent's connections."""
+		self._lock = threading.Lock()
+		self.values = [0] * len(self.values)
+		self.checked_out = 0
+		self._warned.clear()
@@ -0,0 +1,222 @@
+from libmercury.security.jwt import JWT
+from .validation import validate
+from .route_management import Route
+from .cache import RouteCache, response_cache
+from .limits import Bulkhead
+from werkzeug import Request, Response
+from typing import Callable, List, Optional
+import inspect
+import threading
+
+# A stage receives the request and the matched url params, and either returns
+# a Response (short-circuiting the chain) or None to hand over to the next stage.
+Stage = Callable[[Request, dict], Optional[Response]]
+
+def get_nested_value(data: dict, key_path: str, default=None):
+	keys = key_path.split('.')
+	for key in keys:
+		if isinstance(data, dict):
+			data = data.get(key, default)
+		else:
+			return default
+	return data
+
+def _error_response(error, message: str, status: int) -> Response:
+	if error:
+		return error()
+	return Response(message, status=status)
+
+def _read_token(request: Request, cookie: Optional[str]) -> Optional[str]:
+	if cookie:
+		return request.cookies.get(cookie)
+	token = request.headers.get("Authorization")
+	if token and token.startswith("Bearer"):
+		token = token[7:]
+	return token
+
+def _auth_stage(controller) -> Stage:
+	authorization = controller._auth
+	cookie = controller._auth_cookie
+	error = controller._error
+	jwt_require = controller._jwt_require
+
+	if controller._negative_auth:
+		# The route is only reachable without a valid token
+		def negative_auth_stage(request: Request, params: dict) -> Optional[Response]:
+			token = _read_token(request, cookie)
+			if token and authorization._verify(token):
+				return _error_response(error, "Error: The token is valid, this route requires the token to be invalid", 400)
+		return negative_auth_stage
+
+	if cookie:
+		missing_message = f"Error: No JWT found in the '{cookie}' cookie"
+	else:
+		missing_message = "Error: No JWT token found in the Autherization header"
+
+	requirement = None
+	if jwt_require:
+		# Resolve the (segment, target[, function]) requirement once
+		target, function = jwt_require[1], None
+		if isinstance(target, tuple):
+			target, function = target[0], target[1]
+		requirement = (jwt_require[0], target, function)
+
+	def auth_stage(request: Request, params: dict) -> Optional[Response]:
+		token = _read_token(request, cookie)
+		if not token:
+			return _error_response(error, missing_message, 400)
+		if not authorization._verify(token):
+			return _error_response(error, "Error: Invalid signature in token", 403)
+		# The response cache keys per-subject routes by the claims of the verified token only
+		request.environ["mercury.verified_token"] = token
+		if requirement is None:
+			return None
+
+		key_path, target, function = requirement
+		try:
+			if function:
+				passed = function(params.get(target))
+			else:
+				passed = get_nested_value(JWT(token).payload, key_path) == params.get(target)
+		except Exception:
+			passed = False
+		if not passed:
+			return _error_response(error, "Error: JWT requirements not met", 403)
+	return auth_stage
+
+def _mimetype_stage(controller) -> Stage:
+	mimetypes = frozenset(controller._mimetypes)
+	error = controller._error
+
+	def mimetype_stage(request: Request, params: dict) -> Optional[Response]:
+		if request.mimetype not in mimetypes:
+			return _error_response(error, "Error: Requested content type is not supported", 400)
+	return mimetype_stage
+
+def _parse_body(request: Request):
+	# Go through the request data, only json and html forms are supported
+	try:
+		return request.json
+	except Exception:
+		return request.form
+
+def _validation_stage(controller) -> Stage:
+	validator = controller._validator
+	error = controller._error
+
+	def validation_stage(request: Request, params: dict) -> Optional[Response]:
+		data = _parse_body(request)
+		if not data:
+			return _error_response(error, "Error: No data provided or data was malformed", 400)
+		return validate(validator, error, data)
+	return validation_stage
+
+def make_response(result) -> Response:
+	"""Turns a generator or iterator returned by a controller into a streamed Response."""
+	if isinstance(result, Response):
+		return result
+	if hasattr(result, "__next__") or hasattr(result, "__anext__"):
+		return Response(result)
+	return result
+
+def compile_stages(controller, route_cache: Optional[RouteCache] = None) -> List[Stage]:
+	"""Builds the checks a route runs before its controller, leaving out the ones it doesn't use."""
+	stages = []
+	if hasattr(controller, "_auth"):
+		stages.append(_auth_stage(controller))
+	if route_cache is not None:
+		# Cached hits still pass auth, but skip validation and the controller
+		stages.append(route_cache.lookup)
+	if hasattr(controller, "_validator"):
+		if getattr(controller, "_mimetypes", None):
+			stages.append(_mimetype_stage(controller))
+		stages.append(_validation_stage(controller))
+	return stages
+
+class CompiledRoute:
+	"""A route resolved into a flat chain of stages followed by its controller."""
+	def __init__(self, route: Route):
+		if not callable(route.handler):
+			raise ValueError(f"Controller '{route.handler}' is not a function")
+		self.route = route
+		self.controller = route.handler
+		self.cache = None
+		# Set by the app when metrics are enabled
+		self.metrics = None
+		if hasattr(route.handler, "_cache_ttl"):
+			self.cache = response_cache.route(route.method, route.url, route.handler)
+		self.stages = tuple(compile_stages(route.handler, self.cache))
+		self.concurrency = None
+		if hasattr(route.handler, "_concurrency_limit"):
+			self.concurrency = Bulkhead(
+				route.handler._concurrency_limit,
+				queue=route.handler._concurrency_queue,
+				timeout=route.handler._concurrency_timeout,
+				retry_after=route.handler._concurrency_retry_after,
+			)
+		# The route decorators wrap controllers in plain functions, look through them
+		self.is_async = inspect.iscoroutinefunction(inspect.unwrap(route.handler))
+		# Controllers yielding from an async def stream a body only an event loop can iterate
+		self.is_async_generator = inspect.isasyncgenfunction(inspect.unwrap(route.handler))
+		self.compress = getattr(route.handler, "_compression", True)
+		self.compression_min_size = getattr(route.handler, "_compression_min_size", None)
+		# Reads of the route skip the replicas, e.g. right after a redirect from a write
+		self.use_primary = getattr(route.handler, "_use_primary", False)
+
+	def run_stages(self, request: Request, params: dict) -> Optional[Response]:
+		for stage in self.stages:
+			response = stage(request, params)
+			if response is not None:
+				return response
+		return None
+
+	def __call__(self, request: Request, params: dict) -> Response:
+		response = self.run_stages(request, params)
+		if response is not None:
+			return response
+		return self.finish(request, self.controller(request, *params.values()))
+
+	def finish(self, request: Request, result) -> Response:
+		"""Turns what the controller returned into the final Response, caching it if the route asks for it."""
+		response = make_response(result)
+		if self.cache is not None:
+			self.cache.store(request, response)
+		return response
+
+	def __repr__(self):
+		return f"CompiledRoute(method={self.route.method}, url='{self.route.url}', stages={len(self.stages)})"
+
+class LazyRoute(CompiledRoute):
+	"""
+	A route known from the manifest whose controller module hasn't been imported yet.
+	The first access to anything compile_route() would have set imports the module and
+	compiles the route in place, so later requests pay nothing for the laziness.
+	"""
+	def __init__(self, route: Route, loader: Callable[[], Callable]):
+		self.route = route
+		self.metrics = None
+		self._loader = loader
+		self._lock = threading.Lock()
+
+	def load(self) -> None:
+		with self._lock:
+			if "stages" in self.__dict__:
+				return
+			metrics = self.metrics
+			CompiledRoute.__init__(self, Route(self.route.method, self.route.url, self._loader()))
+			self.metrics = metrics
+
+	def __getattr__(self, name: str):
+		# Only called for attributes that don't exist yet, i.e. before load()
+		if name.startswith("__") or name in ("_loader", "_lock"):
+			raise AttributeError(name)
+		self.load()
+		return object.__getattribute__(self, name)
+
+	def __repr__(self):
+		if "stages" not in self.__dict__:
+			return f"LazyRoute(method={self.route.method}, url='{self.route.url}')"
+		return super().__repr__()
+
+def compile_route(route: Route) -> CompiledRoute:
+	return CompiledRoute(route)
@@ -0,0 +1,110 @@
+from werkzeug import Response
+from sqlalchemy.orm.query import Query
+from typing import Callable, Iterable, Iterator, List, Optional
+from datetime import date, datetime, time
+from decimal import Decimal
+from uuid import UUID
+import base64
+import csv
+import io
+import json
+
+def json_default(value):
+	"""Serializes the column types json doesn't know about."""
+	if isinstance(value, (datetime, date, time)):
+		return value.isoformat()
+	if isinstance(value, (Decimal, UUID)):
+		return str(value)
+	if isinstance(value, (bytes, bytearray, memoryview)):
+		return base64.b64encode(bytes(value)).decode()
+	raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def _row_reader(row, exclude: List[str]) -> Callable:
+	# Resolved once from the first row, the query returns the same shape for every row
+	if hasattr(row, "__table__"):
+		names = [c.name for c in row.__table__.columns if c.name not in exclude]
+		return lambda row: {name: getattr(row, name) for name in names}
+	if hasattr(row, "_fields"):
+		names = [name for name in row._fields if name not in exclude]
+		return lambda row: {name: row._mapping[name] for name in names}
+	raise TypeError(f"Can't export rows of type {type(row).__name__}, query a model or columns")
+
+def iter_rows(query: Query, batch_size: int = 1000, exclude: List[str] = []) -> Iterator[dict]:
+	"""
+	Yields every row of a query as a dictionary. yield_per fetches batch_size rows at a time and
+	makes the connection use a server-side cursor where the driver supports it, so memory stays
+	flat however many rows there are.
+	"""
+	rows = iter(query.yield_per(batch_size))
+	try:
+		read = None
+		for row in rows:
+			if read is None:
+				read = _row_reader(row, exclude)
+			yield read(row)
+	finally:
+		# Closing early(e.g. the client went away) releases the cursor
+		rows.close()
+
+def _batched(lines: Iterable[str], batch_size: int) -> Iterator[bytes]:
+	batch = []
+	try:
+		for line in lines:
+			batch.append(line)
+			if len(batch) >= batch_size:
+				yield "".join(batch).encode()
+				batch = []
+		if batch:
+			yield "".join(batch).encode()
+	finally:
+		lines.close()
+
+def _export_response(body: Iterator[bytes], mimetype: str, filename: Optional[str]) -> Response:
+	response = Response(body, mimetype=mimetype)
+	if filename:
+		response.headers["Content-Disposition"] = f'attachment; filename="{filename}"'
+	return response
+
+def export_ndjson(query: Query, batch_size: int = 1000, exclude: List[str] = [], filename: Optional[str] = None) -> Response:
+	"""
+	:param query: The query to export, e.g. from query() or paginate()
+	:param batch_size: Rows fetched from the database, and written to the client, at a time
+	:param exclude: Columns left out of the export
+	:param filename: Sends the export as a download with this name
+	Streams the rows of a query as newline delimited json, one object per line.
+	"""
+	dumps = json.JSONEncoder(default=json_default).encode
+	lines = (dumps(row) + "\n" for row in iter_rows(query, batch_size, exclude))
+	return _export_response(_batched(lines, batch_size), "application/x-ndjson", filename)
+
+def export_json(query: Query, batch_size: int = 1000, exclude: List[str] = [], filename: Optional[str] = None) -> Response:
+	"""Streams the rows of a query as a single json array, the parameters are the ones of export_ndjson."""
+	dumps = json.JSONEncoder(default=json_default).encode
+
+	def lines() -> Iterator[str]:
+		yield "["
+		separator = ""
+		for row in iter_rows(query, batch_size, exclude):
+			yield separator + dumps(row)
+			separator = ","
+		yield "]"
+	return _export_response(_batched(lines(), batch_size), "application/json", filename)
+
+def export_csv(query: Query, batch_size: int = 1000, exclude: List[str] = [], filename: Optional[str] = None, header: bool = True) -> Response:
+	"""Streams the rows of a query as csv with a header line, the parameters are the ones of export_ndjson."""
+	def chunks() -> Iterator[bytes]:
+		buffer = io.StringIO()
+		writer = csv.writer(buffer)
+		count = 0
+		for row in iter_rows(query, batch_size, exclude):
+			if count == 0 and header:
+				writer.writerow(row.keys())
+			writer.writerow(row.values())
+			count += 1
+			if count % batch_size == 0:
+				yield buffer.getvalue().encode()
+				buffer.seek(0)
+				buffer.truncate()
+		if buffer.tell():
+			yield buffer.getvalue().encode()
+	return _export_response(chunks(), "text/csv", filename)
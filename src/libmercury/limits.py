@@ -0,0 +1,123 @@
+from werkzeug import Response
+from collections import deque
+from typing import Optional
+from time import perf_counter
+import asyncio
+import threading
+
+class _Waiter:
+	"""A request queued by acquire_async, release() hands it a slot by resolving its future on its event loop."""
+	__slots__ = ("loop", "future", "granted")
+
+	def __init__(self, loop: asyncio.AbstractEventLoop) -> None:
+		self.loop = loop
+		self.future = loop.create_future()
+		# Set under the bulkhead's lock once the slot is its, the future may only resolve later
+		self.granted = False
+
+def _wake(future: asyncio.Future) -> None:
+	if not future.done():
+		future.set_result(None)
+
+class Bulkhead:
+	"""
+	:param limit: Requests allowed to run at the same time
+	:param queue: Requests allowed to wait for a free slot, the ones beyond it are rejected right away
+	:param timeout: Seconds a queued request waits for a slot before it is rejected
+	:param retry_after: Seconds sent in the Retry-After header of rejections
+	Caps how many requests run at once, either for the whole app(WSGIApp(concurrency=...))
+	or for a single route(useConcurrencyLimit). Rejected requests fail fast with a 503.
+	"""
+	def __init__(self, limit: int, queue: int = 0, timeout: float = 1.0, retry_after: int = 1) -> None:
+		if limit < 1:
+			raise ValueError("A concurrency limit must allow at least one request")
+		self.limit = limit
+		self.queue = queue
+		self.timeout = timeout
+		self.retry_after = retry_after
+		self.active = 0
+		self.waiting = 0
+		self.rejected = 0
+		self._condition = threading.Condition()
+		# The requests queued by acquire_async, in the order they arrived
+		self._waiters = deque()
+
+	def acquire(self) -> Optional[float]:
+		"""Takes a slot, returning the seconds spent waiting for it, or None when the request has to be rejected."""
+		with self._condition:
+			if self.active < self.limit:
+				self.active += 1
+				return 0.0
+			if self.waiting >= self.queue or self.timeout <= 0:
+				self.rejected += 1
+				return None
+			self.waiting += 1
+			start = perf_counter()
+			try:
+				while self.active >= self.limit:
+					remaining = self.timeout - (perf_counter() - start)
+					if remaining <= 0:
+						self.rejected += 1
+						return None
+					self._condition.wait(remaining)
+			finally:
+				self.waiting -= 1
+			self.active += 1
+			return perf_counter() - start
+
+	async def acquire_async(self) -> Optional[float]:
+		"""Like acquire, without blocking the event loop while queued. Queued requests get the slots in the order they arrived."""
+		with self._condition:
+			if self.active < self.limit:
+				self.active += 1
+				return 0.0
+			if self.waiting >= self.queue or self.timeout <= 0:
+				self.rejected += 1
+				return None
+			waiter = _Waiter(asyncio.get_running_loop())
+			self._waiters.append(waiter)
+			self.waiting += 1
+		start = perf_counter()
+		cancelled = True
+		try:
+			await asyncio.wait((waiter.future,), timeout=self.timeout)
+			cancelled = False
+		finally:
+			with self._condition:
+				self.waiting -= 1
+				granted = waiter.granted
+				if not granted:
+					if waiter in self._waiters:
+						self._waiters.remove(waiter)
+					if not cancelled:
+						self.rejected += 1
+			if granted and cancelled:
+				# The slot was handed over just as the request was cancelled, pass it on
+				self.release()
+		if not granted:
+			return None
+		return perf_counter() - start
+
+	def release(self) -> None:
+		with self._condition:
+			# A queued async request takes the slot over directly, so a request arriving meanwhile can't jump the queue
+			while self._waiters:
+				waiter = self._waiters.popleft()
+				try:
+					# Slots are released from threads as well
+					waiter.loop.call_soon_threadsafe(_wake, waiter.future)
+				except RuntimeError:
+					# Its event loop is closed, nobody is waiting anymore
+					continue
+				waiter.granted = True
+				return
+			self.active -= 1
+			self._condition.notify()
+
+	def reject(self) -> Response:
+		response = Response("Error: The server is busy, try again later", status=503)
+		response.headers["Retry-After"] = str(self.retry_after)
+		return response
+
+	def stats(self) -> dict:
+		return {"limit": self.limit, "active": self.active, "waiting": self.waiting, "rejected": self.rejected}
@@ -0,0 +1,133 @@
+from typing import Dict, List, Optional, Tuple
+import ast
+import hashlib
+import json
+import os
+
+MANIFEST_VERSION = 1
+
+# Decorator name -> http method, `route` takes the method as its first argument
+ROUTE_DECORATORS = {
+	"GETRoute": "GET",
+	"POSTRoute": "POST",
+	"DELETERoute": "DELETE",
+	"PATCHRoute": "PATCH",
+	"PUTRoute": "PUT",
+	"OPTIONSRoute": "OPTIONS",
+	"HEADRoute": "HEAD",
+	"CONTROLRoute": "CONTROL",
+	"TRACERoute": "TRACE",
+	"route": None,
+}
+
+def _file_hash(path: str) -> str:
+	with open(path, "rb") as f:
+		return hashlib.sha256(f.read()).hexdigest()
+
+def _decorator_name(node: ast.expr) -> Optional[str]:
+	if isinstance(node, ast.Name):
+		return node.id
+	if isinstance(node, ast.Attribute):
+		return node.attr
+	return None
+
+def _literal(node: ast.expr):
+	try:
+		return ast.literal_eval(node)
+	except ValueError:
+		return None
+
+def scan_controller(path: str, class_name: str) -> dict:
+	"""
+	Reads the route decorators of a controller class without importing its module.
+	Controllers the scan can't be sure about(inherited methods, urls that aren't literals)
+	are marked eager, the app imports those at startup like before.
+	"""
+	with open(path, "rb") as f:
+		tree = ast.parse(f.read(), filename=path)
+	controller = next((node for node in tree.body if isinstance(node, ast.ClassDef) and node.name == class_name), None)
+	if controller is None:
+		return {"eager": True, "routes": []}
+
+	eager = any(not (isinstance(base, ast.Name) and base.id == "object") for base in controller.bases)
+	routes = []
+	for node in controller.body:
+		if not isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+			continue
+		for decorator in node.decorator_list:
+			if not isinstance(decorator, ast.Call):
+				continue
+			name = _decorator_name(decorator.func)
+			if name not in ROUTE_DECORATORS:
+				continue
+			args = [_literal(arg) for arg in decorator.args]
+			if ROUTE_DECORATORS[name] is None:
+				args = args if len(args) == 2 else [None, None]
+				method, url = args
+			else:
+				method, url = ROUTE_DECORATORS[name], args[0] if args else None
+			if not isinstance(method, str) or not isinstance(url, str):
+				eager = True
+				continue
+			routes.append([method, url, node.name])
+	return {"eager": eager, "routes": routes}
+
+class RouteManifest:
+	"""
+	:param path: The file the scanned routes are cached in
+	Caches the routes of every controller file, a file is only scanned again when its
+	mtime or size changed and its content hash no longer matches.
+	"""
+	def __init__(self, path: str = ".mercury_manifest.json") -> None:
+		self.path = path
+		self.controllers: Dict[str, dict] = {}
+		self.changed = False
+		self._load()
+
+	def _load(self) -> None:
+		try:
+			with open(self.path) as f:
+				data = json.load(f)
+		except (OSError, ValueError):
+			return
+		if data.get("version") == MANIFEST_VERSION:
+			self.controllers = data.get("controllers", {})
+
+	def save(self) -> None:
+		if not self.changed:
+			return
+		try:
+			with open(self.path + ".tmp", "w") as f:
+				json.dump({"version": MANIFEST_VERSION, "controllers": self.controllers}, f)
+			os.replace(self.path + ".tmp", self.path)
+		except OSError:
+			# A read-only deployment just scans on every start
+			return
+		self.changed = False
+
+	def entry(self, path: str, class_name: str) -> Tuple[dict, bool]:
+		"""Returns the manifest entry of a controller file, and whether it had to be scanned."""
+		stat = os.stat(path)
+		entry = self.controllers.get(path)
+		if entry is not None and entry["class"] == class_name:
+			if entry["mtime"] == stat.st_mtime_ns and entry["size"] == stat.st_size:
+				return entry, False
+			# A touched but unchanged file(e.g. after a checkout) keeps its routes
+			digest = _file_hash(path)
+			if entry["hash"] == digest:
+				entry["mtime"], entry["size"] = stat.st_mtime_ns, stat.st_size
+				self.changed = True
+				return entry, False
+		else:
+			digest = _file_hash(path)
+
+		entry = {"class": class_name, "mtime": stat.st_mtime_ns, "size": stat.st_size, "hash": digest}
+		entry.update(scan_controller(path, class_name))
+		self.controllers[path] = entry
+		self.changed = True
+		return entry, True
+
+	def prune(self, paths: List[str]) -> None:
+		for path in set(self.controllers) - set(paths):
+			del self.controllers[path]
+			self.changed = True
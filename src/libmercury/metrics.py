@@ -0,0 +1,418 @@
+from colorama import Fore, Style
+from .db.connection import connection
+from .db.telemetry import POOL_BUCKETS
+from bisect import bisect_left
+from collections import deque
+from typing import Dict, Iterable, List, Optional, Tuple
+import json
+import os
+import threading
+import time
+import weakref
+from time import perf_counter
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATUS_CLASSES = ("1xx", "2xx", "3xx", "4xx", "5xx")
+UNMATCHED = "(unmatched)"
+# Bumped whenever the layout of RouteMetrics.values changes, so workers skip files in an older layout
+METRICS_VERSION = 3
+# The counters of exited workers, folded into one file so the directory doesn't grow with every recycled worker
+RETIRED = "retired.json"
+# Pids folded into the retired file, kept so a scrape racing the removal of a worker's file doesn't count it twice
+_RETIRED_PIDS = 1024
+
+# Every open Metrics of the process, forked children reset them through one hook rather than one per instance
+_instances = weakref.WeakSet()
+
+def _after_fork() -> None:
+	for metrics in list(_instances):
+		metrics._after_fork()
+
+if hasattr(os, "register_at_fork"):
+	os.register_at_fork(after_in_child=_after_fork)
+
+def _read(path: str) -> Optional[dict]:
+	try:
+		with open(path) as f:
+			return json.load(f)
+	except (OSError, ValueError):
+		return None
+
+def retire_process(directory: str, pid: int) -> None:
+	"""Folds the counters an exited worker left in the directory into the retired file and removes the worker's file."""
+	path = os.path.join(directory, f"{pid}.json")
+	data = _read(path)
+	if data is None:
+		return
+	retired_path = os.path.join(directory, RETIRED)
+	retired = _read(retired_path)
+	if retired is None or retired.get("version") != data.get("version") or retired.get("bounds") != data.get("bounds"):
+		# Files in another layout can't be merged, the workers of the current one skip them anyway
+		retired = {"version": data.get("version"), "pid": None, "bounds": data.get("bounds"), "routes": [], "pools": [], "pids": []}
+	routes = {(method, route): values for method, route, values, inflight in retired["routes"]}
+	for method, route, values, inflight in data.get("routes", ()):
+		current = routes.get((method, route))
+		routes[(method, route)] = values if current is None else [a + b for a, b in zip(current, values)]
+	pools = {name: values for name, values, gauges in retired["pools"]}
+	gauge_count = {name: len(gauges) for name, values, gauges in retired["pools"]}
+	for name, values, gauges in data.get("pools", ()):
+		current = pools.get(name)
+		pools[name] = values if current is None else [a + b for a, b in zip(current, values)]
+		gauge_count[name] = len(gauges)
+	# Nothing of an exited worker is in flight or checked out anymore
+	retired["routes"] = [[method, route, values, 0] for (method, route), values in routes.items()]
+	retired["pools"] = [[name, values, [0] * gauge_count[name]] for name, values in pools.items()]
+	retired["pids"] = (retired["pids"] + [pid])[-_RETIRED_PIDS:]
+	try:
+		with open(retired_path + ".tmp", "w") as f:
+			json.dump(retired, f)
+		os.replace(retired_path + ".tmp", retired_path)
+		os.remove(path)
+	except OSError as e:
+		print(f"{Fore.YELLOW}[WARNING] Could not fold the metrics of worker {pid} into {retired_path}: {e}{Style.RESET_ALL}")
+
+def _escape(value: str) -> str:
+	return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_bound(bound: float) -> str:
+	return repr(float(bound))
+
+class RouteMetrics:
+	"""
+	Counters of a single route template, laid out in one flat list:
+	[requests, 1xx..5xx, latency buckets..., +Inf bucket, latency sum, request bytes, response bytes,
+	 queue wait sum, queued requests, rejected requests, database queries, database time]
+	"""
+	__slots__ = ("method", "route", "values", "inflight", "_buckets", "_sum")
+
+	def __init__(self, method: str, route: str, bucket_count: int) -> None:
+		self.method = method
+		self.route = route
+		self._buckets = 1 + len(STATUS_CLASSES)
+		self._sum = self._buckets + bucket_count + 1
+		self.values = [0] * (self._sum + 8)
+		self.inflight = 0
+
+	def add(self, status: int, bucket: int, duration: float, request_size: int, response_size: int) -> None:
+		values = self.values
+		self.inflight -= 1
+		values[0] += 1
+		values[min(max(status // 100, 1), 5)] += 1
+		values[self._buckets + bucket] += 1
+		values[self._sum] += duration
+		values[self._sum + 1] += request_size
+		values[self._sum + 2] += response_size
+
+	def add_wait(self, wait: float, rejected: bool) -> None:
+		values = self.values
+		values[self._sum + 3] += wait
+		values[self._sum + 4] += 1
+		if rejected:
+			values[self._sum + 5] += 1
+
+	def add_sql(self, queries: int, duration: float) -> None:
+		values = self.values
+		values[self._sum + 6] += queries
+		values[self._sum + 7] += duration
+
+class Metrics:
+	"""
+	:param path: The url the Prometheus text exposition is served on, None disables the endpoint
+	:param buckets: Upper bounds in seconds of the latency histogram
+	:param directory: Folder shared by the worker processes of a server, each one writes its counters there
+	  so any worker can answer a scrape with the totals(defaults to the MERCURY_METRICS_DIR environment variable)
+	:param flush_interval: Seconds between two aggregations of the pending observations(and writes to the directory)
+	:param max_pending: Observations kept before the request thread has to fold them into the counters itself
+	Records request count, status classes, latency, request/response sizes and in-flight requests per route template.
+	Recording only appends a tuple to a deque, which is atomic, the aggregation happens when metrics are read.
+	The telemetry of the database connection pools is exposed alongside, and the statements run per route when the app instruments them.
+	"""
+	def __init__(self, path: Optional[str] = "/metrics", buckets: Iterable[float] = DEFAULT_BUCKETS, directory: Optional[str] = None, flush_interval: float = 1.0, max_pending: int = 100000) -> None:
+		self.path = path
+		self.bounds = tuple(sorted(buckets))
+		self.directory = directory or os.environ.get("MERCURY_METRICS_DIR")
+		self.flush_interval = flush_interval
+		self.max_pending = max_pending
+		self.routes: Dict[Tuple[str, str], RouteMetrics] = {}
+		self._pending = deque()
+		self._append = self._pending.append
+		self._lock = threading.Lock()
+		self._pid = os.getpid()
+		self._closed = threading.Event()
+		self._thread = None
+		# Requests that matched no route share one series, so scanners can't blow up the label cardinality
+		self.unmatched = self.route("*", UNMATCHED)
+		if self.directory:
+			os.makedirs(self.directory, exist_ok=True)
+		self._start_flusher()
+		_instances.add(self)
+
+	def route(self, method: str, route: str) -> RouteMetrics:
+		with self._lock:
+			route_metrics = self.routes.get((method, route))
+			if route_metrics is None:
+				route_metrics = RouteMetrics(method, route, len(self.bounds))
+				self.routes[(method, route)] = route_metrics
+			return route_metrics
+
+	def begin(self, route_metrics: RouteMetrics) -> None:
+		self._append((route_metrics, 0, 0.0, 0, 0))
+
+	def record(self, route_metrics: RouteMetrics, status: int, start: float, request_size: int, response_size: int) -> None:
+		self._append((route_metrics, status, perf_counter() - start, request_size, response_size))
+		if len(self._pending) > self.max_pending:
+			self.drain()
+
+	def record_wait(self, route_metrics: RouteMetrics, wait: float, rejected: bool = False) -> None:
+		"""Records the time a request spent queued(for a worker thread or a concurrency limit slot) before it ran or was rejected."""
+		self._append((route_metrics, -2 if rejected else -1, wait, 0, 0))
+
+	def record_sql(self, route_metrics: RouteMetrics, queries: int, duration: float) -> None:
+		"""Records the statements a request ran and the time the database took for them."""
+		self._append((route_metrics, -3, duration, queries, 0))
+
+	def drain(self) -> None:
+		"""Folds the pending observations into the per-route counters."""
+		pending = self._pending
+		bounds = self.bounds
+		with self._lock:
+			while True:
+				try:
+					route_metrics, status, duration, request_size, response_size = pending.popleft()
+				except IndexError:
+					return
+				if not status:
+					route_metrics.inflight += 1
+				elif status == -3:
+					route_metrics.add_sql(request_size, duration)
+				elif status < 0:
+					route_metrics.add_wait(duration, status == -2)
+				else:
+					route_metrics.add(status, bisect_left(bounds, duration), duration, request_size, response_size)
+
+	def snapshot(self) -> Dict[Tuple[str, str], Tuple[List[float], int]]:
+		self.drain()
+		with self._lock:
+			return {key: (list(route_metrics.values), route_metrics.inflight) for key, route_metrics in self.routes.items()}
+
+	# Multi-process aggregation
+	def _file(self, pid: int) -> str:
+		return os.path.join(self.directory, f"{pid}.json")
+
+	def _after_fork(self) -> None:
+		# Workers start from zero and need their own flusher, threads don't survive a fork
+		self._pid = os.getpid()
+		self._lock = threading.Lock()
+		self._closed = threading.Event()
+		self._pending.clear()
+		for route_metrics in self.routes.values():
+			route_metrics.values = [0] * len(route_metrics.values)
+			route_metrics.inflight = 0
+		self._start_flusher()
+
+	def _start_flusher(self) -> None:
+		self._thread = threading.Thread(target=self._flush_loop, name="mercury-metrics", daemon=True)
+		self._thread.start()
+
+	def _flush_loop(self) -> None:
+		pid = self._pid
+		while pid == self._pid and not self._closed.wait(self.flush_interval):
+			if self.directory:
+				self.flush()
+			else:
+				self.drain()
+
+	def close(self) -> None:
+		"""Stops the flusher thread, forked children of the process no longer restart it. Recording and flush() still work."""
+		_instances.discard(self)
+		self._closed.set()
+		thread = self._thread
+		if thread is not None and thread is not threading.current_thread():
+			thread.join(self.flush_interval + 1.0)
+
+	def flush(self) -> None:
+		routes = [[method, route, values, inflight] for (method, route), (values, inflight) in self.snapshot().items()]
+		path = self._file(self._pid)
+		pools = [[name, values, gauges] for name, (values, gauges) in self.pool_snapshot().items()]
+		with open(path + ".tmp", "w") as f:
+			json.dump({"version": METRICS_VERSION, "pid": self._pid, "bounds": self.bounds, "routes": routes, "pools": pools}, f)
+		os.replace(path + ".tmp", path)
+
+	def _layout_matches(self, data: dict) -> bool:
+		return tuple(data.get("bounds", ())) == self.bounds and data.get("version") == METRICS_VERSION
+
+	def _other_processes(self) -> Iterable[Tuple[bool, dict]]:
+		# The retired file is read first, a worker folded into it after that still has its own file
+		retired = _read(os.path.join(self.directory, RETIRED))
+		retired_pids = set()
+		if retired is not None and self._layout_matches(retired):
+			retired_pids.update(retired.get("pids", ()))
+			yield False, retired
+		for name in os.listdir(self.directory):
+			if not name.endswith(".json"):
+				continue
+			try:
+				pid = int(name[:-5])
+			except ValueError:
+				continue
+			if pid == self._pid or pid in retired_pids:
+				continue
+			data = _read(os.path.join(self.directory, name))
+			if data is None or not self._layout_matches(data):
+				continue
+			yield self._alive(pid), data
+
+	def _alive(self, pid: int) -> bool:
+		try:
+			os.kill(pid, 0)
+			return True
+		except ProcessLookupError:
+			return False
+		except PermissionError:
+			return True
+
+	def collect(self) -> Dict[Tuple[str, str], Tuple[List[float], int]]:
+		"""Returns the totals per (method, route) of this process and, with a directory, of every other worker."""
+		totals = self.snapshot()
+		if self.directory:
+			for alive, data in self._other_processes():
+				for method, route, values, inflight in data["routes"]:
+					current = totals.get((method, route))
+					if current is None:
+						totals[(method, route)] = (values, inflight if alive else 0)
+						continue
+					merged = [a + b for a, b in zip(current[0], values)]
+					# Counters of exited workers still count, their in-flight requests don't
+					totals[(method, route)] = (merged, current[1] + (inflight if alive else 0))
+		return totals
+
+	def pool_snapshot(self) -> Dict[str, Tuple[List[float], List[int]]]:
+		"""Returns the counters and gauges of every connection pool of this process, keyed by the pool's database url."""
+		pools = {}
+		for instance in list(connection.instances):
+			for telemetry in instance.telemetries:
+				values, gauges = telemetry.snapshot()
+				current = pools.get(telemetry.name)
+				if current is not None:
+					values = [a + b for a, b in zip(current[0], values)]
+					gauges = [a + b for a, b in zip(current[1], gauges)]
+				pools[telemetry.name] = (values, gauges)
+		return pools
+
+	def collect_pools(self) -> Dict[str, Tuple[List[float], List[int]]]:
+		"""Returns the pool telemetry of this process and, with a directory, of every other worker."""
+		totals = self.pool_snapshot()
+		if self.directory:
+			for alive, data in self._other_processes():
+				for name, values, gauges in data.get("pools", ()):
+					if not alive:
+						# Connections of exited workers are gone, their counters still count
+						gauges = [0] * len(gauges)
+					current = totals.get(name)
+					if current is not None:
+						values = [a + b for a, b in zip(current[0], values)]
+						gauges = [a + b for a, b in zip(current[1], gauges)]
+					totals[name] = (values, gauges)
+		return totals
+
+	def quantile(self, method: str, route: str, q: float) -> Optional[float]:
+		"""Estimates a latency quantile(e.g. 0.95) from the histogram, like Prometheus' histogram_quantile."""
+		values = self.collect().get((method, route))
+		if values is None or not values[0][0]:
+			return None
+		values = values[0]
+		offset = 1 + len(STATUS_CLASSES)
+		buckets = values[offset:offset + len(self.bounds) + 1]
+		rank = q * values[0]
+		seen = 0
+		for index, count in enumerate(buckets):
+			if count and seen + count >= rank:
+				if index == len(self.bounds):
+					return self.bounds[-1]
+				lower = self.bounds[index - 1] if index else 0.0
+				upper = self.bounds[index]
+				return lower + (upper - lower) * (rank - seen) / count
+			seen += count
+		return self.bounds[-1]
+
+	def exposition(self) -> str:
+		"""Renders the collected metrics in the Prometheus text format."""
+		totals = self.collect()
+		offset = 1 + len(STATUS_CLASSES)
+		sum_index = offset + len(self.bounds) + 1
+		sections = {
+			"requests": ["# HELP mercury_requests_total Requests handled per route.", "# TYPE mercury_requests_total counter"],
+			"responses": ["# HELP mercury_responses_total Responses per route and status class.", "# TYPE mercury_responses_total counter"],
+			"duration": ["# HELP mercury_request_duration_seconds Time spent handling a request.", "# TYPE mercury_request_duration_seconds histogram"],
+			"request_size": ["# HELP mercury_request_size_bytes_total Request body bytes received.", "# TYPE mercury_request_size_bytes_total counter"],
+			"response_size": ["# HELP mercury_response_size_bytes_total Response body bytes sent, when known upfront.", "# TYPE mercury_response_size_bytes_total counter"],
+			"inflight": ["# HELP mercury_requests_in_flight Requests being handled right now.", "# TYPE mercury_requests_in_flight gauge"],
+			"queue_wait": ["# HELP mercury_queue_wait_seconds Time requests spent queued before running or being rejected.", "# TYPE mercury_queue_wait_seconds summary"],
+			"rejected": ["# HELP mercury_requests_rejected_total Requests shed by a concurrency limit or a full queue.", "# TYPE mercury_requests_rejected_total counter"],
+			"db_queries": ["# HELP mercury_db_queries_total Statements run by the requests of a route.", "# TYPE mercury_db_queries_total counter"],
+			"db_time": ["# HELP mercury_db_time_seconds_total Time the database took for the statements of a route's requests.", "# TYPE mercury_db_time_seconds_total counter"],
+		}
+		for (method, route), (values, inflight) in sorted(totals.items()):
+			labels = f'method="{_escape(method)}",route="{_escape(route)}"'
+			sections["requests"].append(f"mercury_requests_total{{{labels}}} {values[0]}")
+			for index, status in enumerate(STATUS_CLASSES):
+				if values[1 + index]:
+					sections["responses"].append(f'mercury_responses_total{{{labels},status="{status}"}} {values[1 + index]}')
+			cumulative = 0
+			for index, bound in enumerate(self.bounds):
+				cumulative += values[offset + index]
+				sections["duration"].append(f'mercury_request_duration_seconds_bucket{{{labels},le="{_format_bound(bound)}"}} {cumulative}')
+			sections["duration"].append(f'mercury_request_duration_seconds_bucket{{{labels},le="+Inf"}} {values[0]}')
+			sections["duration"].append(f"mercury_request_duration_seconds_sum{{{labels}}} {values[sum_index]}")
+			sections["duration"].append(f"mercury_request_duration_seconds_count{{{labels}}} {values[0]}")
+			sections["request_size"].append(f"mercury_request_size_bytes_total{{{labels}}} {values[sum_index + 1]}")
+			sections["response_size"].append(f"mercury_response_size_bytes_total{{{labels}}} {values[sum_index + 2]}")
+			sections["inflight"].append(f"mercury_requests_in_flight{{{labels}}} {inflight}")
+			if values[sum_index + 4]:
+				sections["queue_wait"].append(f"mercury_queue_wait_seconds_sum{{{labels}}} {values[sum_index + 3]}")
+				sections["queue_wait"].append(f"mercury_queue_wait_seconds_count{{{labels}}} {values[sum_index + 4]}")
+			if values[sum_index + 5]:
+				sections["rejected"].append(f"mercury_requests_rejected_total{{{labels}}} {values[sum_index + 5]}")
+			if values[sum_index + 6]:
+				sections["db_queries"].append(f"mercury_db_queries_total{{{labels}}} {values[sum_index + 6]}")
+				sections["db_time"].append(f"mercury_db_time_seconds_total{{{labels}}} {values[sum_index + 7]}")
+		lines = [line for section in sections.values() for line in section]
+		return "\n".join(lines + self._pool_exposition(self.collect_pools())) + "\n"
+
+	def _pool_exposition(self, pools: Dict[str, Tuple[List[float], List[int]]]) -> List[str]:
+		if not pools:
+			return []
+		total = len(POOL_BUCKETS) + 1
+		sections = {
+			"checked_out": ["# HELP mercury_db_pool_checked_out Connections checked out of the pool.", "# TYPE mercury_db_pool_checked_out gauge"],
+			"overflow": ["# HELP mercury_db_pool_overflow Connections open beyond the pool size.", "# TYPE mercury_db_pool_overflow gauge"],
+			"size": ["# HELP mercury_db_pool_size Configured size of the pool.", "# TYPE mercury_db_pool_size gauge"],
+			"wait": ["# HELP mercury_db_pool_checkout_wait_seconds Time spent waiting for a connection from the pool.", "# TYPE mercury_db_pool_checkout_wait_seconds histogram"],
+			"timeouts": ["# HELP mercury_db_pool_checkout_timeouts_total Checkouts that gave up waiting for a connection.", "# TYPE mercury_db_pool_checkout_timeouts_total counter"],
+			"connects": ["# HELP mercury_db_pool_connections_opened_total Connections opened to the database.", "# TYPE mercury_db_pool_connections_opened_total counter"],
+			"invalidations": ["# HELP mercury_db_pool_invalidations_total Connections invalidated, e.g. after the database dropped them.", "# TYPE mercury_db_pool_invalidations_total counter"],
+			"lifetime": ["# HELP mercury_db_pool_connection_lifetime_seconds Time connections stayed open until they were closed.", "# TYPE mercury_db_pool_connection_lifetime_seconds summary"],
+		}
+		for name, (values, gauges) in sorted(pools.items()):
+			labels = f'pool="{_escape(name)}"'
+			sections["checked_out"].append(f"mercury_db_pool_checked_out{{{labels}}} {gauges[0]}")
+			sections["overflow"].append(f"mercury_db_pool_overflow{{{labels}}} {gauges[1]}")
+			sections["size"].append(f"mercury_db_pool_size{{{labels}}} {gauges[2]}")
+			cumulative = 0
+			for index, bound in enumerate(POOL_BUCKETS):
+				cumulative += values[index]
+				sections["wait"].append(f'mercury_db_pool_checkout_wait_seconds_bucket{{{labels},le="{_format_bound(bound)}"}} {cumulative}')
+			sections["wait"].append(f'mercury_db_pool_checkout_wait_seconds_bucket{{{labels},le="+Inf"}} {values[total + 1]}')
+			sections["wait"].append(f"mercury_db_pool_checkout_wait_seconds_sum{{{labels}}} {values[total]}")
+			sections["wait"].append(f"mercury_db_pool_checkout_wait_seconds_count{{{labels}}} {values[total + 1]}")
+			sections["timeouts"].append(f"mercury_db_pool_checkout_timeouts_total{{{labels}}} {values[total + 2]}")
+			sections["connects"].append(f"mercury_db_pool_connections_opened_total{{{labels}}} {values[total + 3]}")
+			sections["invalidations"].append(f"mercury_db_pool_invalidations_total{{{labels}}} {values[total + 4]}")
+			sections["lifetime"].append(f"mercury_db_pool_connection_lifetime_seconds_sum{{{labels}}} {values[total + 5]}")
+			sections["lifetime"].append(f"mercury_db_pool_connection_lifetime_seconds_count{{{labels}}} {values[total + 6]}")
+		return [line for section in sections.values() for line in section]
+
+	def __call__(self, environ: dict, start_response) -> Iterable[bytes]:
+		body = self.exposition().encode()
+		start_response("200 OK", [("Content-Type", "text/plain; version=0.0.4; charset=utf-8"), ("Content-Length", str(len(body)))])
+		return [body]
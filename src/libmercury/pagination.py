@@ -0,0 +1,202 @@
+from colorama import Fore, Style
+from .serialization import serializer_for
+from werkzeug import Response
+from sqlalchemy import and_, or_
+from sqlalchemy.orm.query import Query
+from typing import Any, Iterable, List, Optional, Tuple, Union
+from datetime import date, datetime, time
+from decimal import Decimal
+from uuid import UUID
+import base64
+import hashlib
+import hmac
+import json
+import os
+
+class InvalidCursor(ValueError):
+	"""Raised for cursors that were tampered with, or that belong to another ordering."""
+
+# Used when neither a secret nor MERCURY_CURSOR_SECRET is given, cursors then only survive as long as the process
+_process_secret = os.urandom(32)
+_warned = False
+
+def _secret(secret: Optional[Union[str, bytes]]) -> bytes:
+	global _warned
+	secret = secret or os.environ.get("MERCURY_CURSOR_SECRET")
+	if not secret:
+		if not _warned:
+			_warned = True
+			print(f"{Fore.YELLOW}[WARNING] MERCURY_CURSOR_SECRET is not set, cursors are signed with a secret of this process only. "
+				f"Behind a load balancer, on another host or after a deploy they are rejected, set the variable or pass secret=...{Style.RESET_ALL}")
+		secret = _process_secret
+	return secret.encode() if isinstance(secret, str) else secret
+
+def _b64encode(data: bytes) -> str:
+	return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+def _b64decode(data: str) -> bytes:
+	return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+# Key values keep their type through the cursor, so they compare against their column the same way again
+def _encode_value(value: Any) -> Any:
+	if isinstance(value, datetime):
+		return {"dt": value.isoformat()}
+	if isinstance(value, date):
+		return {"d": value.isoformat()}
+	if isinstance(value, time):
+		return {"t": value.isoformat()}
+	if isinstance(value, Decimal):
+		return {"dec": str(value)}
+	if isinstance(value, UUID):
+		return {"uuid": str(value)}
+	if isinstance(value, bytes):
+		return {"b": _b64encode(value)}
+	return value
+
+def _decode_value(value: Any) -> Any:
+	if not isinstance(value, dict):
+		return value
+	kind, data = next(iter(value.items()))
+	decoders = {
+		"dt": datetime.fromisoformat,
+		"d": date.fromisoformat,
+		"t": time.fromisoformat,
+		"dec": Decimal,
+		"uuid": UUID,
+		"b": _b64decode,
+	}
+	return decoders[kind](data)
+
+def encode_cursor(payload: dict, secret: Optional[Union[str, bytes]] = None) -> str:
+	data = _b64encode(json.dumps(payload, separators=(",", ":")).encode())
+	signature = _b64encode(hmac.new(_secret(secret), data.encode(), hashlib.sha256).digest()[:16])
+	return f"{data}.{signature}"
+
+def decode_cursor(cursor: str, secret: Optional[Union[str, bytes]] = None) -> dict:
+	parts = cursor.split(".")
+	if len(parts) != 2:
+		raise InvalidCursor("Malformed cursor")
+	data, signature = parts
+	expected = _b64encode(hmac.new(_secret(secret), data.encode(), hashlib.sha256).digest()[:16])
+	if not hmac.compare_digest(signature, expected):
+		raise InvalidCursor("Invalid cursor signature")
+	try:
+		return json.loads(_b64decode(data))
+	except ValueError as e:
+		raise InvalidCursor("Malformed cursor") from e
+
+def _ordering(model, order_by: Optional[Iterable[str]]) -> List[Tuple[str, bool]]:
+	"""Resolves ['-created', 'name'] into (attribute, descending) pairs, ending with the primary key so the order is unique."""
+	primary_keys = [model.__mapper__.get_property_by_column(column).key for column in model.__table__.primary_key.columns]
+	ordering = []
+	for name in order_by or ():
+		descending = name.startswith("-")
+		ordering.append((name.lstrip("-"), descending))
+	names = {name for name, _ in ordering}
+	# Ties on the user's ordering are broken by the primary key, in the direction of the last column
+	direction = ordering[-1][1] if ordering else False
+	ordering.extend((key, direction) for key in primary_keys if key not in names)
+	return ordering
+
+def _after(model, ordering: List[Tuple[str, bool]], values: list):
+	# (a, b) > (x, y) spelled out as a > x OR (a = x AND b > y), which works with mixed directions on every dialect
+	clauses = []
+	for index, (name, descending) in enumerate(ordering):
+		column = getattr(model, name)
+		equal = [getattr(model, previous) == values[position] for position, (previous, _) in enumerate(ordering[:index])]
+		step = column < values[index] if descending else column > values[index]
+		clauses.append(and_(*equal, step))
+	return or_(*clauses)
+
+class Page:
+	"""A page of keyset pagination: its items and the opaque cursors leading to its neighbours."""
+	def __init__(self, items: list, per_page: int, next_cursor: Optional[str], previous_cursor: Optional[str]) -> None:
+		self.items = items
+		self.per_page = per_page
+		self.next_cursor = next_cursor
+		self.previous_cursor = previous_cursor
+
+	@property
+	def has_next(self) -> bool:
+		return self.next_cursor is not None
+
+	@property
+	def has_previous(self) -> bool:
+		return self.previous_cursor is not None
+
+	def envelope(self, exclude: List[str] = [], include: Optional[List[str]] = None) -> dict:
+		"""The page as {"data": [...], "pagination": {...}}, ready for json."""
+		data = []
+		if self.items:
+			data = serializer_for(type(self.items[0]), exclude, include).to_dicts(self.items)
+		return {
+			"data": data,
+			"pagination": {
+				"per_page": self.per_page,
+				"next": self.next_cursor,
+				"previous": self.previous_cursor,
+			},
+		}
+
+	def __repr__(self):
+		return f"Page(items={len(self.items)}, has_next={self.has_next}, has_previous={self.has_previous})"
+
+def keyset_page(base: Query, model, cursor: Optional[str] = None, per_page: int = 10, order_by: Optional[Iterable[str]] = None,
+		secret: Optional[Union[str, bytes]] = None) -> Page:
+	"""
+	:param base: The filtered query to paginate, e.g. query(User, active=True)
+	:param model: The model the query returns
+	:param cursor: The next or previous cursor of the page before, None for the first page
+	:param per_page: Items per page
+	:param order_by: Attribute names to order by, prefixed with '-' for descending order(defaults to the primary key)
+	:param secret: Key the cursors are signed with(defaults to the MERCURY_CURSOR_SECRET environment variable). Set one in production:
+	  without it each process signs with its own random key, a warning is printed and cursors fail on other workers, hosts and deploys
+	Instead of skipping rows with an offset, every page starts right after the last row of the page before,
+	so with an index on the ordering columns a page costs the same at any depth. The ordering columns must not be null.
+	"""
+	ordering = _ordering(model, order_by)
+	signature = [f"{'-' if descending else ''}{name}" for name, descending in ordering]
+	backwards = False
+	query = base
+	if cursor:
+		payload = decode_cursor(cursor, secret)
+		if not isinstance(payload, dict) or payload.get("o") != signature:
+			raise InvalidCursor("The cursor belongs to another ordering")
+		backwards = bool(payload.get("p", False))
+		try:
+			values = [_decode_value(value) for value in payload["k"]]
+		except (KeyError, TypeError, ValueError, StopIteration) as e:
+			raise InvalidCursor("Malformed cursor") from e
+		if len(values) != len(ordering):
+			raise InvalidCursor("Malformed cursor")
+		# A previous cursor walks the ordering in reverse from the first item of the page it came from
+		query = query.filter(_after(model, [(name, descending != backwards) for name, descending in ordering], values))
+
+	columns = []
+	for name, descending in ordering:
+		column = getattr(model, name)
+		columns.append(column.desc() if descending != backwards else column.asc())
+	rows = query.order_by(None).order_by(*columns).limit(per_page + 1).all()
+	more = len(rows) > per_page
+	items = rows[:per_page]
+	if backwards:
+		items.reverse()
+
+	def cursor_at(item, previous: bool) -> str:
+		keys = [_encode_value(getattr(item, name)) for name, _ in ordering]
+		return encode_cursor({"k": keys, "o": signature, "p": previous}, secret)
+
+	next_cursor = previous_cursor = None
+	if items:
+		# Walking forwards there's a next page if a row was left over, and a previous one if we came from a cursor
+		if (more and not backwards) or (backwards and cursor):
+			next_cursor = cursor_at(items[-1], False)
+		if (more and backwards) or (not backwards and cursor):
+			previous_cursor = cursor_at(items[0], True)
+	return Page(items, per_page, next_cursor, previous_cursor)
+
+def page_response(page: Page, exclude: List[str] = [], include: Optional[List[str]] = None, status: int = 200) -> Response:
+	"""Sends a page envelope as json."""
+	body = serializer_for(type(page.items[0]), exclude, include).dumps(page.items) if page.items else b"[]"
+	pagination = json.dumps({"per_page": page.per_page, "next": page.next_cursor, "previous": page.previous_cursor})
+	return Response(b'{"data": ' + body + b', "pagination": ' + pagination.encode() + b"}", status=status, mimetype="application/json")
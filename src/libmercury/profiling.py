@@ -0,0 +1,168 @@
+from colorama import Fore, Style
+from collections import defaultdict
+from werkzeug import Request, Response
+from typing import Dict, Iterable, List, Optional
+import cProfile
+import hmac
+import itertools
+import os
+import pstats
+import random
+import re
+import signal
+import threading
+import time
+
+def _frame_name(func: tuple) -> str:
+	filename, line, name = func
+	if filename == "~":
+		return name
+	return f"{os.path.basename(filename)}:{name}:{line}"
+
+def collapse_stats(stats: Dict, max_depth: int = 64) -> List[str]:
+	"""
+	Converts cProfile stats into collapsed stack lines(`a;b;c <microseconds>`) for flame graph tools.
+	cProfile only records caller/callee pairs, so the time of a function called from several places
+	is split between its stacks in proportion to the time each caller spent in it.
+	"""
+	children = defaultdict(list)
+	roots = []
+	for func, (cc, nc, tt, ct, callers) in stats.items():
+		if not callers:
+			roots.append(func)
+		for caller, edge in callers.items():
+			children[caller].append((func, edge[3]))
+
+	lines = defaultdict(float)
+	def walk(func: tuple, path: List[str], seen: set, scale: float) -> None:
+		_, _, tt, ct, _ = stats[func]
+		path = path + [_frame_name(func)]
+		if tt * scale > 0:
+			lines[";".join(path)] += tt * scale
+		if len(path) >= max_depth:
+			return
+		for child, edge_time in children[func]:
+			child_time = stats[child][3]
+			if child in seen or not child_time:
+				continue
+			walk(child, path, seen | {child}, scale * edge_time / child_time)
+
+	for root in roots:
+		walk(root, [], {root}, 1.0)
+	return [f"{stack} {int(seconds * 1e6)}" for stack, seconds in lines.items() if int(seconds * 1e6)]
+
+class Profiler:
+	"""
+	:param directory: Folder the profiles are written to
+	:param rate: Fraction of requests to profile(0.01 profiles one request in a hundred)
+	:param routes: Route templates that are always profiled, e.g. ['/users/{id:int}']
+	:param header: Requests carrying this header are always profiled, only when they also carry the admin token
+	:param max_files: Oldest profiles are deleted once the folder holds more than this
+	:param formats: 'prof'(loadable with pstats/snakeviz) and/or 'collapsed'(flame graph input)
+	:param enabled: Whether profiling starts switched on
+	:param admin_path: Url of an endpoint switching the profiler at runtime, only served when admin_token is set
+	:param admin_token: Secret expected in the X-Mercury-Admin header of admin requests
+	Profiles a sample of requests with cProfile. While disabled, the only cost per request is one attribute check.
+	One request is profiled at a time(since 3.12 the profilers of a process share one hook), requests picked while
+	another one is being profiled run unprofiled.
+	"""
+	def __init__(self, directory: str = "profiles", rate: float = 0.0, routes: Optional[Iterable[str]] = None, header: Optional[str] = "X-Mercury-Profile",
+			max_files: int = 100, formats: Iterable[str] = ("prof", "collapsed"), enabled: bool = False,
+			admin_path: Optional[str] = "/_mercury/profiler", admin_token: Optional[str] = None) -> None:
+		self.directory = directory
+		self.rate = rate
+		self.routes = frozenset(routes or ())
+		self.environ_header = "HTTP_" + header.upper().replace("-", "_") if header else None
+		self.max_files = max_files
+		self.formats = tuple(formats)
+		self.enabled = enabled
+		self.admin_path = admin_path if admin_token else None
+		self.admin_token = admin_token
+		self._lock = threading.Lock()
+		self._profiling = threading.Lock()
+		self._sequence = itertools.count()
+
+	def install_signal(self, signum: int = getattr(signal, "SIGUSR2", None)) -> None:
+		"""Toggles the profiler whenever the process receives the signal, e.g. `kill -USR2 <pid>`."""
+		signal.signal(signum, lambda *args: self.toggle())
+
+	def toggle(self) -> None:
+		self.enabled = not self.enabled
+		state = "enabled" if self.enabled else "disabled"
+		print(f"{Fore.MAGENTA}[Profiler]{Style.RESET_ALL} Profiling {state} in process {os.getpid()}")
+
+	def should_profile(self, route: str, environ: dict) -> bool:
+		# Anyone can send the header, without the token it would let clients profile(and write to disk) on demand
+		if self.environ_header and self.environ_header in environ and self._authorized(environ.get("HTTP_X_MERCURY_ADMIN", "")):
+			return True
+		if route in self.routes:
+			return True
+		return self.rate > 0 and random.random() < self.rate
+
+	def run(self, compiled, request: Request, params: dict) -> Response:
+		if not self._profiling.acquire(blocking=False):
+			return compiled(request, params)
+		profile = cProfile.Profile()
+		start = time.perf_counter()
+		status = 500
+		try:
+			response = profile.runcall(compiled, request, params)
+			status = response.status_code
+			return response
+		finally:
+			duration = time.perf_counter() - start
+			self._profiling.release()
+			try:
+				self._write(profile, compiled.route.method, compiled.route.url, status, duration)
+			except OSError as e:
+				print(f"{Fore.YELLOW}[WARNING] Could not write profile: {e}{Style.RESET_ALL}")
+
+	def _write(self, profile: cProfile.Profile, method: str, route: str, status: int, duration: float) -> None:
+		os.makedirs(self.directory, exist_ok=True)
+		slug = re.sub(r"[^A-Za-z0-9]+", "_", route).strip("_") or "root"
+		# The sequence number keeps profiles of the same second(and thread races) from overwriting each other
+		name = f"{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}-{next(self._sequence)}-{method}-{slug}-{status}-{duration * 1000:.1f}ms"
+		base = os.path.join(self.directory, name)
+		stats = pstats.Stats(profile)
+		if "prof" in self.formats:
+			stats.dump_stats(base + ".prof")
+		if "collapsed" in self.formats:
+			with open(base + ".collapsed", "w") as f:
+				f.write(f"# {method} {route} status={status} duration={duration:.6f}s\n")
+				f.write("\n".join(collapse_stats(stats.stats)) + "\n")
+		self._rotate()
+
+	def _rotate(self) -> None:
+		with self._lock:
+			files = sorted(
+				(os.path.join(self.directory, name) for name in os.listdir(self.directory)),
+				key=os.path.getmtime,
+			)
+			profiles = {}
+			for path in files:
+				profiles.setdefault(os.path.splitext(path)[0], []).append(path)
+			# A profile may span a .prof and a .collapsed file, rotate them together
+			for stale in list(profiles)[:max(len(profiles) - self.max_files, 0)]:
+				for path in profiles[stale]:
+					os.remove(path)
+
+	def _authorized(self, token: str) -> bool:
+		if not self.admin_token:
+			return False
+		# compare_digest only takes ASCII strings, so compare the header's raw bytes(WSGI decodes them as latin-1) with the utf-8 token
+		return hmac.compare_digest(token.encode("latin-1", "replace"), self.admin_token.encode("utf-8"))
+
+	def admin(self, environ: dict, start_response) -> Iterable[bytes]:
+		"""Handles `?enabled=1&rate=0.05` requests to the admin path, answering with the current settings."""
+		request = Request(environ)
+		if not self._authorized(request.headers.get("X-Mercury-Admin", "")):
+			return Response("Error: Invalid admin token", status=403)(environ, start_response)
+		if "enabled" in request.args:
+			self.enabled = request.args.get("enabled") in ("1", "true", "on")
+		if "rate" in request.args:
+			try:
+				self.rate = min(max(float(request.args["rate"]), 0.0), 1.0)
+			except ValueError:
+				return Response("Error: rate must be a number", status=400)(environ, start_response)
+		body = f"enabled={self.enabled} rate={self.rate} routes={sorted(self.routes)}"
+		return Response(body)(environ, start_response)
@@ -46,6 +46,59 @@ def useJWTValidator(validator, **kwargs):
 		return wrapped_function
 	return decorator
 
+def useCompression(enabled: bool = True, **kwargs):
+	def decorator(func):
+		@wraps(func)
+		def wrapper(*args, **kwargs):
+			return func(*args, **kwargs)
+		wrapper._compression = enabled
+		wrapper._compression_min_size = kwargs.get("min_size")
+		return wrapper
+	return decorator
+
+def useEventStream(heartbeat: float = 15.0):
+	def decorator(func):
+		@wraps(func)
+		def wrapper(*args, **kwargs):
+			from libmercury.streaming import event_stream
+			return event_stream(func(*args, **kwargs), heartbeat)
+		wrapper._event_stream = True
+		return wrapper
+	return decorator
+
+def useCache(ttl: float = 60, **kwargs):
+	def decorator(func):
+		@wraps(func)
+		def wrapper(*args, **kwargs):
+			return func(*args, **kwargs)
+		wrapper._cache_ttl = ttl
+		wrapper._cache_vary = kwargs.get("vary")
+		wrapper._cache_subject = kwargs.get("subject", False)
+		wrapper._cache_backend = kwargs.get("backend")
+		return wrapper
+	return decorator
+
+def useConcurrencyLimit(limit: int, **kwargs):
+	def decorator(func):
+		@wraps(func)
+		def wrapper(*args, **kwargs):
+			return func(*args, **kwargs)
+		wrapper._concurrency_limit = limit
+		wrapper._concurrency_queue = kwargs.get("queue", 0)
+		wrapper._concurrency_timeout = kwargs.get("timeout", 1.0)
+		wrapper._concurrency_retry_after = kwargs.get("retry_after", 1)
+		return wrapper
+	return decorator
+
+def usePrimary():
+	def decorator(func):
+		@wraps(func)
+		def wrapper(*args, **kwargs):
+			return func(*args, **kwargs)
+		wrapper._use_primary = True
+		return wrapper
+	return decorator
+
 def route(method: str, url: str):
 	def decorator(func):
 		@wraps(func)
@@ -0,0 +1,128 @@
+from .export import json_default
+from sqlalchemy import inspect
+from sqlalchemy.orm.exc import UnmappedColumnError
+from operator import attrgetter, itemgetter
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+import json
+import threading
+
+_encoder = json.JSONEncoder(default=json_default)
+
+def _getter(getter: Callable, names: Tuple[str, ...]) -> Callable[[Any], tuple]:
+	# attrgetter/itemgetter return a bare value instead of a tuple when given a single name
+	if len(names) == 1:
+		return lambda obj: (getter(obj),)
+	if not names:
+		return lambda obj: ()
+	return getter
+
+class Serializer:
+	"""
+	:param model: The SQLAlchemy model class
+	:param exclude: Columns left out
+	:param include: Only these fields, in this order, they may also name non-column attributes(e.g. properties)
+	Turns instances of one model into dictionaries or json. The field list and the getters reading them
+	are resolved once, use serializer_for() to share serializers instead of building new ones.
+	Loaded column values are read straight from the instance __dict__, which skips the ORM's attribute
+	descriptors, instances with expired or deferred columns fall back to regular attribute access.
+	"""
+	def __init__(self, model, exclude: Iterable[str] = (), include: Optional[Iterable[str]] = None) -> None:
+		self.model = model
+		excluded = frozenset(exclude)
+		if include is not None:
+			names = [name for name in include if name not in excluded]
+		else:
+			names = [c.name for c in model.__table__.columns if c.name not in excluded]
+		self.fields = tuple(names)
+		keys, all_columns = self._attribute_keys()
+		self._read_attributes = _getter(attrgetter(*keys) if keys else None, keys)
+		# Properties aren't in the instance __dict__, only models serialized by their columns take the fast path
+		self._read_state = _getter(itemgetter(*keys) if keys else None, keys) if all_columns else None
+		self._row_getters: Dict[Tuple[str, ...], Callable] = {}
+
+	def _attribute_keys(self) -> Tuple[Tuple[str, ...], bool]:
+		# The mapped attribute of a column may be named differently than the column itself
+		mapper = inspect(self.model)
+		columns = self.model.__table__.columns
+		keys = []
+		all_columns = True
+		for name in self.fields:
+			try:
+				keys.append(mapper.get_property_by_column(columns[name]).key)
+			except (KeyError, UnmappedColumnError):
+				keys.append(name)
+				all_columns = False
+		return tuple(keys), all_columns
+
+	def _read(self, obj) -> tuple:
+		if self._read_state is not None:
+			try:
+				return self._read_state(obj.__dict__)
+			except KeyError:
+				pass
+		return self._read_attributes(obj)
+
+	def to_dict(self, obj) -> dict:
+		return dict(zip(self.fields, self._read(obj)))
+
+	def to_dicts(self, objs: Iterable) -> List[dict]:
+		fields, read_state, read_attributes = self.fields, self._read_state, self._read_attributes
+		if read_state is None:
+			return [dict(zip(fields, read_attributes(obj))) for obj in objs]
+		dicts = []
+		for obj in objs:
+			try:
+				values = read_state(obj.__dict__)
+			except KeyError:
+				values = read_attributes(obj)
+			dicts.append(dict(zip(fields, values)))
+		return dicts
+
+	def to_json(self, obj) -> str:
+		return _encoder.encode(self.to_dict(obj))
+
+	def dumps(self, objs: Iterable) -> bytes:
+		"""Serializes a list of instances into one json array."""
+		return _encoder.encode(self.to_dicts(objs)).encode()
+
+	def _row_getter(self, keys: Tuple[str, ...]) -> Callable[[Any], tuple]:
+		getter = self._row_getters.get(keys)
+		if getter is None:
+			positions = {key: index for index, key in enumerate(keys)}
+			missing = [name for name in self.fields if name not in positions]
+			if missing:
+				raise KeyError(f"The rows don't have the columns {missing}")
+			getter = _getter(itemgetter(*(positions[name] for name in self.fields)), self.fields)
+			self._row_getters[keys] = getter
+		return getter
+
+	def row_dicts(self, rows: Iterable) -> List[dict]:
+		"""
+		Turns Core rows(e.g. session.execute(select(Model.__table__)).all()) into dictionaries,
+		without building ORM instances. The columns are looked up by name once per row shape.
+		"""
+		rows = list(rows)
+		if not rows:
+			return []
+		read = self._row_getter(tuple(rows[0]._fields))
+		fields = self.fields
+		return [dict(zip(fields, read(row))) for row in rows]
+
+	def dump_rows(self, rows: Iterable) -> bytes:
+		"""Serializes Core rows into one json array."""
+		return _encoder.encode(self.row_dicts(rows)).encode()
+
+_registry: Dict[tuple, Serializer] = {}
+_registry_lock = threading.Lock()
+
+def serializer_for(model, exclude: Iterable[str] = (), include: Optional[Iterable[str]] = None) -> Serializer:
+	"""Returns the serializer of a (model, exclude, include) combination, compiling it on first use."""
+	key = (model, frozenset(exclude), None if include is None else tuple(include))
+	serializer = _registry.get(key)
+	if serializer is None:
+		with _registry_lock:
+			serializer = _registry.get(key)
+			if serializer is None:
+				serializer = Serializer(model, exclude, include)
+				_registry[key] = serializer
+	return serializer
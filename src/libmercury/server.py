@@ -0,0 +1,374 @@
+from colorama import Fore, Style
+from werkzeug.serving import BaseWSGIServer, ThreadedWSGIServer, WSGIRequestHandler
+from .metrics import retire_process
+from .write_behind import close_write_buffers
+from queue import Full, Queue
+from typing import Callable, Dict, Iterable, Optional
+import gc
+import os
+import random
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+def _log(message: str) -> None:
+	print(f"{Fore.CYAN}[Server]{Style.RESET_ALL} {message}", flush=True)
+
+def _rss() -> int:
+	"""Resident memory of this process in bytes."""
+	try:
+		with open("/proc/self/statm") as f:
+			return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+	except (OSError, ValueError, IndexError):
+		import resource
+		# Peak rather than current usage, in kilobytes on Linux
+		return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def _listen(host: str, port: int, backlog: int, reuse_port: bool) -> socket.socket:
+	family = socket.AF_INET6 if ":" in host else socket.AF_INET
+	sock = socket.socket(family, socket.SOCK_STREAM)
+	sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+	if reuse_port:
+		sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+	sock.bind((host, port))
+	sock.listen(backlog)
+	sock.set_inheritable(True)
+	return sock
+
+class _PooledRequestHandler(WSGIRequestHandler):
+	def make_environ(self) -> dict:
+		environ = super().make_environ()
+		# Only the first request of a connection waited in the accept queue
+		queued_at = getattr(self.server.local, "queued_at", None)
+		if queued_at is not None:
+			environ["mercury.queued_at"] = queued_at
+			self.server.local.queued_at = None
+		return environ
+
+class PooledWSGIServer(BaseWSGIServer):
+	"""
+	:param threads: Connections handled at the same time
+	:param queue_size: Accepted connections allowed to wait for a thread, the ones beyond it get a 503 right away
+	:param keepalive_timeout: Seconds an idle keep-alive connection may hold a thread
+	:param retry_after: Seconds sent in the Retry-After header of rejections
+	A werkzeug server handling connections with a fixed pool of threads and a bounded queue,
+	instead of one new thread per connection, so a traffic spike is shed instead of piling up.
+	"""
+	multithread = True
+
+	def __init__(self, host: str, port: int, app: Callable, threads: int = 32, queue_size: int = 128,
+			keepalive_timeout: float = 5.0, retry_after: int = 1, fd: Optional[int] = None) -> None:
+		handler = type("_Handler", (_PooledRequestHandler,), {"timeout": keepalive_timeout, "protocol_version": "HTTP/1.1"})
+		super().__init__(host, port, app, handler=handler, fd=fd)
+		self.local = threading.local()
+		self.rejected = 0
+		self._queue = Queue(maxsize=queue_size)
+		self._busy = (
+			b"HTTP/1.1 503 Service Unavailable\r\n"
+			b"Content-Type: text/plain\r\n"
+			b"Retry-After: " + str(retry_after).encode() + b"\r\n"
+			b"Content-Length: 42\r\n"
+			b"Connection: close\r\n\r\n"
+			b"Error: The server is busy, try again later"
+		)
+		self._threads = [threading.Thread(target=self._work, name="mercury-worker", daemon=True) for _ in range(threads)]
+		for thread in self._threads:
+			thread.start()
+
+	def process_request(self, request: socket.socket, client_address) -> None:
+		try:
+			self._queue.put_nowait((request, client_address, time.perf_counter()))
+		except Full:
+			self.rejected += 1
+			try:
+				request.sendall(self._busy)
+			except OSError:
+				pass
+			self.shutdown_request(request)
+
+	def _work(self) -> None:
+		while True:
+			request, client_address, queued_at = self._queue.get()
+			self.local.queued_at = queued_at
+			try:
+				self.finish_request(request, client_address)
+			except Exception:
+				self.handle_error(request, client_address)
+			finally:
+				self.shutdown_request(request)
+
+	def pending(self) -> int:
+		return self._queue.qsize()
+
+class _Worker:
+	"""Runs in a forked child: serves the preloaded app until it is told to stop or has to be recycled."""
+	def __init__(self, server: "PreforkServer", app, sock: Optional[socket.socket]) -> None:
+		self.server = server
+		self.app = app
+		self.sock = sock
+		self.requests = 0
+		self.inflight = 0
+		self.max_requests = server.max_requests
+		if self.max_requests and server.max_requests_jitter:
+			# Workers started together shouldn't all recycle at the same moment
+			self.max_requests += random.randint(0, server.max_requests_jitter)
+		self.stopping = threading.Event()
+		self._lock = threading.Lock()
+
+	def __call__(self, environ: dict, start_response: Callable) -> Iterable[bytes]:
+		with self._lock:
+			self.requests += 1
+			self.inflight += 1
+		if self.max_requests and self.requests >= self.max_requests:
+			self._stop(f"recycled after {self.requests} requests")
+		try:
+			body = self.app(environ, start_response)
+		except BaseException:
+			self._done()
+			raise
+		return _Closing(body, self._done)
+
+	def _done(self) -> None:
+		with self._lock:
+			self.inflight -= 1
+
+	def _stop(self, reason: str) -> None:
+		if not self.stopping.is_set():
+			_log(f"Worker {os.getpid()} stopping: {reason}")
+			self.stopping.set()
+
+	def _watch(self, master: int) -> None:
+		server = self.server
+		while not self.stopping.wait(0.5):
+			if os.getppid() != master:
+				self._stop("master exited")
+			elif server.max_rss and _rss() > server.max_rss:
+				self._stop(f"recycled at {_rss() // (1024 * 1024)}MB resident memory")
+
+	def run(self, master: int) -> None:
+		server = self.server
+		sock = self.sock
+		if sock is None:
+			# With SO_REUSEPORT every worker has its own accept queue and the kernel balances between them
+			sock = _listen(server.host, server.port, server.backlog, True)
+		if server.threads:
+			httpd = PooledWSGIServer(server.host, server.port, self, server.threads, server.queue_size, fd=sock.fileno())
+		else:
+			httpd = ThreadedWSGIServer(server.host, server.port, self, fd=sock.fileno())
+		sock.close()
+
+		signal.signal(signal.SIGTERM, lambda *args: self._stop("SIGTERM"))
+		signal.signal(signal.SIGINT, lambda *args: self._stop("SIGINT"))
+		signal.signal(signal.SIGHUP, signal.SIG_IGN)
+		threading.Thread(target=httpd.serve_forever, kwargs={"poll_interval": 0.2}, name="mercury-accept", daemon=True).start()
+		self._watch(master)
+
+		# Stop accepting, then let the queued and running requests finish
+		httpd.shutdown()
+		httpd.socket.close()
+		pending = getattr(httpd, "pending", lambda: 0)
+		deadline = time.monotonic() + server.graceful_timeout
+		while (self.inflight or pending()) and time.monotonic() < deadline:
+			time.sleep(0.05)
+		if self.inflight:
+			_log(f"Worker {os.getpid()} exiting with {self.inflight} unfinished requests")
+		# Workers leave through os._exit, which skips atexit, rows buffered by the requests are written here
+		close_write_buffers(max(deadline - time.monotonic(), 1.0))
+		# and so are the counters of the requests since the last flush
+		metrics = getattr(self.app, "metrics", None)
+		if metrics and metrics.directory:
+			metrics.close()
+			metrics.flush()
+
+class _Closing:
+	"""Calls a callback once the server closed the response iterable, i.e. the body was fully sent."""
+	def __init__(self, body: Iterable[bytes], callback: Callable[[], None]) -> None:
+		self.body = body
+		self.callback = callback
+
+	def __iter__(self):
+		return iter(self.body)
+
+	def close(self) -> None:
+		try:
+			if hasattr(self.body, "close"):
+				self.body.close()
+		finally:
+			self.callback()
+
+class PreforkServer:
+	"""
+	:param load_app: Builds the WSGI app, it is called once in the master before forking and again on every reload
+	:param host: The address to listen on
+	:param port: The port to listen on
+	:param workers: Number of worker processes
+	:param reuse_port: Give every worker its own SO_REUSEPORT socket instead of sharing the master's
+	:param max_requests: Recycle a worker after handling this many requests, 0 disables it
+	:param max_requests_jitter: Random extra requests per worker, so workers don't recycle all at once
+	:param max_rss: Recycle a worker once its resident memory exceeds this many bytes, 0 disables it
+	:param graceful_timeout: Seconds a stopping worker gets to finish its in-flight requests
+	:param backlog: Listen queue length
+	:param threads: Size of each worker's thread pool, 0 starts a thread per connection instead
+	:param queue_size: Connections a worker queues while its threads are busy, the ones beyond it get a 503
+	Preloads the app in the master process and forks workers serving it on a shared socket.
+	SIGHUP loads the app again and replaces the workers gracefully, SIGTERM/SIGINT drain the workers and exit.
+	"""
+	def __init__(self, load_app: Callable[[], Callable], host: str = "127.0.0.1", port: int = 8000, workers: Optional[int] = None,
+			reuse_port: bool = False, max_requests: int = 0, max_requests_jitter: int = 0, max_rss: int = 0,
+			graceful_timeout: float = 30.0, backlog: int = 2048, threads: int = 32, queue_size: int = 128) -> None:
+		if not hasattr(os, "fork"):
+			raise RuntimeError("The prefork server needs os.fork, which this platform doesn't provide")
+		if reuse_port and not hasattr(socket, "SO_REUSEPORT"):
+			raise RuntimeError("SO_REUSEPORT is not supported on this platform")
+		self.load_app = load_app
+		self.host = host
+		self.port = port
+		self.workers = workers or os.cpu_count() or 1
+		self.reuse_port = reuse_port
+		self.max_requests = max_requests
+		self.max_requests_jitter = max_requests_jitter
+		self.max_rss = max_rss
+		self.graceful_timeout = graceful_timeout
+		self.backlog = backlog
+		self.threads = threads
+		self.queue_size = queue_size
+		self.app = None
+		self.socket = None
+		self.metrics_dir = None
+		self.children: Dict[int, int] = {}
+		self.generation = 0
+		self._signals = []
+		self._respawn_after = 0.0
+
+	def _load(self) -> None:
+		# Collecting while the app loads would leave holes in pages the workers share,
+		# freezing moves everything loaded so far out of the collector's reach so
+		# the workers' collections don't write to(and so copy) those pages
+		gc.disable()
+		gc.unfreeze()
+		started = time.perf_counter()
+		try:
+			app = self.load_app()
+		except BaseException:
+			gc.freeze()
+			gc.enable()
+			raise
+		if self.app is not None:
+			# The old app's metrics would keep flushing in the master, and restart in every worker forked from now on
+			metrics = getattr(self.app, "metrics", None)
+			if metrics:
+				metrics.close()
+			# Release the previous app before freezing, or it would stay frozen in the master forever
+			self.app = None
+			gc.collect()
+		self.app = app
+		gc.freeze()
+		gc.enable()
+		_log(f"Loaded the app in {(time.perf_counter() - started) * 1000:.0f}ms")
+
+	def _spawn(self) -> None:
+		pid = os.fork()
+		if pid:
+			self.children[pid] = self.generation
+			return
+		# Worker process
+		status = 0
+		try:
+			for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGCHLD):
+				signal.signal(signum, signal.SIG_DFL)
+			gc.enable()
+			_Worker(self, self.app, self.socket).run(os.getppid())
+		except BaseException as e:
+			_log(f"Worker {os.getpid()} crashed: {e!r}")
+			status = 1
+		finally:
+			sys.stdout.flush()
+			sys.stderr.flush()
+			os._exit(status)
+
+	def _reap(self) -> None:
+		while self.children:
+			try:
+				pid, status = os.waitpid(-1, os.WNOHANG)
+			except ChildProcessError:
+				self.children.clear()
+				return
+			if not pid:
+				return
+			self.children.pop(pid, None)
+			if self.metrics_dir:
+				retire_process(self.metrics_dir, pid)
+			if status:
+				# Don't fork in a tight loop when the workers crash on startup
+				self._respawn_after = time.monotonic() + 1.0
+
+	def _stop_workers(self, generation: Optional[int] = None) -> None:
+		for pid, worker_generation in list(self.children.items()):
+			if generation is None or worker_generation == generation:
+				try:
+					os.kill(pid, signal.SIGTERM)
+				except ProcessLookupError:
+					pass
+
+	def _reload(self) -> None:
+		_log("Reloading")
+		old = self.generation
+		try:
+			self._load()
+		except Exception as e:
+			# Keep serving the old code rather than going down with a broken deploy
+			_log(f"{Fore.RED}Reload failed, keeping the running workers:{Style.RESET_ALL} {e!r}")
+			return
+		self.generation += 1
+		for _ in range(self.workers):
+			self._spawn()
+		self._stop_workers(old)
+
+	def _shutdown(self) -> None:
+		_log("Shutting down, draining the workers")
+		self._stop_workers()
+		deadline = time.monotonic() + self.graceful_timeout + 1
+		while self.children and time.monotonic() < deadline:
+			self._reap()
+			time.sleep(0.05)
+		for pid in list(self.children):
+			try:
+				os.kill(pid, signal.SIGKILL)
+			except ProcessLookupError:
+				pass
+		self._reap()
+
+	def run(self) -> None:
+		# Workers write their metrics to a shared folder so any of them can answer a scrape with the totals
+		if not os.environ.get("MERCURY_METRICS_DIR"):
+			os.environ["MERCURY_METRICS_DIR"] = tempfile.mkdtemp(prefix="mercury-metrics-")
+		self.metrics_dir = os.environ["MERCURY_METRICS_DIR"]
+		self._load()
+		if not self.reuse_port:
+			self.socket = _listen(self.host, self.port, self.backlog, False)
+
+		for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+			signal.signal(signum, lambda signum, frame: self._signals.append(signum))
+		for _ in range(self.workers):
+			self._spawn()
+		_log(f"Listening on http://{self.host}:{self.port} with {self.workers} workers (master {os.getpid()})")
+
+		while True:
+			time.sleep(0.2)
+			while self._signals:
+				signum = self._signals.pop(0)
+				if signum == signal.SIGHUP:
+					self._reload()
+				else:
+					self._shutdown()
+					return
+			self._reap()
+			if time.monotonic() < self._respawn_after:
+				continue
+			# Replace workers that were recycled or crashed
+			current = sum(1 for generation in self.children.values() if generation == self.generation)
+			for _ in range(self.workers - current):
+				self._spawn()
@@ -0,0 +1,272 @@
+from werkzeug.http import HTTP_STATUS_CODES, http_date, parse_date
+from werkzeug.security import safe_join
+from werkzeug.wsgi import wrap_file
+from collections import OrderedDict
+from typing import Callable, Iterable, List, Optional, Tuple
+import hashlib
+import mimetypes
+import os
+import stat
+import threading
+import time
+
+Headers = List[Tuple[str, str]]
+
+class _StaticFile:
+	__slots__ = ("path", "exists", "size", "mtime", "mtime_ns", "etag", "last_modified", "content_type", "encoding", "data", "checked")
+
+	def __init__(self, path: str, checked: float, exists: bool = False) -> None:
+		self.path = path
+		self.checked = checked
+		self.exists = exists
+		self.size = 0
+		self.data = None
+
+def _accepted_encodings(header: str) -> set:
+	encodings = set()
+	for part in header.split(","):
+		name, _, params = part.partition(";")
+		params = params.replace(" ", "")
+		if params.startswith("q="):
+			try:
+				if float(params[2:]) == 0:
+					continue
+			except ValueError:
+				pass
+		encodings.add(name.strip().lower())
+	return encodings
+
+def _etag_matches(header: str, etag: str) -> bool:
+	# If-None-Match uses the weak comparison, so W/ prefixes are ignored
+	if header.strip() == "*":
+		return True
+	for candidate in header.split(","):
+		candidate = candidate.strip()
+		if candidate.startswith("W/"):
+			candidate = candidate[2:]
+		if candidate == etag:
+			return True
+	return False
+
+def _parse_range(header: str, size: int):
+	"""Returns (start, end) for a single byte range, None to ignore the header, or False if unsatisfiable."""
+	unit, _, spec = header.partition("=")
+	if unit.strip() != "bytes" or "," in spec:
+		return None
+	first, _, last = spec.strip().partition("-")
+	try:
+		if not first:
+			length = int(last)
+			if length <= 0:
+				return False
+			return max(size - length, 0), size - 1
+		start = int(first)
+		end = int(last) if last else size - 1
+	except ValueError:
+		return None
+	if start >= size or end < start:
+		return False
+	return start, min(end, size - 1)
+
+def _read_range(file, start: int, length: int, block_size: int) -> Iterable[bytes]:
+	try:
+		file.seek(start)
+		while length > 0:
+			chunk = file.read(min(block_size, length))
+			if not chunk:
+				break
+			length -= len(chunk)
+			yield chunk
+	finally:
+		file.close()
+
+class StaticFiles:
+	"""
+	:param directory: The folder files are served from(defaults to src/static)
+	:param url_prefix: The url path the folder is mounted on
+	:param max_age: Seconds sent in Cache-Control, no header is sent when None
+	:param max_cache_bytes: Memory budget of the in-memory file cache
+	:param max_file_size: Files larger than this are streamed from disk instead of cached
+	:param max_entries: Bound on cached lookups, including misses and files streamed from disk
+	:param check_interval: Seconds a cached lookup is trusted before the file is stat'ed again
+	:param precompressed: Serve .br/.gz siblings of a file to clients that accept them
+	Serves static files straight from the WSGI environ, before routing and before a Request is built.
+	"""
+	encodings = (("br", ".br"), ("gzip", ".gz"))
+
+	def __init__(self, directory: str = "src/static", url_prefix: str = "/static/", max_age: Optional[int] = None,
+			max_cache_bytes: int = 32 * 1024 * 1024, max_file_size: int = 256 * 1024, max_entries: int = 4096,
+			check_interval: float = 1.0, precompressed: bool = True, block_size: int = 64 * 1024) -> None:
+		self.directory = directory
+		self.url_prefix = url_prefix
+		self.max_age = max_age
+		self.max_cache_bytes = max_cache_bytes
+		self.max_file_size = max_file_size
+		self.max_entries = max_entries
+		self.check_interval = check_interval
+		self.precompressed = precompressed
+		self.block_size = block_size
+		self._cache = OrderedDict()
+		self._cache_bytes = 0
+		self._lock = threading.Lock()
+
+	def _load(self, path: str, content_type: str, encoding: Optional[str], now: float) -> _StaticFile:
+		entry = _StaticFile(path, now)
+		try:
+			st = os.stat(path)
+		except OSError:
+			return entry
+		if not stat.S_ISREG(st.st_mode):
+			return entry
+
+		entry.exists = True
+		entry.size = st.st_size
+		entry.mtime = int(st.st_mtime)
+		entry.mtime_ns = st.st_mtime_ns
+		entry.last_modified = http_date(entry.mtime)
+		entry.content_type = content_type
+		entry.encoding = encoding
+		if st.st_size <= self.max_file_size:
+			with open(path, "rb") as f:
+				entry.data = f.read()
+			entry.size = len(entry.data)
+			entry.etag = f'"{hashlib.blake2b(entry.data, digest_size=16).hexdigest()}"'
+		else:
+			entry.etag = f'"{st.st_ino:x}-{st.st_mtime_ns:x}-{st.st_size:x}"'
+		return entry
+
+	def _lookup(self, path: str, content_type: str, encoding: Optional[str]) -> Optional[_StaticFile]:
+		now = time.monotonic()
+		with self._lock:
+			entry = self._cache.get(path)
+			if entry is not None:
+				self._cache.move_to_end(path)
+				if now - entry.checked < self.check_interval:
+					return entry if entry.exists else None
+
+		if entry is not None and entry.exists:
+			# Cheap revalidation, reuse the entry when the file is untouched
+			try:
+				st = os.stat(path)
+				if st.st_mtime_ns == entry.mtime_ns and st.st_size == entry.size:
+					entry.checked = now
+					return entry
+			except OSError:
+				pass
+
+		entry = self._load(path, content_type, encoding, now)
+		with self._lock:
+			previous = self._cache.pop(path, None)
+			if previous is not None and previous.data is not None:
+				self._cache_bytes -= previous.size
+			self._cache[path] = entry
+			if entry.data is not None:
+				self._cache_bytes += entry.size
+			# Evict least recently used entries until the budget is met again
+			while len(self._cache) > 1 and (self._cache_bytes > self.max_cache_bytes or len(self._cache) > self.max_entries):
+				_, evicted = self._cache.popitem(last=False)
+				if evicted.data is not None:
+					self._cache_bytes -= evicted.size
+		return entry if entry.exists else None
+
+	def _headers(self, entry: _StaticFile) -> Headers:
+		headers = [("ETag", entry.etag), ("Last-Modified", entry.last_modified)]
+		if self.max_age is not None:
+			headers.append(("Cache-Control", f"public, max-age={self.max_age}"))
+		if self.precompressed:
+			headers.append(("Vary", "Accept-Encoding"))
+		return headers
+
+	def _not_modified(self, entry: _StaticFile, environ: dict) -> bool:
+		if_none_match = environ.get("HTTP_IF_NONE_MATCH")
+		if if_none_match is not None:
+			return _etag_matches(if_none_match, entry.etag)
+		if_modified_since = environ.get("HTTP_IF_MODIFIED_SINCE")
+		if if_modified_since:
+			date = parse_date(if_modified_since)
+			return date is not None and entry.mtime <= date.timestamp()
+		return False
+
+	def _range(self, entry: _StaticFile, environ: dict):
+		header = environ.get("HTTP_RANGE")
+		if not header:
+			return None
+		if_range = environ.get("HTTP_IF_RANGE")
+		if if_range and if_range != entry.etag and if_range != entry.last_modified:
+			return None
+		return _parse_range(header, entry.size)
+
+	def _body(self, entry: _StaticFile, environ: dict, start: int, length: int) -> Iterable[bytes]:
+		if entry.data is not None:
+			if length == entry.size:
+				return [entry.data]
+			return [entry.data[start:start + length]]
+		file = open(entry.path, "rb")
+		if length == entry.size:
+			# Lets the server use sendfile when it provides wsgi.file_wrapper
+			return wrap_file(environ, file, self.block_size)
+		return _read_range(file, start, length, self.block_size)
+
+	def _error(self, status: int) -> Tuple[int, Headers, Iterable[bytes]]:
+		body = f"<h1>{status} {HTTP_STATUS_CODES[status]}</h1>".encode()
+		headers = [("Content-Type", "text/html; charset=utf-8"), ("Content-Length", str(len(body)))]
+		if status == 405:
+			headers.append(("Allow", "GET, HEAD"))
+		return status, headers, [body]
+
+	def resolve(self, environ: dict) -> Tuple[int, Headers, Iterable[bytes]]:
+		"""Returns the status, headers and body iterable for a static file request."""
+		method = environ.get("REQUEST_METHOD", "GET")
+		if method not in ("GET", "HEAD"):
+			return self._error(405)
+
+		filename = environ.get("PATH_INFO", "").encode("latin-1").decode("utf-8", "replace")[len(self.url_prefix):]
+		path = safe_join(self.directory, filename)
+		if path is None:
+			return self._error(404)
+
+		content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+		if content_type.startswith("text/"):
+			content_type += "; charset=utf-8"
+
+		entry = None
+		if self.precompressed:
+			accepted = _accepted_encodings(environ.get("HTTP_ACCEPT_ENCODING", ""))
+			for encoding, suffix in self.encodings:
+				if encoding in accepted:
+					entry = self._lookup(path + suffix, content_type, encoding)
+					if entry is not None:
+						break
+		if entry is None:
+			entry = self._lookup(path, content_type, None)
+		if entry is None:
+			return self._error(404)
+
+		headers = self._headers(entry)
+		if self._not_modified(entry, environ):
+			return 304, headers, []
+
+		headers.append(("Content-Type", entry.content_type))
+		headers.append(("Accept-Ranges", "bytes"))
+		if entry.encoding:
+			headers.append(("Content-Encoding", entry.encoding))
+
+		status, start, length = 200, 0, entry.size
+		byte_range = self._range(entry, environ)
+		if byte_range is False:
+			headers.append(("Content-Range", f"bytes */{entry.size}"))
+			headers.append(("Content-Length", "0"))
+			return 416, headers, []
+		if byte_range is not None:
+			status, start, length = 206, byte_range[0], byte_range[1] - byte_range[0] + 1
+			headers.append(("Content-Range", f"bytes {byte_range[0]}-{byte_range[1]}/{entry.size}"))
+
+		headers.append(("Content-Length", str(length)))
+		if method == "HEAD":
+			return status, headers, []
+		return status, headers, self._body(entry, environ, start, length)
+
+	def __call__(self, environ: dict, start_response: Callable) -> Iterable[bytes]:
+		status, headers, body = self.resolve(environ)
+		start_response(f"{status} {HTTP_STATUS_CODES[status]}", headers)
+		return body
@@ -0,0 +1,135 @@
+from werkzeug import Response
+from queue import Empty, Full, Queue
+from typing import AsyncIterator, Iterable, Iterator, Optional
+import asyncio
+import contextvars
+import json
+import threading
+
+HEARTBEAT = b": heartbeat\n\n"
+
+class Event:
+	"""A server-sent event, yield it from a useEventStream controller to set the event name, id or retry."""
+	def __init__(self, data, event: Optional[str] = None, id: Optional[str] = None, retry: Optional[int] = None) -> None:
+		self.data = data
+		self.event = event
+		self.id = id
+		self.retry = retry
+
+	def encode(self) -> bytes:
+		lines = []
+		if self.event is not None:
+			lines.append(f"event: {self.event}")
+		if self.id is not None:
+			lines.append(f"id: {self.id}")
+		if self.retry is not None:
+			lines.append(f"retry: {self.retry}")
+		data = self.data
+		if isinstance(data, bytes):
+			data = data.decode()
+		elif not isinstance(data, str):
+			data = json.dumps(data)
+		lines.extend(f"data: {line}" for line in data.split("\n"))
+		return ("\n".join(lines) + "\n\n").encode()
+
+def encode_event(item) -> bytes:
+	if isinstance(item, Event):
+		return item.encode()
+	return Event(item).encode()
+
+def _pump(iterator: Iterable, heartbeat: float, context: contextvars.Context) -> Iterator[bytes]:
+	# The controller runs in its own thread so heartbeats keep flowing while it blocks,
+	# a failed heartbeat write is how the server notices the client went away.
+	# It runs in the request's context, so its sessions belong to the request's scope
+	queue = Queue(maxsize=16)
+	stop = threading.Event()
+	item_kind, error_kind, done_kind = 0, 1, 2
+
+	def put(kind, value) -> bool:
+		while not stop.is_set():
+			try:
+				queue.put((kind, value), timeout=0.5)
+				return True
+			except Full:
+				continue
+		return False
+
+	def produce() -> None:
+		try:
+			for item in iterator:
+				if not put(item_kind, item):
+					break
+		except Exception as e:
+			put(error_kind, e)
+		finally:
+			if hasattr(iterator, "close"):
+				iterator.close()
+			put(done_kind, None)
+
+	threading.Thread(target=context.run, args=(produce,), name="mercury-event-stream", daemon=True).start()
+	try:
+		while True:
+			try:
+				kind, value = queue.get(timeout=heartbeat)
+			except Empty:
+				yield HEARTBEAT
+				continue
+			if kind == done_kind:
+				return
+			if kind == error_kind:
+				raise value
+			yield encode_event(value)
+	finally:
+		stop.set()
+
+async def _apump(iterator: AsyncIterator, heartbeat: Optional[float]) -> AsyncIterator[bytes]:
+	pending = None
+	try:
+		while True:
+			if pending is None:
+				pending = asyncio.ensure_future(iterator.__anext__())
+			done, _ = await asyncio.wait({pending}, timeout=heartbeat)
+			if not done:
+				yield HEARTBEAT
+				continue
+			task, pending = pending, None
+			try:
+				item = task.result()
+			except StopAsyncIteration:
+				return
+			yield encode_event(item)
+	finally:
+		if pending is not None:
+			pending.cancel()
+			try:
+				await pending
+			except BaseException:
+				pass
+		if hasattr(iterator, "aclose"):
+			await iterator.aclose()
+
+def _encode_all(iterator: Iterable) -> Iterator[bytes]:
+	try:
+		for item in iterator:
+			yield encode_event(item)
+	finally:
+		if hasattr(iterator, "close"):
+			iterator.close()
+
+def event_stream(events, heartbeat: Optional[float] = 15.0) -> Response:
+	"""
+	:param events: An iterator or async iterator of Event objects or plain data(str, bytes, or anything json serializable)
+	:param heartbeat: Seconds of silence before a comment line is sent to keep the connection alive, None disables it
+	Wraps an iterator of events into a text/event-stream response.
+	"""
+	if hasattr(events, "__aiter__"):
+		body = _apump(events, heartbeat)
+	elif heartbeat:
+		body = _pump(events, heartbeat, contextvars.copy_context())
+	else:
+		body = _encode_all(events)
+	response = Response(body, mimetype="text/event-stream")
+	response.headers["Cache-Control"] = "no-cache"
+	# Keeps reverse proxies such as nginx from buffering the stream
+	response.headers["X-Accel-Buffering"] = "no"
+	return response
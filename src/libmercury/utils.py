@@ -1,9 +1,18 @@
-from typing import Union, Any
+from typing import Union, Any, List
 from werkzeug import Request, Response
 from werkzeug.utils import redirect
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy import select
 from sqlalchemy.orm.query import Query
 from libmercury.db import connection
+from .db.async_query import AsyncQuery
+from .db.query_cache import query_cache
+from .db.statements import filtered_query, find_first, row_exists
+from .export import export_csv, export_json, export_ndjson
+from .bulk import ChunkResult, insert_rows, upsert_rows
+from .write_behind import BufferFull, WriteBuffer
+from .serialization import Serializer, serializer_for
+from .pagination import InvalidCursor, Page, keyset_page, page_response
 import json
 
 def get_connection() -> connection:
@@ -11,15 +20,31 @@ def get_connection() -> connection:
 	return Connection
 
 def query(model, **kwargs) -> Query:
-	result = get_connection().Session.query(model).filter_by(**kwargs)
+	result = filtered_query(get_connection().Session, model, kwargs)
 	return result
 
+def cache_queries(model, ttl: float = 60, max_entries: int = 1024) -> None:
+	"""
+	:param ttl: Seconds a lookup stays cached, it bounds how long writes of other processes can go unnoticed
+	:param max_entries: Lookups kept, the least recently used ones are evicted first
+	Caches the find_or_404() and exists() lookups of a model in this process, commits touching the model invalidate them.
+	Hit rates are reported by query_cache.stats().
+	"""
+	query_cache.enable(model, ttl, max_entries)
+
 def exists(model, **kwargs) -> bool:
 	"""Finds if a model exists with the given query parameters"""
-	result = query(model, **kwargs).first()
-	if result == None:
-		return False
-	return True
+	if query_cache.is_cached(model):
+		return query_cache.exists(get_connection().Session, model, kwargs)
+	return row_exists(get_connection().Session, model, kwargs)
+
+def query_async(model, **kwargs) -> AsyncQuery:
+	"""query() on the request's AsyncSession, await it(or .first(), .count(), ...) to run it."""
+	return AsyncQuery(get_connection().AsyncSession, select(model).filter_by(**kwargs))
+
+async def exists_async(model, **kwargs) -> bool:
+	"""Finds if a model exists with the given query parameters, without blocking the event loop"""
+	return await query_async(model, **kwargs).exists()
 
 def reset_and_redirect(redirect_url: str, request: Request) -> Response:
 	"""Redirects to the specified URL and resets all cookies."""
@@ -38,22 +63,35 @@ def find_or_404(model, response_format: str="html", **kwargs) -> Union[Response,
 	:pram response_format: The format of the response(defaults to html)
 	Finds the model or returns a 404 error in either json or html.
 	"""
-	result = query(model, **kwargs).first()
+	if query_cache.is_cached(model):
+		result = query_cache.find(get_connection().Session, model, kwargs)
+	else:
+		result = find_first(get_connection().Session, model, kwargs)
 
 	if result is None:
-		if response_format == "json":
-			error_message = {
-				"error": "404 Not Found",
-				"details": f"{model.__name__} not found with {kwargs}"
-			}
-			response_body = json.dumps(error_message)
-			return Response(response_body, status=404, mimetype='application/json')
-		else:  # Default to HTML
-			error_message = f"<h1>404 Not Found</h1><p>{model.__name__} not found with {kwargs}</p>"
-			return Response(error_message, status=404, mimetype='text/html')
+		return _not_found(model, response_format, kwargs)
 	
 	return result
 
+async def find_or_404_async(model, response_format: str="html", **kwargs) -> Union[Response, Any]:
+	"""find_or_404 on the request's AsyncSession."""
+	result = await query_async(model, **kwargs).first()
+	if result is None:
+		return _not_found(model, response_format, kwargs)
+	return result
+
+def _not_found(model, response_format: str, kwargs: dict) -> Response:
+	if response_format == "json":
+		error_message = {
+			"error": "404 Not Found",
+			"details": f"{model.__name__} not found with {kwargs}"
+		}
+		response_body = json.dumps(error_message)
+		return Response(response_body, status=404, mimetype='application/json')
+	else:  # Default to HTML
+		error_message = f"<h1>404 Not Found</h1><p>{model.__name__} not found with {kwargs}</p>"
+		return Response(error_message, status=404, mimetype='text/html')
+
 def paginate(model, page=1, per_page=10, **kwargs) -> Query:
 	"""Paginate the results of a query on a SQLAlchemy model, returning a query object."""
 	query_result = query(model, **kwargs)  # Assuming `query` is a function that returns a query object
@@ -61,22 +99,36 @@ def paginate(model, page=1, per_page=10, **kwargs) -> Query:
 	
 	return paginated_query
 
+def paginate_async(model, page=1, per_page=10, **kwargs) -> AsyncQuery:
+	"""paginate() on the request's AsyncSession, await the returned query for the page's items."""
+	return query_async(model, **kwargs).offset((page - 1) * per_page).limit(per_page)
+
+def keyset_paginate(model, cursor: str=None, per_page=10, order_by: list=None, **kwargs) -> Page:
+	"""
+	:param cursor: page.next_cursor or page.previous_cursor of the page before, None for the first page
+	:param order_by: Attribute names, '-name' for descending order(defaults to the primary key)
+	Paginates by the last row seen instead of an offset, so deep pages are as fast as the first one.
+	Raises InvalidCursor for cursors that were tampered with.
+	"""
+	return keyset_page(query(model, **kwargs), model, cursor, per_page, order_by)
+
 def expires_in(seconds: int) -> int:
 	import time
 	return int(time.time())+seconds
 
 def model_to_dict(obj, exclude=[]) -> dict:
 	"""Converts a SQLAlchemy model instance to a dictionary, excluding specified fields."""
-	return {
-		c.name: getattr(obj, c.name)
-		for c in obj.__table__.columns
-		if c.name not in exclude
-	}
+	return serializer_for(type(obj), exclude).to_dict(obj)
 
 def model_to_json(model, exclude=[]) -> str:
 	"""Converts a SQLAlchemy model instance to a JSON string, with optional exclusion of specified fields."""
-	model_dict = model_to_dict(model, exclude)
-	return json.dumps(model_dict)
+	return serializer_for(type(model), exclude).to_json(model)
+
+def models_to_json(models: list, exclude=[]) -> bytes:
+	"""Converts a list of instances of one model to a JSON array, the fields are resolved once for the whole list."""
+	if not models:
+		return b"[]"
+	return serializer_for(type(models[0]), exclude).dumps(models)
 
 def json_to_object(json_str: str, model_class) -> dict:
 	"""Converts a JSON string to a SQLAlchemy model instance, excluding the primary key.
@@ -122,6 +174,32 @@ def json_to_object(json_str: str, model_class) -> dict:
 		# Handle any other exceptions
 		return {"error": "Unexpected error", "details": str(e)}
 
+def bulk_insert(model, data, chunk_size: int=1000, method: str="executemany", on_error: str="raise") -> List[ChunkResult]:
+	"""
+	:param data: A list(or generator) of dicts, or a JSON array of objects
+	:param chunk_size: Rows per statement and transaction
+	Inserts many rows at once on the primary, without building a model instance per row. Returns a ChunkResult per chunk,
+	see insert_rows for the other parameters.
+	"""
+	return insert_rows(get_connection().Engine, model, data, chunk_size, method, on_error)
+
+def bulk_upsert(model, data, conflict: list=None, update: list=None, chunk_size: int=1000, method: str="executemany", on_error: str="raise") -> List[ChunkResult]:
+	"""
+	:param conflict: Columns rows collide on(defaults to the primary key)
+	:param update: Columns overwritten on existing rows(defaults to all given ones, [] leaves existing rows untouched)
+	bulk_insert that updates the rows which already exist(INSERT ... ON CONFLICT on SQLite and PostgreSQL).
+	"""
+	return upsert_rows(get_connection().Engine, model, data, conflict, update, chunk_size, method, on_error)
+
+def write_behind(model, max_rows: int=500, interval: float=0.05, **kwargs) -> WriteBuffer:
+	"""
+	:param max_rows: Rows per batch
+	:param interval: Seconds rows wait for a batch to fill up
+	Creates a write-behind buffer for a model, writing to the primary. Create it once(e.g. at module level) and
+	enqueue() rows from controllers, they are inserted in batches outside of the request. See WriteBuffer for the other options.
+	"""
+	return WriteBuffer(model, lambda: get_connection().Engine, max_rows, interval, **kwargs)
+
 def update_object(object, updates: dict) -> Response:
 	session = get_connection().Session
 	"""Update an SQLAlchemy object with the provided dictionary of changes.
@@ -133,6 +211,32 @@ def update_object(object, updates: dict) -> Response:
 	Returns:
 		werkzeug.wrappers.Response: A response object indicating success or error.
 	"""
+	rejected = _apply_updates(object, updates)
+	if rejected is not None:
+		return rejected
+
+	# Commit the changes
+	try:
+		session.commit()
+		return _updated(object)
+	except Exception as e:
+		session.rollback()
+		return _update_failed(e)
+
+async def update_object_async(object, updates: dict) -> Response:
+	"""update_object for objects loaded through the request's AsyncSession, the responses are the same."""
+	session = get_connection().AsyncSession
+	rejected = _apply_updates(object, updates)
+	if rejected is not None:
+		return rejected
+	try:
+		await session.commit()
+		return _updated(object)
+	except Exception as e:
+		await session.rollback()
+		return _update_failed(e)
+
+def _apply_updates(object, updates: dict) -> Union[Response, None]:
 	# Get the primary key and unique columns
 	primary_key_column = object.__table__.primary_key.columns.keys()[0]
 	unique_columns = [c.name for c in object.__table__.columns if c.unique]
@@ -153,21 +257,22 @@ def update_object(object, updates: dict) -> Response:
 	# Apply updates to the object
 	for key, value in updates.items():
 		setattr(object, key, value)
+	return None
 
-	# Commit the changes
-	try:
-		session.commit()
-		success_message = {
-			"success": "Update successful",
-			"details": f"Updated {object.__class__.__name__} with ID {getattr(object, primary_key_column)}."
-		}
-		return Response(
-			json.dumps(success_message),
-			status=200,
-			mimetype='application/json'
-		)
-	except IntegrityError as e:
-		session.rollback()
+def _updated(object) -> Response:
+	primary_key_column = object.__table__.primary_key.columns.keys()[0]
+	success_message = {
+		"success": "Update successful",
+		"details": f"Updated {object.__class__.__name__} with ID {getattr(object, primary_key_column)}."
+	}
+	return Response(
+		json.dumps(success_message),
+		status=200,
+		mimetype='application/json'
+	)
+
+def _update_failed(e: Exception) -> Response:
+	if isinstance(e, IntegrityError):
 		error_message = {
 			"error": "Database error",
 			"details": str(e.orig)	# You might need to adjust based on your DB errors
@@ -177,14 +282,12 @@ def update_object(object, updates: dict) -> Response:
 			status=400,
 			mimetype='application/json'
 		)
-	except Exception as e:
-		session.rollback()
-		error_message = {
-			"error": "Unexpected error",
-			"details": str(e)
-		}
-		return Response(
-			json.dumps(error_message),
-			status=500,
-			mimetype='application/json'
-		)
+	error_message = {
+		"error": "Unexpected error",
+		"details": str(e)
+	}
+	return Response(
+		json.dumps(error_message),
+		status=500,
+		mimetype='application/json'
+	)
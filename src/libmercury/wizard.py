@@ -3,6 +3,7 @@ from colorama import Fore, Style
 from libmercury.db.setup_db import * 
 from libmercury.security import keygen 
 from libmercury.db import MigrationSystem
+from libmercury.db.MigrationGenerator import Migration
 from libmercury.generation import generate
 from .version import version
 import os
@@ -24,6 +25,8 @@ class CLI:
 			"migrate": self.migrate,
 			"generate": self.generate,
 			"run": self.run,
+			"serve": self.serve,
+			"analyze": self.analyze,
 		}
 		if len(self.arguments) < 1:
 			self.version_display()
@@ -68,12 +71,15 @@ class CLI:
 			f.write("""from libmercury.db import connection
 Connection = connection("sqlite:///src/cargo/dev.db", echo=False)
 #Connection.Engine - The engine
-#Connection.Session - The session connected to the db""")
+#Connection.Session - The session of the current request, what isn't committed is rolled back when the request ends
+#  (pass commit_on_success=True to commit it when the request succeeds)
+#Pool options for server databases: pool_size, max_overflow, pool_pre_ping, pool_recycle""")
 		with open(f"{directory}/app.py", "w") as f:
 			f.write("""from libmercury.wsgi import WSGIApp
 from werkzeug.serving import run_simple
 app = WSGIApp()
-run_simple("localhost", 8000, app)""")
+if __name__ == "__main__":
+	run_simple("localhost", 8000, app)""")
 
 		#Create .mercury files that allow us to run commands from anywhere in the file structure
 		directories = [
@@ -256,7 +262,6 @@ class {name}Jwt:
 			create_mercury_table(db_url)
 			create_version(db_url, 0)	
 		db_version = get_version(db_url)
-		latest_migration_id = 0
 		migrations = []
 
 		#Get all non-runned migrations
@@ -264,26 +269,34 @@ class {name}Jwt:
 			if file.endswith('.py') and os.path.isfile(os.path.join("src/cargo/migrations", file)):
 				try:
 					if int(file[:-3]) > db_version:
-						if int(file[:-3]) > latest_migration_id:
-							latest_migration_id = int(file[:-3])
 						migrations.append(os.path.join("src/cargo/migrations", file))
 				except ValueError:
 					pass
 		migrations.sort(key=lambda x: int(os.path.basename(x)[:-3]))
 		
+		failed = False
 		for migration in migrations:
 			print(f"{Fore.GREEN}[Migrator]{Style.RESET_ALL} Running migration {migration}")
+			# One connection and transaction per file, the version is recorded in it so it only moves past files that committed
+			run = Migration(db_url)
 			try:
-				module = self._import_module(migration).upgrade(db_url)
-				print(f"{Fore.GREEN}[Migrator]{Style.RESET_ALL} '{migration}' passed with no errors")
+				with run:
+					self._import_module(migration).upgrade(db_url)
+					run.record_version(int(os.path.basename(migration)[:-3]))
 			except Exception as e:
-				print(f"{Fore.GREEN}[Migrator]{Style.RESET_ALL} Migration: '{migration}' failed with error:")
+				print(f"{Fore.RED}[Migrator]{Style.RESET_ALL} Migration: '{migration}' failed with error:")
 				print(e)
+				if run.transactional:
+					print(f"{Fore.RED}[Migrator]{Style.RESET_ALL} Its changes were rolled back")
+				else:
+					print(f"{Fore.YELLOW}[WARNING] {run.dialect} can't roll back schema changes, the statements of '{migration}' before the error stay applied{Style.RESET_ALL}")
+				print(f"{Fore.RED}[Migrator]{Style.RESET_ALL} Stopped, the later migrations were not run")
+				failed = True
+				break
+			print(f"{Fore.GREEN}[Migrator]{Style.RESET_ALL} '{migration}' passed with no errors")
 
 		#Update map
 		map = loads(open("map.json", "r").read())
-		if not latest_migration_id == 0:
-			update_version(db_url, latest_migration_id)
 
 		with open("map.json", "w") as f:
 			map["controllers"] = list(set(map["controllers"]))
@@ -291,12 +304,99 @@ class {name}Jwt:
 			map["models"] = list(set(map["models"]))
 			map["security"] = list(set(map["security"]))
 			f.write(dumps(map))
+		if failed:
+			raise SystemExit(1)
 
 	def run(self) -> None:
 		with open("map.json", "r") as f:
 			map = loads(f.read())
+		# The development server, apps started by it report their queries in a response header
+		os.environ.setdefault("MERCURY_ENV", "development")
 		os.system(f"{map['interpreter']} app.py")
 
+	def serve(self) -> None:
+		import argparse
+		from libmercury.server import PreforkServer
+		parser = argparse.ArgumentParser(prog="mercury serve", description="Runs the app with a preforking multi-process server")
+		parser.add_argument("--host", default="127.0.0.1")
+		parser.add_argument("--port", type=int, default=8000)
+		parser.add_argument("--workers", type=int, default=None, help="Worker processes, defaults to the cpu count")
+		parser.add_argument("--app", default=None, help="module:attribute of the app, defaults to a WSGIApp built from map.json")
+		parser.add_argument("--reuse-port", action="store_true", help="Give every worker its own SO_REUSEPORT socket")
+		parser.add_argument("--max-requests", type=int, default=0, help="Recycle a worker after this many requests")
+		parser.add_argument("--max-requests-jitter", type=int, default=0)
+		parser.add_argument("--max-rss", type=int, default=0, help="Recycle a worker above this many MB of resident memory")
+		parser.add_argument("--graceful-timeout", type=float, default=30.0)
+		parser.add_argument("--threads", type=int, default=32, help="Threads per worker, 0 starts a thread per connection")
+		parser.add_argument("--queue-size", type=int, default=128, help="Connections a worker queues before answering 503")
+		options = parser.parse_args(self.arguments[1:])
+
+		def load_app():
+			if options.app is None:
+				from libmercury.wsgi import WSGIApp
+				return WSGIApp()
+			module_name, _, attribute = options.app.partition(":")
+			module = self._import_module(module_name.replace(".", "/") + ".py")
+			return getattr(module, attribute or "app")
+
+		PreforkServer(
+			load_app,
+			host=options.host,
+			port=options.port,
+			workers=options.workers,
+			reuse_port=options.reuse_port,
+			max_requests=options.max_requests,
+			max_requests_jitter=options.max_requests_jitter,
+			max_rss=options.max_rss * 1024 * 1024,
+			graceful_timeout=options.graceful_timeout,
+			threads=options.threads,
+			queue_size=options.queue_size,
+		).run()
+
+	def analyze(self) -> None:
+		import argparse
+		from libmercury.db.advisor import IndexAdvisor, read_statements
+		parser = argparse.ArgumentParser(prog="mercury analyze", description="Suggests indexes for a workload of statements by running EXPLAIN on them")
+		parser.add_argument("files", nargs="*", help="Statements captured with SQLInstrumentation(capture=...) or sql files, "
+			"defaults to the MERCURY_SQL_CAPTURE file or .mercury_queries.jsonl")
+		parser.add_argument("--statements", action="store_true", help="List the statements every suggestion helps")
+		options = parser.parse_args(self.arguments[1:])
+		files = options.files or [os.environ.get("MERCURY_SQL_CAPTURE") or ".mercury_queries.jsonl"]
+		for path in files:
+			if not os.path.isfile(path):
+				print(f"{Fore.RED}Error:{Style.RESET_ALL} No statements at '{path}', capture some with SQLInstrumentation(capture=\"{path}\") or pass a sql file")
+				return
+
+		with open("map.json", "r") as f:
+			map_json = loads(f.read())
+		module = self._import_module("src/cargo/connection.py")
+		if not hasattr(module, "Connection"):
+			raise AttributeError("The module does not have a 'Connection' object.")
+		models = MigrationSystem("src/cargo/connection.py", map_json["models"]).load_orm_models(map_json["models"])
+		advisor = IndexAdvisor(module.Connection.Engine, models)
+		print(f"{Fore.CYAN}[Analyzer]{Style.RESET_ALL} Explaining the statements of {', '.join(files)}")
+		suggestions = advisor.analyze(statement for path in files for statement in read_statements(path))
+		print(f"{Fore.CYAN}[Analyzer]{Style.RESET_ALL} {advisor.explained} statements explained, {advisor.skipped} skipped, {len(advisor.failed)} failed")
+		for statement, error in advisor.failed:
+			print(f"{Fore.YELLOW}[WARNING] Could not explain {statement[:200]}: {error}{Style.RESET_ALL}")
+		for table, count in sorted(advisor.unfiltered.items()):
+			print(f"{Fore.CYAN}[Analyzer]{Style.RESET_ALL} {count} statements read all of '{table}' without a filter, no index helps them")
+		if not suggestions:
+			print(f"{Fore.CYAN}[Analyzer]{Style.RESET_ALL} No full scans or sorts an index would avoid")
+			return
+		for suggestion in suggestions:
+			reasons = " and ".join(sorted(suggestion.reasons))
+			print(f"{Fore.CYAN}[Analyzer]{Style.RESET_ALL} {suggestion.table}({', '.join(suggestion.columns)}): avoids a {reasons} in {len(suggestion.statements)} statements")
+			if options.statements:
+				for statement in suggestion.statements:
+					print(f"\t{statement}")
+		print(f"{Fore.CYAN}[Analyzer]{Style.RESET_ALL} Add to the upgrade() of a migration(mercury create migration <message>):")
+		for suggestion in suggestions:
+			print(f"\t{suggestion.migration()}")
+		print(f"{Fore.CYAN}[Analyzer]{Style.RESET_ALL} And to its downgrade():")
+		for suggestion in suggestions:
+			print(f"\t{suggestion.downgrade()}")
+
 	def generate(self) -> None:
 		result = generate(' '.join(self.arguments), CLI)
 
@@ -0,0 +1,210 @@
+from .bulk import _RowValidator, insert_rows
+from colorama import Fore, Style
+from collections import deque
+from typing import Any, Callable, List, Optional, Union
+from time import monotonic
+import atexit
+import os
+import threading
+import time
+import weakref
+
+class BufferFull(Exception):
+	"""Raised by enqueue() when the buffer is at max_pending and on_full is "raise"."""
+
+class WriteBuffer:
+	"""
+	:param model: The model whose table the rows go into
+	:param engine: The engine written to, or a function returning it(resolved on the first write)
+	:param max_rows: Rows written per batch, a batch is written as soon as this many are waiting
+	:param interval: Seconds the first waiting row waits for others before a smaller batch is written
+	:param max_pending: Rows held in memory at most, including the batch being written
+	:param on_full: What enqueue() does at max_pending: "block" for up to block_timeout then drop, "drop" right away, or "raise" BufferFull
+	:param block_timeout: Seconds a blocked enqueue() waits for room
+	:param retries: Times a failed batch is retried, with a doubling delay starting at retry_delay seconds
+	:param on_failure: Called with the rows and the exception of a batch that failed every retry
+	Write-behind for high-volume inserts(audit logs, analytics events): controllers enqueue rows and return,
+	a background thread inserts them in batches. Rows still waiting are written when the process exits,
+	prefork workers write theirs before they exit. Rows are only durable once written, see stats().
+	"""
+	instances = weakref.WeakSet()
+
+	def __init__(self, model, engine, max_rows: int = 500, interval: float = 0.05, max_pending: int = 100000, on_full: str = "block",
+			block_timeout: float = 1.0, retries: int = 3, retry_delay: float = 0.2, on_failure: Optional[Callable[[List[dict], Exception], None]] = None) -> None:
+		if on_full not in ("block", "drop", "raise"):
+			raise ValueError("on_full must be 'block', 'drop' or 'raise'")
+		self.model = model
+		self.engine = engine
+		self.max_rows = max_rows
+		self.interval = interval
+		self.max_pending = max(max_pending, max_rows)
+		self.on_full = on_full
+		self.block_timeout = block_timeout
+		self.retries = retries
+		self.retry_delay = retry_delay
+		self.on_failure = on_failure
+		self._validate = _RowValidator(model)
+		self._keys = tuple(column.key for column in model.__table__.columns)
+		self._reset()
+		WriteBuffer.instances.add(self)
+
+	def _reset(self) -> None:
+		self._pid = os.getpid()
+		self._pending = deque()
+		self._writing = 0
+		self._condition = threading.Condition()
+		self._thread = None
+		self._closing = False
+		self._flushing = False
+		self.written = 0
+		self.batches = 0
+		self.retried = 0
+		self.failed = 0
+		self.dropped = 0
+		self.last_error: Optional[str] = None
+
+	def _row(self, item: Union[dict, Any]) -> dict:
+		if not isinstance(item, dict):
+			if not isinstance(item, self.model):
+				raise TypeError(f"Expected a {self.model.__name__} or a dict, got {type(item).__name__}")
+			# Only the attributes that were set, so the column defaults apply to the others
+			state = item.__dict__
+			item = {key: state[key] for key in self._keys if key in state}
+		return self._validate(item)
+
+	def enqueue(self, item: Union[dict, Any]) -> bool:
+		"""Queues a model instance(it isn't added to any session) or a dict of columns, returns False if it was dropped."""
+		row = self._row(item)
+		if self._pid != os.getpid():
+			# Forked: the rows and the flusher thread belong to the parent
+			self._reset()
+		with self._condition:
+			if self._closing:
+				raise RuntimeError("The write buffer is closed")
+			if len(self._pending) + self._writing >= self.max_pending and not self._wait_for_room():
+				return False
+			self._pending.append(row)
+			if self._thread is None:
+				self._start()
+			count = len(self._pending)
+			# The first row starts the interval, a full batch is written right away
+			if count == 1 or count >= self.max_rows:
+				self._condition.notify_all()
+		return True
+
+	def _wait_for_room(self) -> bool:
+		if self.on_full == "raise":
+			raise BufferFull(f"{len(self._pending) + self._writing} rows of {self.model.__name__} are waiting to be written")
+		if self.on_full == "block":
+			deadline = monotonic() + self.block_timeout
+			while len(self._pending) + self._writing >= self.max_pending:
+				remaining = deadline - monotonic()
+				if remaining <= 0:
+					break
+				self._condition.wait(remaining)
+			else:
+				return True
+		self.dropped += 1
+		return False
+
+	def _start(self) -> None:
+		self._thread = threading.Thread(target=self._run, name=f"mercury-write-behind-{self.model.__name__}", daemon=True)
+		self._thread.start()
+
+	def _run(self) -> None:
+		while True:
+			with self._condition:
+				while not self._pending and not self._closing:
+					self._condition.wait()
+				deadline = monotonic() + self.interval
+				while len(self._pending) < self.max_rows and not (self._closing or self._flushing):
+					remaining = deadline - monotonic()
+					if remaining <= 0:
+						break
+					self._condition.wait(remaining)
+				if not self._pending:
+					return
+				batch = [self._pending.popleft() for _ in range(min(len(self._pending), self.max_rows))]
+				self._writing = len(batch)
+			try:
+				self._write(batch)
+			finally:
+				with self._condition:
+					self._writing = 0
+					# Wakes enqueue() calls waiting for room and flush() calls waiting for the buffer to empty
+					self._condition.notify_all()
+
+	def _write(self, batch: List[dict]) -> None:
+		attempt = 0
+		while True:
+			try:
+				engine = self.engine() if callable(self.engine) else self.engine
+				insert_rows(engine, self.model, batch, chunk_size=len(batch))
+				self.written += len(batch)
+				self.batches += 1
+				return
+			except Exception as e:
+				self.last_error = str(e)
+				if attempt >= self.retries:
+					self._failed(batch, e)
+					return
+				attempt += 1
+				self.retried += 1
+				time.sleep(self.retry_delay * 2 ** (attempt - 1))
+
+	def _failed(self, batch: List[dict], error: Exception) -> None:
+		self.failed += len(batch)
+		print(f"{Fore.RED}[ERROR] Could not write {len(batch)} {self.model.__name__} rows after {self.retries} retries: {error}{Style.RESET_ALL}")
+		if self.on_failure is not None:
+			try:
+				self.on_failure(batch, error)
+			except Exception as e:
+				print(f"{Fore.YELLOW}[WARNING] on_failure of the {self.model.__name__} write buffer raised: {e!r}{Style.RESET_ALL}")
+
+	def flush(self, timeout: Optional[float] = None) -> bool:
+		"""Writes the waiting rows now and waits for them, returns False if they weren't written within timeout."""
+		if self._pid != os.getpid():
+			return True
+		deadline = None if timeout is None else monotonic() + timeout
+		with self._condition:
+			self._flushing = True
+			self._condition.notify_all()
+			try:
+				while self._pending or self._writing:
+					remaining = None if deadline is None else deadline - monotonic()
+					if remaining is not None and remaining <= 0:
+						return False
+					self._condition.wait(remaining)
+				return True
+			finally:
+				self._flushing = False
+
+	def close(self, timeout: Optional[float] = 5.0) -> bool:
+		"""Writes the waiting rows and stops the flusher, later enqueue() calls raise."""
+		written = self.flush(timeout)
+		with self._condition:
+			self._closing = True
+			self._condition.notify_all()
+		if not written:
+			print(f"{Fore.YELLOW}[WARNING] {len(self._pending) + self._writing} {self.model.__name__} rows were not written before shutdown{Style.RESET_ALL}")
+		return written
+
+	def stats(self) -> dict:
+		return {
+			"pending": len(self._pending) + self._writing,
+			"written": self.written,
+			"batches": self.batches,
+			"retried": self.retried,
+			"failed": self.failed,
+			"dropped": self.dropped,
+			"last_error": self.last_error,
+		}
+
+def close_write_buffers(timeout: float = 5.0) -> None:
+	"""Writes what every buffer of the process still holds, it runs at exit and when a prefork worker stops."""
+	deadline = monotonic() + timeout
+	for buffer in list(WriteBuffer.instances):
+		if buffer._pid == os.getpid() and not buffer._closing:
+			buffer.close(max(deadline - monotonic(), 0.0))
+
+atexit.register(close_write_buffers)
@@ -1,206 +1,82 @@
-from colorama import Fore, Style
-from werkzeug.utils import send_from_directory
-from libmercury.security.jwt import JWT
-from .validation import validate
-from .route_management import Route
+from .app import BaseApp
+from .db.connection import RequestScope
 from werkzeug import Request, Response
-from marsrouter import Router
+from werkzeug.wsgi import ClosingIterator
 from typing import Callable, Iterable
-import importlib.util
-import json
-import os
+import time
 
-class WSGIApp:
-	def __init__(self):
-		self.routes = []
-		self.load_project()
-		self.router = Router()
-		self.load_mapper()
-
-	def load_mapper(self) -> None:
-		for route in self.routes:
-			if route.url[-1] == "/" and route.url != "/":
-				route.url = route.url[:-1]
-			self.router.add_route(route.url, route.handler, methods=[route.method])
-
-	def load_project(self) -> None:
-		# Load the map.json file
-		with open('map.json') as f:
-			config = json.load(f)
-		
-		# Load and register routes from controllers
-		for controller_path in set(config.get('controllers', [])):
-			self._load_controller(controller_path)
-
-	def _load_controller(self, controller_path: str) -> None:
-		# Import the module
-		module_name = os.path.splitext(os.path.basename(controller_path))[0]
-		spec = importlib.util.spec_from_file_location(module_name, controller_path)
-		module = importlib.util.module_from_spec(spec)
-		spec.loader.exec_module(module)
-		
-		# Get the controller class name (assuming it's the same as the module name)
-		controller_class_name = module_name 
-		
-		# Get the controller class from the module
-		controller_class = getattr(module, controller_class_name, None)
-		if not controller_class:
-			print(f"{Fore.YELLOW}[WARNING] Controller class {controller_class_name} not found in module {module_name}{Style.RESET_ALL}")
-			return
-	
-		# Iterate over all attributes in the class
-		for method_name in dir(controller_class):
-			method = getattr(controller_class, method_name)
-			
-			# Check if the attribute is callable and has route attributes
-			if callable(method) and hasattr(method, '_route_method') and hasattr(method, '_route_url'):
-				route = Route(method._route_method, method._route_url, method)
-				self.routes.append(route)
-
-	def get_nested_value(self, data: dict, key_path: str, default=None):
-		keys = key_path.split('.')
-		for key in keys:
-			if isinstance(data, dict):
-				data = data.get(key, default)
-			else:
-				return default
-		return data
+class WSGIApp(BaseApp):
+	serves_async = False
 
 	def wsgi_handler(self, environ: dict, start_response: Callable) -> Iterable[bytes]:
+		# Static files and the metrics endpoint short-circuit before a Request is built or the router is consulted
+		path_info = environ.get("PATH_INFO", "")
+		if self.static and path_info.startswith(self.static.url_prefix):
+			return self.static(environ, start_response)
+		if self.metrics and path_info == self.metrics.path:
+			return self.metrics(environ, start_response)
+		if self.profiler and path_info == self.profiler.admin_path:
+			return self.profiler.admin(environ, start_response)
+
+		start = time.perf_counter()
 		# Create a Request object from WSGI environment
 		request = Request(environ)
 		
 		method = request.method
 		path = request.path
-		if path.startswith('/static/'):
-			# Serve the static file from the directory
-			filename = path[len('/static/'):]
-			try:
-				response = send_from_directory("src/static", filename, environ, as_attachment=False)
-			except:
-				response = Response("<h1>404 Not Found</h1>", status=404, content_type='text/html')
-				return response(environ, start_response)
-		
 		result = self.router.match(path, method)
-		if not result.get("controller"):
-			return Response(result.get("error"), status=result.get("status_code"), content_type='text/html')(environ, start_response)
-		controller = result.get("controller")
-		if not callable(controller):
-			raise ValueError(f"Controller '{controller}' is not a function")
-		args = result.get("params")
-		if not isinstance(args, dict):
-			raise ValueError("Params must be a dict")
-
-		if hasattr(controller, "_auth"):
-			authorization = controller._auth
-			cookie = controller._auth_cookie
-			error = controller._error
-			negative_auth = controller._negative_auth
-			jwt_require = controller._jwt_require
-			validator = controller._jwt_validator
-			token = None
+		compiled = result.get("controller")
+		if not compiled:
+			response = Response(result.get("error"), status=result.get("status_code"), content_type='text/html')
+			if self.metrics:
+				route_metrics = self.metrics.unmatched
+				self.metrics.begin(route_metrics)
+				self.metrics.record(route_metrics, response.status_code, start, request.content_length or 0, response.calculate_content_length() or 0)
+			return response(environ, start_response)
 
-			if cookie and not negative_auth: #Only raise an error if negative auth is not present 
-				token = request.cookies.get(cookie)
-				if not token:
-					if error:
-						return error()(environ, start_response)
-					rsp = Response(f"Error: No JWT found in the '{cookie}' cookie")
-					return rsp(environ, start_response)
-			elif not negative_auth: #Only raise an error if negative auth is not present
-				token = request.headers.get("Authorization")
-				if not token:
-					if error:
-						return error()(environ, start_response)
-					rsp = Response("Error: No JWT token found in the Autherization header")
-					rsp.status_code = 400
-					return rsp(environ, start_response)
-				if token.startswith("Bearer"):
-					token = token[7:]
-
-			if not authorization._verify(token) and not negative_auth: #Only raise an error if negative auth is not present
-				if error:
-					return error()(environ, start_response)
-				rsp = Response("Error: Invalid signature in token")
-				rsp.status_code = 403
-				return rsp(environ, start_response)
-			
-			# Finaly, check to see if the jwt requirements are met
-			if negative_auth or not jwt_require:
-				return []
-		
-			# Initialize JWT and retrieve the segment
-			jwt = JWT(token)
-			segment = self.get_nested_value(jwt.payload, jwt_require[0])
-			target, function = jwt_require[1], None
-		
-			# Handle case where target is a tuple (target, function)
-			if isinstance(target, tuple):
-				target, function = target[0], target[1]
-		
-			if segment != args.get(target) and not function:
-				if error:
-					return error()(environ, start_response)
-				rsp = Response("Error: JWT requirements not met")
-				rsp.status_code = 403
-				return rsp(environ, start_response)
-		
-			try:
-				if function and not function(args.get(target)):
-					if error:
-						return error()(environ, start_response)
-					rsp = Response("Error: JWT requirements not met")
-					rsp.status_code = 403
-					return rsp(environ, start_response)
-			except:
-				if error:
-					return error()(environ, start_response)
-				rsp = Response("Error: JWT requirements not met")
-				rsp.status_code = 403
-				return rsp(environ, start_response)
-
-			#If you passed all the stages of verification, and you have negative auth, raise an error
-			if negative_auth:
-				if error:
-					return error()(environ, start_response)
-				rsp = Response("Error: The token is valid, this route requires the token to be invalid")
-				rsp.status_code = 400
-				return rsp(environ, start_response)
-
-		if hasattr(controller, "_validator"):
-			validator = controller._validator
-			error = controller._error
-			mimetypes = controller._mimetypes
-			if mimetypes and not request.mimetype in mimetypes:
-				if error:
-					return error()(environ, start_response)
-				rsp = Response("Error: Requested content type is not supported")
-				rsp.status_code = 400
-				return rsp(environ, start_response)
-			# Go through the request data, only json and html are supported
-			try:
-				data = request.json
-			except:
-				try:
-					data = request.form
-				except:
-					if error:
-						return error()
-					rsp = Response("Error: No data provided")
-					rsp.status_code = 400
-					return rsp(environ, start_response)
-			if not data:
-				if error:
-					return error()
-				rsp = Response("Error: No data provided or data was malformed")
-				rsp.status_code = 400
-				return rsp(environ, start_response)
-
-			validation_result = validate(validator, error, data)
-			if validation_result:
-				return validation_result(environ, start_response)
-
-		return controller(request, *args.values())(environ, start_response)
+		route_metrics = compiled.metrics
+		if route_metrics:
+			self.metrics.begin(route_metrics)
+		response, waited = self.admit(compiled, environ)
+		if waited is not None and route_metrics:
+			self.metrics.record_wait(route_metrics, waited, response is not None)
+		if response is not None:
+			if route_metrics:
+				self.metrics.record(route_metrics, response.status_code, start, request.content_length or 0, response.calculate_content_length() or 0)
+			return response(environ, start_response)
+		# Database sessions used by the request are opened lazily and belong to this scope
+		scope = RequestScope(f"{method} {compiled.route.url}", compiled.use_primary or RequestScope.wrote_recently(request))
+		if self.sql:
+			self.sql.begin(scope)
+		try:
+			if compiled.is_async or compiled.is_async_generator:
+				raise self.async_error(compiled)
+			# Auth, validation and the controller itself were resolved in load_mapper
+			profiler = self.profiler
+			if profiler and profiler.enabled and profiler.should_profile(compiled.route.url, environ):
+				response = profiler.run(compiled, request, result.get("params"))
+			else:
+				response = compiled(request, result.get("params"))
+			if self.compression and compiled.compress:
+				response = self.compression.apply(response, environ, compiled.compression_min_size)
+		except Exception:
+			if route_metrics:
+				self.metrics.record(route_metrics, 500, start, request.content_length or 0, 0)
+			self.end_request(compiled, scope, True)
+			raise
+		if route_metrics:
+			self.metrics.record(route_metrics, response.status_code, start, request.content_length or 0, response.calculate_content_length() or 0)
+		# Error responses roll back whatever the controller left in its session
+		failed = response.status_code >= 400
+		if not failed:
+			scope.remember_writes(response)
+		if self.sql:
+			self.sql.annotate(scope, response)
+		if response.is_streamed:
+			# A streamed body may still be reading from the session, end the scope once it was sent
+			return ClosingIterator(response(environ, start_response), lambda: self.end_request(compiled, scope, failed))
+		self.end_request(compiled, scope, failed)
+		return response(environ, start_response)
 
 	def __call__(self, environ: dict, start_response: Callable) -> Iterable[bytes]:
 		return self.wsgi_handler(environ, start_response)